@@ -0,0 +1,352 @@
+# coding=utf-8
+
+"""
+store_requestで使用する、メッセージ重複判定用のフィルタ
+MD5OfBody(16バイト)をBloom filterに登録することで、件数に依らない固定サイズのメモリで重複を判定する
+フィルタはS3に保存し、一定時間(window)内であれば呼び出しを跨いだ重複も判定する
+"""
+
+import math
+import struct
+import time
+import botocore.exceptions
+from typing import Any, List
+
+MAGIC = b'DDF1'
+HEADER = struct.Struct('<4sQIQd')  # magic, ビット数, ハッシュ関数の数, 登録件数, 作成時刻
+
+
+class BloomFilter:
+    """
+    16バイトのダイジェストを登録するBloom filter
+    ダイジェスト自体が一様なハッシュ値なので、前半/後半の8バイトを二つのハッシュ値としてdouble hashingする
+    """
+
+    def __init__(self, size_bits: int, hashes: int, created_at: float, count: int = 0, bits: bytearray = None) -> None:
+        """
+        Parameters
+        ----------
+        size_bits: int
+            ビット配列の大きさ
+        hashes: int
+            ハッシュ関数の数
+        created_at: float
+            作成時刻(unix時間)
+        count: int
+            登録件数
+        bits: bytearray
+            ビット配列。Noneの場合は空のフィルタを作成する
+        """
+        self.size_bits = size_bits
+        self.hashes = hashes
+        self.created_at = created_at
+        self.count = count
+        self.bits = bytearray((size_bits + 7) // 8) if bits is None else bits
+
+    @classmethod
+    def create(cls, capacity: int, error_rate: float, created_at: float) -> 'BloomFilter':
+        """
+        想定件数と誤判定率から大きさを決めてフィルタを作成する
+
+        Parameters
+        ----------
+        capacity: int
+            登録する想定件数
+        error_rate: float
+            想定件数を登録したときの誤判定(偽陽性)率
+        created_at: float
+            作成時刻(unix時間)
+
+        Returns
+        -------
+        BloomFilter
+            空のフィルタ
+        """
+        size_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        hashes = max(1, int(round(size_bits / capacity * math.log(2))))
+        return cls(size_bits, hashes, created_at)
+
+    def _positions(self, digest: bytes) -> List[int]:
+        """
+        ダイジェストに対応するビット位置を返す
+        """
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        return [(h1 + i * h2) % self.size_bits for i in range(self.hashes)]
+
+    def __contains__(self, digest: bytes) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(digest))
+
+    def add(self, digest: bytes) -> bool:
+        """
+        ダイジェストを登録する
+
+        Parameters
+        ----------
+        digest: bytes
+            16バイトのダイジェスト
+
+        Returns
+        -------
+        bool
+            既に登録されていた(と判定された)場合はTrue
+        """
+        found = True
+        for p in self._positions(digest):
+            mask = 1 << (p & 7)
+            if not self.bits[p >> 3] & mask:
+                found = False
+                self.bits[p >> 3] |= mask
+        if not found:
+            self.count += 1
+        return found
+
+    def false_positive_rate(self) -> float:
+        """
+        現在の登録件数での誤判定率の推定値
+        """
+        return (1 - math.exp(-self.hashes * self.count / self.size_bits)) ** self.hashes
+
+    def to_bytes(self) -> bytes:
+        """
+        保存用のbyte列に変換する
+        """
+        return HEADER.pack(MAGIC, self.size_bits, self.hashes, self.count, self.created_at) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, offset: int = 0) -> 'BloomFilter':
+        """
+        to_bytes()で変換したbyte列から復元する
+
+        Parameters
+        ----------
+        data: bytes
+            to_bytes()の結果を含むbyte列
+        offset: int
+            data内の開始位置
+
+        Returns
+        -------
+        BloomFilter
+
+        Raises
+        ------
+        ValueError
+            形式が不正
+        """
+        magic, size_bits, hashes, count, created_at = HEADER.unpack_from(data, offset)
+        if magic != MAGIC:
+            raise ValueError('invalid filter format')
+        start = offset + HEADER.size
+        bits = bytearray(data[start:start + (size_bits + 7) // 8])
+        if len(bits) != (size_bits + 7) // 8:
+            raise ValueError('invalid filter size')
+        return cls(size_bits, hashes, created_at, count, bits)
+
+    def byte_size(self) -> int:
+        """
+        to_bytes()の結果の大きさ
+        """
+        return HEADER.size + len(self.bits)
+
+
+class DedupFilter:
+    """
+    二世代のBloomFilterで、少なくともwindow秒前までに登録されたメッセージの重複を判定する
+    現世代がwindow秒を過ぎたら、旧世代を捨てて世代を進める
+    """
+
+    def __init__(self, capacity: int, error_rate: float, window: float, now: float = None,
+                 current: BloomFilter = None, previous: BloomFilter = None) -> None:
+        """
+        Parameters
+        ----------
+        capacity: int
+            一世代(window秒)に登録する想定件数
+        error_rate: float
+            一世代に想定件数を登録したときの誤判定率
+        window: float
+            一世代の期間(秒)
+        now: float
+            現在時刻(unix時間)。省略時はtime.time()
+        current: BloomFilter
+            現世代。Noneの場合は新しく作成する
+        previous: BloomFilter
+            旧世代
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.window = window
+        now = time.time() if now is None else now
+        self.current = BloomFilter.create(capacity, error_rate, now) if current is None else current
+        self.previous = previous
+        self.rotate(now)
+
+    def rotate(self, now: float) -> None:
+        """
+        現世代がwindow秒を過ぎていれば世代を進める
+
+        Parameters
+        ----------
+        now: float
+            現在時刻(unix時間)
+        """
+        if now - self.current.created_at >= 2 * self.window:  # 旧世代も期限切れ
+            self.previous = None
+            self.current = BloomFilter.create(self.capacity, self.error_rate, now)
+        elif now - self.current.created_at >= self.window:
+            self.previous = self.current
+            self.current = BloomFilter.create(self.capacity, self.error_rate, now)
+
+    def check_and_add(self, md5: str) -> bool:
+        """
+        メッセージのMD5OfBodyを登録し、重複かどうかを返す
+
+        Parameters
+        ----------
+        md5: str
+            MD5OfBody (16進文字列)
+
+        Returns
+        -------
+        bool
+            重複している(と判定された)場合はTrue
+        """
+        digest = bytes.fromhex(md5)
+        if self.previous is not None and digest in self.previous:
+            return True
+        return self.current.add(digest)
+
+    def false_positive_rate(self) -> float:
+        """
+        現在の登録件数での、新しいメッセージを重複と誤判定する確率の推定値
+        """
+        rate = self.current.false_positive_rate()
+        if self.previous is not None:
+            previous_rate = self.previous.false_positive_rate()
+            rate = rate + previous_rate - rate * previous_rate
+        return rate
+
+    def memory_bytes(self) -> int:
+        """
+        フィルタのビット配列が使用しているメモリの大きさ
+        """
+        return len(self.current.bits) + (0 if self.previous is None else len(self.previous.bits))
+
+    def to_bytes(self) -> bytes:
+        """
+        保存用のbyte列に変換する
+        """
+        return self.current.to_bytes() + (b'' if self.previous is None else self.previous.to_bytes())
+
+    @classmethod
+    def from_bytes(cls, data: bytes, capacity: int, error_rate: float, window: float,
+                   now: float = None) -> 'DedupFilter':
+        """
+        to_bytes()で変換したbyte列から復元する
+        想定件数や誤判定率が変更されて大きさが合わない場合は、空のフィルタを作成する
+
+        Parameters
+        ----------
+        data: bytes
+            to_bytes()の結果
+        capacity: int
+            一世代に登録する想定件数
+        error_rate: float
+            一世代に想定件数を登録したときの誤判定率
+        window: float
+            一世代の期間(秒)
+        now: float
+            現在時刻(unix時間)。省略時はtime.time()
+
+        Returns
+        -------
+        DedupFilter
+
+        Raises
+        ------
+        ValueError
+            形式が不正
+        """
+        current = BloomFilter.from_bytes(data)
+        previous = None
+        if len(data) > current.byte_size():
+            previous = BloomFilter.from_bytes(data, current.byte_size())
+
+        expected = BloomFilter.create(capacity, error_rate, 0)
+        if (current.size_bits, current.hashes) != (expected.size_bits, expected.hashes):
+            return cls(capacity, error_rate, window, now)
+        return cls(capacity, error_rate, window, now, current, previous)
+
+
+def load_filter(s3: Any, bucket: str, key: str, capacity: int, error_rate: float, window: float,
+                now: float = None) -> DedupFilter:
+    """
+    S3に保存されたフィルタを読み込む。存在しない場合は空のフィルタを作成する
+
+    Parameters
+    ----------
+    s3: Any
+        S3クライアント
+    bucket: str
+        フィルタを保存するS3バケット
+    key: str
+        フィルタのキー
+    capacity: int
+        一世代に登録する想定件数
+    error_rate: float
+        一世代に想定件数を登録したときの誤判定率
+    window: float
+        一世代の期間(秒)
+    now: float
+        現在時刻(unix時間)。省略時はtime.time()
+
+    Returns
+    -------
+    DedupFilter
+    """
+    try:
+        data = s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        return DedupFilter(capacity, error_rate, window, now)
+
+    return DedupFilter.from_bytes(data, capacity, error_rate, window, now)
+
+
+def save_filter(s3: Any, dedup: DedupFilter, bucket: str, key: str) -> None:
+    """
+    フィルタをS3に保存する
+
+    Parameters
+    ----------
+    s3: Any
+        S3クライアント
+    dedup: DedupFilter
+        保存するフィルタ
+    bucket: str
+        フィルタを保存するS3バケット
+    key: str
+        フィルタのキー
+    """
+    s3.put_object(Bucket=bucket, Key=key, Body=dedup.to_bytes())
+
+
+def get_capacity(rate_per_minute: int, window: float) -> int:
+    """
+    単位時間あたりの想定メッセージ数から、一世代に登録する想定件数を求める
+
+    Parameters
+    ----------
+    rate_per_minute: int
+        一分あたりの想定メッセージ数
+    window: float
+        一世代の期間(秒)
+
+    Returns
+    -------
+    int
+        一世代に登録する想定件数
+    """
+    return max(1, int(math.ceil(rate_per_minute * window / 60)))
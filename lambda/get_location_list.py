@@ -2,19 +2,39 @@
 
 """
 S3に配置された日毎の位置情報ファイルを取得するため、APIGatewayから呼び出されるlambda
+collect_requestが一日分を複数のセグメントに分割して書き出している場合("YYYYMMDD.manifest.json"がある場合)は、
+全セグメントの署名付きURLを返すので、クライアントは並行してダウンロードし、サイズとMD5で検証できる
+
+ファイルの有無と署名付きURLは、ウォームコンテナ内で年月日毎にキャッシュする
+  見つかった場合      URLの有効期限より短いCACHE_TTL秒の間、同じURLを返す
+  見つからない場合    NOT_FOUND_TTL秒(CACHE_TTLが短ければその値)の間、"not found"を返す
+                      遅れて実行されたcollect_requestや、過去日の再集計で書き出されたファイルを長く隠さないよう短くする
+"ymd_list"を指定すると、複数日分のURLを一度に返す
 """
 
 import boto3
+import botocore.exceptions
+import datetime
+import json
 import logging
 import os
-from typing import Any, Dict
+import time
+from typing import Any, Dict, List, Optional
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 DEFAULT_BUCKET_DOWNLOAD = 'me32as8cme32as8c-task3-download'
+DEFAULT_URL_EXPIRES = '300'     # 署名付きURLの有効期間(秒)
+DEFAULT_CACHE_TTL = '240'       # 見つかった結果をキャッシュする期間(秒)。URLの有効期間より短くする
+DEFAULT_NOT_FOUND_TTL = '60'    # 見つからなかった結果をキャッシュする期間(秒)。CACHE_TTLを超えない
+DEFAULT_MAX_DAYS = '31'         # ymd_listで一度に指定できる日数
+
+MIN_URL_LIFETIME = 30           # キャッシュから返すURLに残す、最低限の有効期間(秒)
+MAX_CACHE_ENTRIES = 1024        # これを超えたら、期限切れのキャッシュを削除する
 
 s3 = boto3.client('s3')
+_cache = dict()  # (バケット, 年月日) -> (期限, 結果)
 
 
 def get_key(event: Dict[str, Any]) -> str:
@@ -43,6 +63,74 @@ def get_key(event: Dict[str, Any]) -> str:
     return event['ymd'] + '.csv.gz'
 
 
+def get_manifest_key(event: Dict[str, Any]) -> str:
+    """
+    event引数から、分割して書き出した場合のマニフェストのS3上のキーを取得する
+
+    Parameters
+    ----------
+    event: Dict[str, Any]
+        lambda_handerに渡されたevent
+
+    Returns
+    -------
+    str:
+        マニフェストのS3上のキー
+
+    Raises
+    ------
+    KeyError
+        eventにymdキーが含まれない
+    """
+    return event['ymd'] + '.manifest.json'
+
+
+def get_manifest(key: str, bucket: str) -> Optional[Dict[str, Any]]:
+    """
+    分割して書き出した場合のマニフェストを読み込む
+
+    Parameters
+    ----------
+    key: str
+        マニフェストのS3上のキー
+    bucket: str
+        キーが含まれるS3バケット名
+
+    Returns
+    -------
+    Optional[Dict[str, Any]]
+        マニフェスト。存在しない(分割されていない)場合はNone
+    """
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        return None
+
+
+def get_segment_list(manifest: Dict[str, Any], bucket: str, expires_in: int = 300) -> List[Dict[str, Any]]:
+    """
+    マニフェストに記載された全セグメントの署名付きURLと、検証用の情報を返す
+
+    Parameters
+    ----------
+    manifest: Dict[str, Any]
+        マニフェスト
+    bucket: str
+        セグメントが含まれるS3バケット名
+    expires_in: int
+        署名付きURLの有効期間(秒)
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        [{"Location": 署名付きURL, "Size": サイズ, "Records": レコード数, "MD5": MD5(16進文字列)}]
+    """
+    return [{'Location': get_presigned_url(x['key'], bucket, expires_in), 'Size': x['size'], 'Records': x['records'],
+             'MD5': x['md5']} for x in manifest['segments']]
+
+
 def check_file(key: str, bucket: str) -> None:
     """
     S3上に指定されたキーのオブジェクトが存在するかどうかを調べる
@@ -64,7 +152,7 @@ def check_file(key: str, bucket: str) -> None:
     s3.head_object(Bucket=bucket, Key=key)
 
 
-def get_presigned_url(key: str, bucket: str) -> str:
+def get_presigned_url(key: str, bucket: str, expires_in: int = 300) -> str:
     """
     指定されたキーの署名付きURLを返す
 
@@ -74,6 +162,8 @@ def get_presigned_url(key: str, bucket: str) -> str:
         対象となるS3オブジェクトのキー
     bucket: str
         キーが含まれるS3バケット名
+    expires_in: int
+        署名付きURLの有効期間(秒)
 
     Returns
     -------
@@ -83,11 +173,139 @@ def get_presigned_url(key: str, bucket: str) -> str:
     return s3.generate_presigned_url(
         ClientMethod='get_object',
         Params={'Bucket': bucket, 'Key': key},
-        ExpiresIn=300,
+        ExpiresIn=expires_in,
         HttpMethod='GET'
     )
 
 
+def find_location(ymd: str, bucket: str, expires_in: int) -> Optional[Dict[str, Any]]:
+    """
+    指定日のファイルを探し、署名付きURLを返す
+
+    Parameters
+    ----------
+    ymd: str
+        年月日 (YYYYMMDD)
+    bucket: str
+        ダウンロード用のS3バケット名
+    expires_in: int
+        署名付きURLの有効期間(秒)
+
+    Returns
+    -------
+    Optional[Dict[str, Any]]
+        {"Location": 署名付きURL}
+        分割して書き出されている場合は {"Records": レコード数, "Segments": get_segment_list()の結果}
+        ファイルが無い場合はNone
+    """
+    # 通常は分割されていないので、先に一日分のファイルの有無を(マニフェストの読み込みより軽い)HEADで調べる
+    key = get_key({'ymd': ymd})
+    try:
+        check_file(key, bucket)
+        return {
+            'Location': get_presigned_url(key, bucket, expires_in)
+        }
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+
+    # 分割して書き出されている場合は、全セグメントのURLを返す
+    manifest = get_manifest(get_manifest_key({'ymd': ymd}), bucket)
+    if manifest is None:
+        return None
+    return {
+        'Records': manifest['records'],
+        'Segments': get_segment_list(manifest, bucket, expires_in)
+    }
+
+
+def lookup_location(ymd: str, bucket: str, expires_in: int, cache_ttl: int, not_found_ttl: int,
+                    now: float = None) -> Optional[Dict[str, Any]]:
+    """
+    find_locationの結果を、ウォームコンテナ内でキャッシュしながら返す
+
+    Parameters
+    ----------
+    ymd: str
+        年月日 (YYYYMMDD)
+    bucket: str
+        ダウンロード用のS3バケット名
+    expires_in: int
+        署名付きURLの有効期間(秒)
+    cache_ttl: int
+        見つかった結果をキャッシュする期間(秒)。URLの有効期間からMIN_URL_LIFETIMEを引いた値までに制限する
+    not_found_ttl: int
+        見つからなかった結果をキャッシュする期間(秒)。cache_ttlまでに制限する
+    now: float
+        現在時刻(unix時間)。省略時はtime.time()
+
+    Returns
+    -------
+    Optional[Dict[str, Any]]
+        find_locationの結果
+    """
+    now = time.time() if now is None else now
+    cached = _cache.get((bucket, ymd))
+    if cached is not None and now < cached[0]:
+        return cached[1]
+
+    result = find_location(ymd, bucket, expires_in)
+    if result is None:
+        expires = now + min(not_found_ttl, cache_ttl)
+    else:
+        expires = now + min(cache_ttl, expires_in - MIN_URL_LIFETIME)
+
+    if len(_cache) >= MAX_CACHE_ENTRIES:
+        for k in [k for k, v in _cache.items() if v[0] <= now]:
+            del _cache[k]
+    _cache[(bucket, ymd)] = (expires, result)
+    return result
+
+
+def get_ymd_list(event: Dict[str, Any], max_days: int) -> List[str]:
+    """
+    event引数の"ymd_list"から、対象となる年月日の一覧を求める
+    各要素は"YYYYMMDD"または"YYYYMMDD-YYYYMMDD"(両端を含む期間)
+
+    Parameters
+    ----------
+    event: Dict[str, Any]
+        lambda_handerに渡されたevent
+        {
+            "ymd_list": ["YYYYMMDD", "YYYYMMDD-YYYYMMDD", ...]
+        }
+        の形式
+    max_days: int
+        一度に指定できる日数
+
+    Returns
+    -------
+    List[str]
+        年月日 (YYYYMMDD) の一覧。重複は除く
+
+    Raises
+    ------
+    KeyError
+        eventにymd_listキーが含まれない
+    ValueError
+        日付の形式が不正、または日数がmax_daysを超える
+    """
+    result = []
+    for arg in event['ymd_list']:
+        first, _, last = str(arg).partition('-')
+        day = datetime.datetime.strptime(first, '%Y%m%d')
+        end = datetime.datetime.strptime(last, '%Y%m%d') if last else day
+        while day <= end:
+            ymd = day.strftime('%Y%m%d')
+            if ymd not in result:
+                result.append(ymd)
+                if len(result) > max_days:
+                    raise ValueError('too many days')
+            day += datetime.timedelta(days=1)
+
+    return result
+
+
 def lambda_handler(event: Dict[str, Any], context) -> Dict[str, Any]:
     """
     Lambdaからinvokeされる関数
@@ -96,25 +314,41 @@ def lambda_handler(event: Dict[str, Any], context) -> Dict[str, Any]:
     ----------
     event: Dict[str, Any]
         APIGateway経由で与えられたJSONデータをdictにしたもの
+        {"ymd": "YYYYMMDD"} または {"ymd_list": ["YYYYMMDD", "YYYYMMDD-YYYYMMDD", ...]}
     context: Any
         未使用
 
     Returns
     ------
     Dict[str, Any]
-        "success" or "error"
+        {"Location": 署名付きURL}
+        分割して書き出されている場合は {"Records": レコード数, "Segments": get_segment_list()の結果}
+        ymd_listを指定した場合は {"Days": [{"ymd": 年月日, 上記のいずれか}
+                                           または {"ymd": 年月日, "Error": "not found"}]}
     """
     try:
         logger.info('start.')
         bucket = os.environ.get('BUCKET_DOWNLOAD', DEFAULT_BUCKET_DOWNLOAD)
+        expires_in = int(os.environ.get('URL_EXPIRES', DEFAULT_URL_EXPIRES))
+        cache_ttl = int(os.environ.get('CACHE_TTL', DEFAULT_CACHE_TTL))
+        not_found_ttl = int(os.environ.get('NOT_FOUND_TTL', DEFAULT_NOT_FOUND_TTL))
+        max_days = int(os.environ.get('MAX_DAYS', DEFAULT_MAX_DAYS))
 
-        key = get_key(event)
-        check_file(key, bucket)
-        location = get_presigned_url(key, bucket)
+        if 'ymd_list' in event:
+            days = []
+            for ymd in get_ymd_list(event, max_days):
+                result = lookup_location(ymd, bucket, expires_in, cache_ttl, not_found_ttl)
+                days.append(dict({'ymd': ymd}, **(result if result is not None else {'Error': 'not found'})))
+            logger.info('finished.')
+            return {
+                'Days': days
+            }
+
+        result = lookup_location(event['ymd'], bucket, expires_in, cache_ttl, not_found_ttl)
+        if result is None:
+            raise Exception('{} not found'.format(event['ymd']))
         logger.info('finished.')
-        return {
-            'Location': location
-        }
+        return result
     except Exception as e:
         logger.error(e)
         raise Exception('not found')
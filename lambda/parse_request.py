@@ -8,15 +8,16 @@ APIGateway経由でLambdaとして呼び出される
 [parse_request]  ->  store_request  ->  retrieve_request  -> collect_request
 """
 
-import boto3
 import logging
 import os
-from typing import Any, Dict
+from typing import Any, Dict, List, Tuple
+from sqs_connection import call_with_queue
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 DEFAULT_QUEUE_NAME = 'request-queue'
+BATCH_SIZE = 10    # send_message_batchで一度に送信できる最大件数
 
 
 def parse_request(json: Dict[str, Any]) -> str:
@@ -80,12 +81,102 @@ def push_location(location: str, queue_name: str) -> None:
     queue_name: str
         キュー名。デフォルトはQUEUE_NAME
     """
-    sqs = boto3.client('sqs')
-    queue_url = sqs.get_queue_url(QueueName=queue_name)['QueueUrl']
-    sqs.send_message(
+    call_with_queue(queue_name, lambda sqs, queue_url: sqs.send_message(
         QueueUrl=queue_url,
         MessageBody=location
-    )
+    ))
+
+
+def parse_requests(json_list: List[Dict[str, Any]]) -> Tuple[List[Tuple[int, str]], List[Dict[str, Any]]]:
+    """
+    複数の位置情報JSONをまとめてCSV文字列に変換する
+    不正なレコードは処理を中断せず、リジェクトとして結果に記録する
+
+    Parameters
+    ----------
+    json_list: List[Dict[str, Any]]
+        parse_requestに渡すJSONを表すdictのリスト
+
+    Returns
+    -------
+    List[Tuple[int, str]], List[Dict[str, Any]]
+        (リスト内の位置, "ユーザID,緯度,経度,タイムスタンプ"の文字列)のリスト,
+        各要素の処理結果 ({"index": 位置, "status": "accepted" or "rejected", ["reason": 理由]}) のリスト
+    """
+    locations = list()
+    results = list()
+    for index, json in enumerate(json_list):
+        try:
+            locations.append((index, parse_request(json)))
+            results.append({'index': index, 'status': 'accepted'})
+        except (KeyError, TypeError, AttributeError):
+            results.append({'index': index, 'status': 'rejected', 'reason': 'invalid json format'})
+        except ValueError:
+            results.append({'index': index, 'status': 'rejected', 'reason': 'invalid value'})
+
+    return locations, results
+
+
+def push_locations(locations: List[Tuple[int, str]], queue_name: str) -> List[int]:
+    """
+    複数の位置情報を、send_message_batchでBATCH_SIZE件ずつSQSにpushする
+
+    Parameters
+    ----------
+    locations: List[Tuple[int, str]]
+        parse_requestsで取得された(リスト内の位置, 位置情報を表す文字列)のリスト
+    queue_name: str
+        キュー名
+
+    Returns
+    -------
+    List[int]
+        SQSへの送信に失敗した要素の位置(リスト内の位置)のリスト
+    """
+    failed = list()
+    if len(locations) == 0:
+        return failed
+
+    for i in range(0, len(locations), BATCH_SIZE):
+        entries = [{'Id': str(index), 'MessageBody': location} for index, location in locations[i:i + BATCH_SIZE]]
+        response = call_with_queue(queue_name, lambda sqs, queue_url: sqs.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=entries
+        ))
+        failed.extend([int(x['Id']) for x in response.get('Failed', [])])
+
+    return failed
+
+
+def handle_batch(json_list: List[Dict[str, Any]], queue_name: str) -> Dict[str, Any]:
+    """
+    位置情報JSONのリストをまとめて処理し、要素毎の受付結果を返す
+
+    Parameters
+    ----------
+    json_list: List[Dict[str, Any]]
+        parse_requestに渡すJSONを表すdictのリスト
+    queue_name: str
+        キュー名
+
+    Returns
+    -------
+    Dict[str, Any]
+        {"accepted": 受付件数, "rejected": リジェクト件数, "results": 要素毎の処理結果のリスト}
+    """
+    if not isinstance(json_list, list):
+        raise TypeError('locations must be a list')
+
+    locations, results = parse_requests(json_list)
+    for index in push_locations(locations, queue_name):
+        results[index] = {'index': index, 'status': 'rejected', 'reason': 'queue error'}
+
+    accepted = len([x for x in results if x['status'] == 'accepted'])
+    return {
+        'accepted': accepted,
+        'rejected': len(results) - accepted,
+        'results': results,
+    }
 
 
 def lambda_handler(event: Dict[str, Any], context) -> Dict[str, Any]:
@@ -96,6 +187,7 @@ def lambda_handler(event: Dict[str, Any], context) -> Dict[str, Any]:
     ----------
     event: Dict[str, Any]
         APIGateway経由で与えられたJSONデータをdictにしたもの
+        {"locations": [JSON, JSON, ...]} の形式の場合は、複数件をまとめて処理する(バッチモード)
     context: Any
         未使用
 
@@ -103,10 +195,19 @@ def lambda_handler(event: Dict[str, Any], context) -> Dict[str, Any]:
     ------
     Dict[str, Any]
         "success" or "error"
+        バッチモードの場合は、bodyにhandle_batchの結果が入る
     """
     try:
         logger.info('start.')
         queue_name = os.environ.get('QUEUE_NAME', DEFAULT_QUEUE_NAME)
+        if 'locations' in event:  # バッチモード
+            result = handle_batch(event['locations'], queue_name)
+            logger.info('finished. accepted={0} rejected={1}'.format(result['accepted'], result['rejected']))
+            return {
+                'statusCode': 200,
+                'body': result,
+            }
+
         location = parse_request(event)
         push_location(location, queue_name)
         logger.info('finished.')
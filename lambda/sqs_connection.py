@@ -0,0 +1,122 @@
+# coding=utf-8
+
+"""
+parse_request, store_request共通で使用するSQSへの接続層
+SQSクライアントとキューURLはコンテナ単位で保持し、Lambdaのウォームスタート時には再利用する
+エラーが発生したときのみ破棄して作り直す
+"""
+
+import boto3
+import botocore.exceptions
+import logging
+import threading
+from typing import Any, Callable, Dict, TypeVar
+
+logger = logging.getLogger()
+
+T = TypeVar('T')
+
+_lock = threading.Lock()
+_client = None                          # SQSクライアント (コンテナ単位で共有)
+_queue_urls: Dict[str, str] = dict()    # キュー名 -> キューURL
+
+# キューURLが無効になった場合のエラーコード
+STALE_QUEUE_ERROR_CODES = ('QueueDoesNotExist', 'AWS.SimpleQueueService.NonExistentQueue')
+
+
+def get_client() -> Any:
+    """
+    SQSクライアントを取得する
+    まだ作成されていなければ作成する
+
+    Returns
+    -------
+    Any
+        SQSクライアント
+    """
+    global _client
+    with _lock:
+        if _client is None:
+            _client = boto3.client('sqs')
+        return _client
+
+
+def get_queue_url(queue_name: str) -> str:
+    """
+    キューURLを取得する
+    まだ解決されていなければget_queue_urlで解決する
+
+    Parameters
+    ----------
+    queue_name: str
+        キュー名
+
+    Returns
+    -------
+    str
+        キューURL
+    """
+    queue_url = _queue_urls.get(queue_name)
+    if queue_url is None:
+        queue_url = get_client().get_queue_url(QueueName=queue_name)['QueueUrl']
+        with _lock:
+            _queue_urls[queue_name] = queue_url
+    return queue_url
+
+
+def invalidate() -> None:
+    """
+    保持しているSQSクライアントとキューURLを破棄する
+    """
+    global _client
+    with _lock:
+        _client = None
+        _queue_urls.clear()
+
+
+def is_stale_queue_error(e: Exception) -> bool:
+    """
+    保持しているキューURLが無効になった(キューが作り直された)ことによるエラーかどうか
+
+    Parameters
+    ----------
+    e: Exception
+        発生した例外
+
+    Returns
+    -------
+    bool
+        キューが存在しないエラーの場合はTrue
+    """
+    return isinstance(e, botocore.exceptions.ClientError) \
+        and e.response.get('Error', {}).get('Code') in STALE_QUEUE_ERROR_CODES
+
+
+def call_with_queue(queue_name: str, func: Callable[[Any, str], T]) -> T:
+    """
+    保持しているSQSクライアントとキューURLでfuncを呼び出す
+    キューが存在しないエラーの場合のみ、クライアントとキューURLを作り直して一度だけ再実行する
+    タイムアウトなどのその他のエラーは、最初の呼び出しが成功している可能性がある(再実行すると二重に送信される)ので、
+    再実行せずにそのまま送出する
+
+    Parameters
+    ----------
+    queue_name: str
+        キュー名
+    func: Callable[[Any, str], T]
+        func(SQSクライアント, キューURL)の形で呼び出される関数
+
+    Returns
+    -------
+    T
+        funcの戻り値
+    """
+    try:
+        return func(get_client(), get_queue_url(queue_name))
+    except botocore.exceptions.ClientError as e:
+        if not is_stale_queue_error(e):
+            raise
+        logger.warning('queue not found. retry with new connection: {}'.format(e))
+        invalidate()
+
+    return func(get_client(), get_queue_url(queue_name))
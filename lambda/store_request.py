@@ -12,7 +12,12 @@ import boto3
 import logging
 import time
 import os
-from typing import Any, List, Dict
+import threading
+import concurrent.futures
+from typing import Any, Callable, List, Dict, Optional, Tuple
+from sqs_connection import get_client, get_queue_url, invalidate
+from dedup_filter import DedupFilter, load_filter, save_filter, get_capacity
+import work_file
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -20,64 +25,406 @@ logger.setLevel(logging.INFO)
 DEFAULT_QUEUE_NAME = 'request-queue'
 DEFAULT_BUCKET_LOCATION = 'me32as8cme32as8c-task3-location'
 DEFAULT_FOLDER_WORK = 'work/'
+DEFAULT_DRAIN_WORKERS = '4'          # キューを並列に取り出すスレッド数
+DEFAULT_WAIT_TIME_SECONDS = '1'      # receive_messageのロングポーリング待ち時間(秒)
+DEFAULT_TIME_MARGIN_SECONDS = '30'   # Lambdaのタイムアウトまでに、書き出し用に残しておく時間(秒)
+DEFAULT_MAX_OBJECT_BYTES = str(64 * 1024 * 1024)  # 一つのオブジェクトに書き込む非圧縮サイズの上限
+DEFAULT_MAX_OBJECT_RECORDS = '50000'              # 一つのオブジェクトに書き込む件数の上限
+DEFAULT_PART_SIZE = str(8 * 1024 * 1024)          # マルチパートアップロードの一パートのサイズ
+DEFAULT_DEDUP_KEY = 'dedup/filter.bin'            # 重複判定用フィルタの保存先
+DEFAULT_DEDUP_WINDOW_SECONDS = '900'              # 呼び出しを跨いで重複を判定する期間(秒)
+DEFAULT_DEDUP_RATE_PER_MINUTE = '30000'           # フィルタの大きさを決めるための、一分あたりの想定メッセージ数
+DEFAULT_DEDUP_ERROR_RATE = '0.000001'             # 想定件数を登録したときの誤判定率
+DEFAULT_WORK_FORMAT = work_file.DEFAULT_FORMAT    # 作業用フォルダに書き出すオブジェクトの形式
+DEFAULT_WORK_PARTITIONED = '1'                    # 作業用フォルダのオブジェクトを日付(JST)毎に分けるかどうか
 
 
-def retrieve_location(queue_name: str) -> List[str]:
+def get_deadline(context: Any, margin: float) -> Optional[float]:
     """
-    SQSに蓄えられたリクエストを取得し、重複を取り除いた位置情報一覧を取得する
+    Lambdaの残り時間から、キューの取り出しを打ち切る時刻を求める
 
     Parameters
     ----------
-    queue_name: str
-        リクエストを取得するQUEUEの名前
+    context: Any
+        Lambdaのcontext。get_remaining_time_in_millis()を持たない場合は打ち切らない
+    margin: float
+        書き出し等のために残しておく時間(秒)
 
     Returns
-    ------
-    List[str]
-        "ユーザID,緯度,経度,タイムスタンプ"の文字列のリスト
-    """
-    sqs = boto3.client('sqs')
-    retrieved = set()  # 重複チェック用
-    result = list()    # メソッドの結果
-    queue_url = sqs.get_queue_url(QueueName=queue_name)['QueueUrl']
-    while True:
-        messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)
-        if 'Messages' not in messages or len(messages['Messages']) == 0:  # キューが空か
-            break
+    -------
+    Optional[float]
+        打ち切り時刻(unix時間)。打ち切らない場合はNone
+    """
+    if not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    return time.time() + context.get_remaining_time_in_millis() / 1000 - margin
+
 
-        for message in messages['Messages']:
-            handle, md5, body = [message[x] for x in ['ReceiptHandle', 'MD5OfBody', 'Body']]
-            if md5 not in retrieved:  # メッセージが重複していなければ
-                retrieved.update({md5})
-                result.append(body)
-            sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=handle)
+def delete_messages(sqs: Any, queue_url: str, handles: List[str]) -> None:
+    """
+    取り出したメッセージをdelete_message_batchでまとめて削除する
+    削除に失敗したメッセージは再配信されるが、重複は取り出し側で取り除かれる
 
-    return result
+    Parameters
+    ----------
+    sqs: Any
+        SQSクライアント
+    queue_url: str
+        キューURL
+    handles: List[str]
+        削除するメッセージのReceiptHandleのリスト (最大10件)
+    """
+    if len(handles) == 0:
+        return
+    response = sqs.delete_message_batch(
+        QueueUrl=queue_url,
+        Entries=[{'Id': str(i), 'ReceiptHandle': handle} for i, handle in enumerate(handles)]
+    )
+    for failed in response.get('Failed', []):
+        logger.warning('delete failed: {}'.format(failed))
 
 
-def write_location(file_name: str, locations: List[str], bucket: str, prefix: str) -> None:
+def delete_received_messages(queue_name: str, handles: List[str], executor: concurrent.futures.Executor) -> None:
     """
-    位置情報を作業用フォルダ(S3)に書き込む
+    取り出したメッセージを10件ずつ、executorで並列に削除する
+
     Parameters
     ----------
-    file_name: str
-        書き出すオブジェクトの名前
+    queue_name: str
+        キュー名
+    handles: List[str]
+        削除するメッセージのReceiptHandleのリスト
+    executor: concurrent.futures.Executor
+        削除に使うスレッドプール (呼び出し毎に作らず、lambda_handlerの中で共有する)
+    """
+    sqs = get_client()
+    queue_url = get_queue_url(queue_name)
+    batches = [handles[i:i + 10] for i in range(0, len(handles), 10)]
+    list(executor.map(lambda batch: delete_messages(sqs, queue_url, batch), batches))
 
-    locations: List[str]
-        retrieve_location()で取得された結果。"ユーザID,緯度,経度,タイムスタンプ"の文字列のリスト
 
-    bucket: str
-        オブジェクトを書き込むS3バケット
+class WorkObject:
+    """
+    作業用フォルダ(S3)に順次書き出すオブジェクトの状態
+    同じprefixのオブジェクトは、区切られる毎に通し番号を進めた別のWorkObjectになる
+    レコードの追加はLocationWriterのロック内で行い、パートの送信はロックの外で並行して行うので、
+    送信中のパートの数をconditionで管理し、オブジェクトの完成時にはその送信を待つ
+    """
+
+    def __init__(self, prefix: str, file_name: str, fmt: str, sequence: int = 0) -> None:
+        """
+        Parameters
+        ----------
+        prefix: str
+            オブジェクトのprefix
+        file_name: str
+            オブジェクトの名前のベース。実際の名前は"ベース-通し番号.形式名"となる
+        fmt: str
+            オブジェクトの形式名
+        sequence: int
+            オブジェクトの通し番号
+        """
+        self.prefix = prefix
+        self.file_name = file_name
+        self.fmt = fmt
+        self.sequence = sequence
+        self.compressor = work_file.create_compressor(self.fmt)
+        self.buffer = bytearray()  # 未送信の圧縮済みデータ
+        self.raw_bytes = 0
+        self.records = 0
+        self.handles = list()      # このオブジェクトの書き込み完了後に削除するメッセージ
+        self.condition = threading.Condition()  # 以下のマルチパートアップロードの状態を保護する
+        self.upload_id = None
+        self.parts = list()
+        self.next_part = 1         # 次に割り当てるパート番号
+        self.pending = 0           # 送信中のパートの数
+        self.error = None          # パートの送信で発生した例外
+
+    def key(self) -> str:
+        """
+        書き込み中のオブジェクトのキー
+        """
+        return self.prefix + '{0}-{1:04d}.{2}'.format(self.file_name, self.sequence, self.fmt)
 
-    prefix: str
-        オブジェクトのprefix
+    def append(self, record: bytes) -> None:
+        """
+        変換済みのレコードを圧縮してバッファに追加する
+        """
+        self.buffer += self.compressor.compress(record)
+        self.raw_bytes += len(record)
+        self.records += 1
+
+    def take_part(self) -> Tuple[int, bytes]:
+        """
+        バッファの圧縮済みデータを、パート番号を割り当てて取り出す (送信中のパートとして数える)
+        """
+        with self.condition:
+            part_number = self.next_part
+            self.next_part += 1
+            self.pending += 1
+        data = bytes(self.buffer)
+        self.buffer = bytearray()
+        return part_number, data
+
+
+class LocationWriter:
     """
-    s3 = boto3.client('s3')
-    s3.put_object(
-        Bucket=bucket,
-        Key=prefix + file_name,
-        Body="\n".join(locations) + "\n"
-    )
+    取り出したメッセージを重複を取り除きながら指定された形式(work_file参照)に変換し、作業用フォルダ(S3)のオブジェクトに順次書き出す
+    オブジェクトは非圧縮サイズか件数が上限に達した時点で区切り、圧縮後のデータがpart_sizeに達した分から
+    マルチパートアップロードで送り出すため、メモリ使用量は件数に比例しない
+    partitioned=Trueの場合は、レコードのタイムスタンプの日付(JST)毎に"prefix/created_date=YYYYMMDD/"に振り分けて書き出す
+    SQSのメッセージは、それを含むオブジェクトの書き込みが完了した後に削除する
+    ロック内ではレコードの変換・圧縮と、送信するパートや完成させるオブジェクトの取り出しのみ行い、
+    S3への送信とSQSからの削除はロックの外で行うので、複数スレッドからの書き込みは通信を待たずに進む
+    """
+
+    def __init__(self, file_name: str, bucket: str, prefix: str, max_bytes: int, max_records: int, part_size: int,
+                 delete_handles: Callable[[List[str]], None], dedup: DedupFilter = None,
+                 fmt: str = work_file.DEFAULT_FORMAT, partitioned: bool = False) -> None:
+        """
+        Parameters
+        ----------
+        file_name: str
+            書き出すオブジェクトの名前のベース。実際の名前は"ベース-通し番号.形式名"となる
+        bucket: str
+            オブジェクトを書き込むS3バケット
+        prefix: str
+            オブジェクトのprefix
+        max_bytes: int
+            一つのオブジェクトに書き込む非圧縮サイズの上限
+        max_records: int
+            一つのオブジェクトに書き込む件数の上限
+        part_size: int
+            マルチパートアップロードの一パートのサイズ (5MB以上)
+        delete_handles: Callable[[List[str]], None]
+            書き込みが完了したオブジェクトに含まれるメッセージのReceiptHandleを受け取り、削除する関数
+            (複数スレッドから呼び出される)
+        dedup: DedupFilter
+            重複判定用のフィルタ。Noneの場合は、この呼び出しの中だけで重複を判定する
+        fmt: str
+            書き出すオブジェクトの形式名 (例: 'csv.gz', 'bin.zst')
+        partitioned: bool
+            日付(JST)毎にオブジェクトを振り分けるかどうか
+        """
+        work_file.parse_format(fmt)  # 未知の形式ならValueError
+        self.file_name = file_name
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.part_size = part_size
+        self.delete_handles = delete_handles
+        self.fmt = fmt
+        self.partitioned = partitioned
+        self.s3 = boto3.client('s3')
+        self.lock = threading.Lock()
+        if dedup is None:
+            dedup = DedupFilter(max_records, float(DEFAULT_DEDUP_ERROR_RATE), float('inf'))
+        self.dedup = dedup
+        self.objects = dict()      # prefix -> 書き込み中のWorkObject
+        self.keys = list()         # 書き込みが完了したオブジェクトのキー
+        self.total_records = 0     # 書き込みが完了したレコード数
+
+    def _get_object(self, body: str) -> WorkObject:
+        """
+        レコードの書き込み先となるオブジェクトを取得する
+        タイムスタンプが不正なレコードは振り分けずにprefix直下に書き出す (retrieve_requestで取り除かれる)
+        """
+        prefix = self.prefix
+        if self.partitioned:
+            try:
+                prefix = work_file.get_partition_prefix(
+                    self.prefix, work_file.get_date_str(int(body.rsplit(',', 1)[1])))
+            except (IndexError, ValueError, OverflowError, OSError):
+                pass
+        if prefix not in self.objects:
+            self.objects[prefix] = WorkObject(prefix, self.file_name, self.fmt)
+        return self.objects[prefix]
+
+    def _detach(self, obj: WorkObject) -> WorkObject:
+        """
+        書き込み中のオブジェクトを区切り、以降のレコードは通し番号を進めた次のオブジェクトに書き込む (ロック内で呼び出す)
+        """
+        self.objects[obj.prefix] = WorkObject(obj.prefix, self.file_name, self.fmt, obj.sequence + 1)
+        return obj
+
+    def _upload_part(self, obj: WorkObject, part_number: int, data: bytes) -> None:
+        """
+        take_partで取り出したデータを、マルチパートアップロードの一パートとして送信する (ロックの外で呼び出す)
+        """
+        try:
+            with obj.condition:  # 同じオブジェクトのパートが並行して送信されても、アップロードは一度だけ開始する
+                if obj.upload_id is None:
+                    obj.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=obj.key())['UploadId']
+            response = self.s3.upload_part(Bucket=self.bucket, Key=obj.key(), PartNumber=part_number,
+                                           UploadId=obj.upload_id, Body=data)
+            with obj.condition:
+                obj.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        except Exception as e:
+            with obj.condition:
+                obj.error = e
+            raise
+        finally:
+            with obj.condition:
+                obj.pending -= 1
+                obj.condition.notify_all()
+
+    def _flush(self, obj: WorkObject) -> None:
+        """
+        区切ったオブジェクトを完成させ、含まれるメッセージをSQSから削除する (ロックの外で呼び出す)
+        送信中のパートがあれば、その完了を待つ
+        書き込みに失敗した場合、メッセージは削除されずに再配信される
+        """
+        with obj.condition:
+            obj.condition.wait_for(lambda: obj.pending == 0)
+        try:
+            if obj.error is not None:
+                raise obj.error
+            if obj.records > 0:
+                obj.buffer += obj.compressor.flush()
+                if obj.upload_id is None:
+                    self.s3.put_object(Bucket=self.bucket, Key=obj.key(), Body=bytes(obj.buffer))
+                else:
+                    self._upload_part(obj, *obj.take_part())
+                    self.s3.complete_multipart_upload(
+                        Bucket=self.bucket, Key=obj.key(), UploadId=obj.upload_id,
+                        MultipartUpload={'Parts': sorted(obj.parts, key=lambda x: x['PartNumber'])})
+                with self.lock:
+                    self.keys.append(obj.key())
+                    self.total_records += obj.records
+        except Exception:
+            if obj.upload_id is not None:
+                self.s3.abort_multipart_upload(Bucket=self.bucket, Key=obj.key(), UploadId=obj.upload_id)
+            raise
+
+        self.delete_handles(obj.handles)
+
+    def write(self, messages: List[Dict[str, Any]]) -> None:
+        """
+        receive_messageで取得したメッセージを書き込む。複数スレッドから呼び出される
+
+        Parameters
+        ----------
+        messages: List[Dict[str, Any]]
+            receive_messageの結果の'Messages'
+        """
+        parts = list()    # 送信するパート (WorkObject, パート番号, データ)
+        flushes = list()  # 完成させるオブジェクト
+        with self.lock:
+            touched = dict()
+            for message in messages:
+                handle, md5, body = [message[x] for x in ['ReceiptHandle', 'MD5OfBody', 'Body']]
+                obj = self._get_object(body)
+                touched[obj.prefix] = obj
+                obj.handles.append(handle)
+                if self.dedup.check_and_add(md5):  # 重複したメッセージは書き込まずに削除のみ行う
+                    continue
+                try:
+                    record = work_file.encode_record(bytes(body + '\n', 'utf-8'), self.fmt)
+                except ValueError:  # バイナリ形式に変換できない不正な行は書き込まない
+                    logger.warning('invalid record: {}'.format(body))
+                    continue
+                obj.append(record)
+                if len(obj.buffer) >= self.part_size:
+                    parts.append((obj,) + obj.take_part())
+
+            for obj in touched.values():
+                if obj.raw_bytes >= self.max_bytes or obj.records >= self.max_records:
+                    flushes.append(self._detach(obj))
+
+        try:
+            for obj, part_number, data in parts:
+                self._upload_part(obj, part_number, data)
+        finally:
+            for obj in flushes:  # パートの送信に失敗した場合も、区切ったオブジェクトは中止して片付ける
+                self._flush(obj)
+
+    def close(self) -> None:
+        """
+        書き込み中のオブジェクトをすべて完成させる
+        """
+        with self.lock:
+            objects = list(self.objects.values())
+            for obj in objects:
+                self._detach(obj)
+        for obj in objects:
+            self._flush(obj)
+
+    @property
+    def records(self) -> int:
+        """
+        書き込み中のオブジェクトに含まれるレコード数
+        """
+        with self.lock:
+            return sum([obj.records for obj in self.objects.values()])
+
+
+def drain_queue(queue_name: str, deadline: Optional[float], wait_time: int, visibility_timeout: Optional[int],
+                writer: LocationWriter, stop: threading.Event) -> None:
+    """
+    キューが空になるか打ち切り時刻になるまで、リクエストを取り出してwriterに書き込む
+    retrieve_location_parallelから、ワーカー毎に呼び出される
+
+    Parameters
+    ----------
+    queue_name: str
+        リクエストを取得するQUEUEの名前
+    deadline: Optional[float]
+        打ち切り時刻(unix時間)。Noneの場合はキューが空になるまで取り出す
+    wait_time: int
+        receive_messageのロングポーリング待ち時間(秒)
+    visibility_timeout: Optional[int]
+        取り出したメッセージを不可視にしておく時間(秒)。Noneの場合はキューの設定に従う
+    writer: LocationWriter
+        取り出したメッセージの書き込み先 (ワーカー間で共有)
+    stop: threading.Event
+        他のワーカーでエラーが発生した場合にセットされる
+    """
+    sqs = get_client()
+    queue_url = get_queue_url(queue_name)
+    options = dict() if visibility_timeout is None else {'VisibilityTimeout': visibility_timeout}
+    while (deadline is None or time.time() < deadline) and not stop.is_set():
+        messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=wait_time,
+                                       **options)
+        if 'Messages' not in messages or len(messages['Messages']) == 0:  # キューが空か
+            break
+        writer.write(messages['Messages'])
+
+
+def retrieve_location_parallel(queue_name: str, workers: int, deadline: Optional[float], wait_time: int,
+                               visibility_timeout: Optional[int], writer: LocationWriter) -> None:
+    """
+    複数のワーカーでSQSに蓄えられたリクエストを並列に取得し、writerに書き込む
+    いずれかのワーカーでエラーが発生した場合は、すべてのワーカーを止めてから例外を送出する
+
+    Parameters
+    ----------
+    queue_name: str
+        リクエストを取得するQUEUEの名前
+    workers: int
+        並列に取り出すワーカー数
+    deadline: Optional[float]
+        打ち切り時刻(unix時間)。Noneの場合はキューが空になるまで取り出す
+    wait_time: int
+        receive_messageのロングポーリング待ち時間(秒)
+    visibility_timeout: Optional[int]
+        取り出したメッセージを不可視にしておく時間(秒)。Noneの場合はキューの設定に従う
+    writer: LocationWriter
+        取り出したメッセージの書き込み先
+    """
+    stop = threading.Event()
+    errors = list()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(drain_queue, queue_name, deadline, wait_time, visibility_timeout, writer, stop)
+                   for _ in range(workers)]
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception() is not None:
+                stop.set()
+                errors.append(future.exception())
+
+    if len(errors) > 0:
+        invalidate()  # 次回の呼び出しでは接続を作り直す
+        raise errors[0]
 
 
 def lambda_handler(event: Any, context: Any) -> Dict[str, Any]:
@@ -89,7 +436,7 @@ def lambda_handler(event: Any, context: Any) -> Dict[str, Any]:
     event: Any
         未使用
     context: Any
-        未使用
+        Lambdaのcontext。残り時間からキューの取り出しを打ち切る時刻を決める
 
     Returns
     ------
@@ -102,12 +449,40 @@ def lambda_handler(event: Any, context: Any) -> Dict[str, Any]:
         queue_name = os.environ.get('QUEUE_NAME', DEFAULT_QUEUE_NAME)
         bucket = os.environ.get('BUCKET_LOCATION', DEFAULT_BUCKET_LOCATION)
         folder = os.environ.get('FOLDER_WORK', DEFAULT_FOLDER_WORK)
+        workers = int(os.environ.get('DRAIN_WORKERS', DEFAULT_DRAIN_WORKERS))
+        wait_time = int(os.environ.get('WAIT_TIME_SECONDS', DEFAULT_WAIT_TIME_SECONDS))
+        margin = float(os.environ.get('TIME_MARGIN_SECONDS', DEFAULT_TIME_MARGIN_SECONDS))
+        max_bytes = int(os.environ.get('MAX_OBJECT_BYTES', DEFAULT_MAX_OBJECT_BYTES))
+        max_records = int(os.environ.get('MAX_OBJECT_RECORDS', DEFAULT_MAX_OBJECT_RECORDS))
+        part_size = int(os.environ.get('PART_SIZE', DEFAULT_PART_SIZE))
+        dedup_key = os.environ.get('DEDUP_KEY', DEFAULT_DEDUP_KEY)
+        dedup_window = float(os.environ.get('DEDUP_WINDOW_SECONDS', DEFAULT_DEDUP_WINDOW_SECONDS))
+        dedup_rate = int(os.environ.get('DEDUP_RATE_PER_MINUTE', DEFAULT_DEDUP_RATE_PER_MINUTE))
+        dedup_error_rate = float(os.environ.get('DEDUP_ERROR_RATE', DEFAULT_DEDUP_ERROR_RATE))
+        work_format = os.environ.get('WORK_FORMAT', DEFAULT_WORK_FORMAT)
+        partitioned = os.environ.get('WORK_PARTITIONED', DEFAULT_WORK_PARTITIONED) == '1'
+
+        s3 = boto3.client('s3')
+        dedup = load_filter(s3, bucket, dedup_key, get_capacity(dedup_rate, dedup_window), dedup_error_rate,
+                            dedup_window)
+
+        deadline = get_deadline(context, margin)
+        # 書き込み完了前に再配信されないよう、Lambdaの終了時刻までメッセージを不可視にしておく
+        visibility_timeout = None if deadline is None else int(deadline - time.time() + margin) + 60
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as delete_executor:
+            writer = LocationWriter(str(int(time.time())), bucket, folder, max_bytes, max_records, part_size,
+                                    lambda handles: delete_received_messages(queue_name, handles, delete_executor),
+                                    dedup, work_format, partitioned)
+            try:
+                retrieve_location_parallel(queue_name, workers, deadline, wait_time, visibility_timeout, writer)
+            finally:
+                writer.close()  # エラー時も、取り出し済みの分は書き出す
 
-        locations = retrieve_location(queue_name)
-        if len(locations) > 0:
-            file_name = str(int(time.time())) + '.csv'
-            write_location(file_name, locations, bucket, folder)
-        logger.info('finished.')
+        # 書き込みに失敗したメッセージは再配信されるので、フィルタは正常終了時のみ保存する
+        save_filter(s3, dedup, bucket, dedup_key)
+        logger.info('dedup filter: false positive rate={0:.3g} memory={1} bytes'
+                    .format(dedup.false_positive_rate(), dedup.memory_bytes()))
+        logger.info('finished. records={0} objects={1}'.format(writer.total_records, len(writer.keys)))
         return {
             'statusCode': 200,
             'body': 'success',
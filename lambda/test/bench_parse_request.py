@@ -0,0 +1,91 @@
+# coding=utf-8
+
+"""
+parse_request.lambda_handlerのレイテンシ計測用スクリプト
+SQSにはmotoを使用する (pip install moto)
+
+    python3 bench_parse_request.py [呼び出し回数]
+
+SQSクライアントとキューURLを毎回作り直す場合(従来の動作)と、
+sqs_connectionでキャッシュした場合のp50/p99を出力する
+"""
+
+import os
+import time
+import uuid
+import logging
+import boto3
+from moto import mock_aws
+from typing import Callable, List
+
+import sys
+sys.path.append('..')
+import sqs_connection
+from parse_request import lambda_handler
+
+
+def measure(count: int, before_call: Callable[[], None]) -> List[float]:
+    """
+    lambda_handlerをcount回呼び出し、それぞれの所要時間(ミリ秒)を返す
+
+    Parameters
+    ----------
+    count: int
+        呼び出し回数
+    before_call: Callable[[], None]
+        各呼び出しの直前に呼ばれる関数
+
+    Returns
+    -------
+    List[float]
+        所要時間(ミリ秒)のリスト(昇順)
+    """
+    event = {
+        'user_id': str(uuid.uuid4()),
+        'location': {
+            'lat_north_south': 'N',
+            'latitude': '35.744947',
+            'lon_west_east': 'E',
+            'longitude': '139.720168'
+        },
+        'timestamp': 1555055157
+    }
+    result = list()
+    for _ in range(count):
+        before_call()
+        start = time.perf_counter()
+        lambda_handler(event, None)
+        result.append((time.perf_counter() - start) * 1000)
+
+    return sorted(result)
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    昇順ソート済みのリストのパーセンタイル値を返す
+    """
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+@mock_aws
+def main(count: int) -> None:
+    """
+    メイン
+    """
+    logging.getLogger().setLevel(logging.WARNING)
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-northeast-1')
+    sqs = boto3.client('sqs')
+
+    for name, before_call in [('uncached', sqs_connection.invalidate), ('cached', lambda: None)]:
+        # 条件を揃えるため、計測毎に空のキューを用意する
+        queue_name = 'task3bench' + str(uuid.uuid4())
+        sqs.create_queue(QueueName=queue_name)
+        os.environ['QUEUE_NAME'] = queue_name
+        sqs_connection.invalidate()
+        measure(10, before_call)  # ウォームアップ
+        values = measure(count, before_call)
+        print('{0:10s} p50={1:8.3f}ms p99={2:8.3f}ms'.format(name, percentile(values, 50), percentile(values, 99)))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
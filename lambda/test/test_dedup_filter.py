@@ -0,0 +1,126 @@
+# coding=utf-8
+
+"""
+dedup_filter用テストファイル
+"""
+
+import unittest
+import boto3
+import uuid
+import hashlib
+import warnings
+
+import sys
+sys.path.append('..')
+from dedup_filter import BloomFilter, DedupFilter, load_filter, save_filter, get_capacity
+
+
+class TestDedupFilter(unittest.TestCase):
+    """
+    TestModule for dedup_filter
+    """
+    s3, bucket_name = (None, None)
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        S3クライアントを作成し、テスト用バケットを用意する
+        """
+        cls.s3 = boto3.client('s3')
+        cls.bucket_name = 'task3test' + str(uuid.uuid4())
+        cls.s3.create_bucket(Bucket=cls.bucket_name,
+                             CreateBucketConfiguration={
+                                 'LocationConstraint': 'ap-northeast-1'
+                             },
+                             ACL='private')
+
+        # BOTO3かunittestの不具合避け
+        warnings.filterwarnings("ignore", category=ResourceWarning, message="unclosed.*<ssl.SSLSocket.*>")
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """
+        作成したバケットの後片付け
+        """
+        cls.s3.delete_object(Bucket=cls.bucket_name, Key='dedup/filter.bin')
+        cls.s3.delete_bucket(Bucket=cls.bucket_name)
+
+    def test_bloom_filter(self) -> None:
+        """
+        BloomFilterのテスト
+        """
+        bloom = BloomFilter.create(1000, 0.001, 0)
+        self.assertEqual(bloom.size_bits, 14378)
+        self.assertEqual(bloom.hashes, 10)
+
+        digests = [self.digest(str(i)) for i in range(1000)]
+        self.assertEqual([bloom.add(d) for d in digests], [False] * 1000)
+        self.assertEqual(bloom.count, 1000)
+        self.assertTrue(all(d in bloom for d in digests))
+        self.assertAlmostEqual(bloom.false_positive_rate(), 0.001, delta=0.0005)
+
+        # 登録していないダイジェストの誤判定は、ほぼ推定値以下
+        false_positives = len([i for i in range(10000) if self.digest('x' + str(i)) in bloom])
+        self.assertLess(false_positives, 50)
+
+        restored = BloomFilter.from_bytes(bloom.to_bytes())
+        self.assertEqual((restored.size_bits, restored.hashes, restored.count), (14378, 10, 1000))
+        self.assertEqual(restored.bits, bloom.bits)
+        self.assertRaises(ValueError, BloomFilter.from_bytes, b'XXXX' + bloom.to_bytes()[4:])
+
+    def test_dedup_filter(self) -> None:
+        """
+        DedupFilterのテスト
+        """
+        dedup = DedupFilter(1000, 0.001, 60, now=0)
+        self.assertFalse(dedup.check_and_add(hashlib.md5(b'a').hexdigest()))
+        self.assertTrue(dedup.check_and_add(hashlib.md5(b'a').hexdigest()))
+        self.assertEqual(dedup.memory_bytes(), len(dedup.current.bits))
+
+        # 一世代進めても判定できる
+        dedup.rotate(60)
+        self.assertIsNotNone(dedup.previous)
+        self.assertTrue(dedup.check_and_add(hashlib.md5(b'a').hexdigest()))
+        self.assertFalse(dedup.check_and_add(hashlib.md5(b'b').hexdigest()))
+        self.assertEqual(dedup.memory_bytes(), 2 * len(dedup.current.bits))
+        self.assertGreater(dedup.false_positive_rate(), 0)
+
+        # 保存と復元
+        restored = DedupFilter.from_bytes(dedup.to_bytes(), 1000, 0.001, 60, now=61)
+        self.assertTrue(restored.check_and_add(hashlib.md5(b'a').hexdigest()))
+        self.assertTrue(restored.check_and_add(hashlib.md5(b'b').hexdigest()))
+
+        # 大きさの設定が変わった場合は空になる
+        restored = DedupFilter.from_bytes(dedup.to_bytes(), 2000, 0.001, 60, now=61)
+        self.assertFalse(restored.check_and_add(hashlib.md5(b'a').hexdigest()))
+
+        # 二世代分の期間を過ぎると判定できない
+        dedup.rotate(180)
+        self.assertIsNone(dedup.previous)
+        self.assertFalse(dedup.check_and_add(hashlib.md5(b'a').hexdigest()))
+
+    def test_load_and_save_filter(self) -> None:
+        """
+        load_filter, save_filterのテスト
+        """
+        dedup = load_filter(self.s3, self.bucket_name, 'dedup/filter.bin', 1000, 0.001, 60, now=0)
+        self.assertEqual(dedup.current.count, 0)
+        dedup.check_and_add(hashlib.md5(b'a').hexdigest())
+        save_filter(self.s3, dedup, self.bucket_name, 'dedup/filter.bin')
+
+        dedup = load_filter(self.s3, self.bucket_name, 'dedup/filter.bin', 1000, 0.001, 60, now=30)
+        self.assertTrue(dedup.check_and_add(hashlib.md5(b'a').hexdigest()))
+
+    def test_get_capacity(self) -> None:
+        """
+        get_capacityのテスト
+        """
+        self.assertEqual(get_capacity(16666, 900), 249990)
+        self.assertEqual(get_capacity(0, 900), 1)
+
+    @staticmethod
+    def digest(value: str) -> bytes:
+        """
+        テスト用のダイジェスト
+        """
+        return hashlib.md5(value.encode('ascii')).digest()
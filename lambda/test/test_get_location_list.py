@@ -11,10 +11,14 @@ import warnings
 import requests
 import os
 import botocore.exceptions
+import hashlib
+import json
 
 import sys
 sys.path.append('..')
-from get_location_list import get_key, check_file, get_presigned_url, lambda_handler
+import get_location_list
+from get_location_list import get_key, get_manifest_key, get_manifest, check_file, get_presigned_url, \
+    find_location, lookup_location, get_ymd_list, lambda_handler
 
 
 class TestGetLocationList(unittest.TestCase):
@@ -46,6 +50,10 @@ class TestGetLocationList(unittest.TestCase):
         作成したキューとバケットの後片付け
         """
         cls.s3.delete_object(Bucket=cls.bucket_name, Key='20190901.csv.gz')
+        response = cls.s3.list_objects_v2(Bucket=cls.bucket_name)
+        if 'Contents' in response:
+            cls.s3.delete_objects(Bucket=cls.bucket_name,
+                                  Delete={'Objects': [{'Key': x['Key']} for x in response['Contents']]})
         cls.s3.delete_bucket(Bucket=cls.bucket_name)
 
     def test_get_key(self) -> None:
@@ -55,6 +63,14 @@ class TestGetLocationList(unittest.TestCase):
         self.assertRaises(KeyError, get_key, {})
         self.assertEqual(get_key({'ymd': '20190901'}), '20190901.csv.gz')
 
+    def test_get_manifest(self) -> None:
+        """
+        get_manifest_key, get_manifestのテスト
+        """
+        self.assertRaises(KeyError, get_manifest_key, {})
+        self.assertEqual(get_manifest_key({'ymd': '20190901'}), '20190901.manifest.json')
+        self.assertIsNone(get_manifest('20190901.manifest.json', self.bucket_name))
+
     def test_check_file(self) -> None:
         """
         check_fileのテスト
@@ -72,6 +88,62 @@ class TestGetLocationList(unittest.TestCase):
         self.assertEqual(r.status_code, 200)
         self.assertEqual(r.content, b'dummy')
 
+    def test_find_location(self) -> None:
+        """
+        find_locationのテスト
+        """
+        self.assertIsNone(find_location('20190801', self.bucket_name, 60))
+        result = find_location('20190901', self.bucket_name, 60)
+        self.assertEqual(requests.get(result['Location']).content, b'dummy')
+
+    def test_lookup_location(self) -> None:
+        """
+        lookup_locationのテスト
+        """
+        get_location_list._cache.clear()
+        base_time = 1567263600  # 2019/9/1 00:00:00(JST)
+        key = '20190903.csv.gz'
+
+        # 見つからない結果はnot_found_ttlの間キャッシュされる
+        self.assertIsNone(lookup_location('20190903', self.bucket_name, 300, 240, 60, base_time))
+        self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=b'dummy')
+        self.assertIsNone(lookup_location('20190903', self.bucket_name, 300, 240, 60, base_time + 59))
+        result = lookup_location('20190903', self.bucket_name, 300, 240, 60, base_time + 60)
+        self.assertIn('Location', result)
+
+        # 見つかった結果はTTLの間キャッシュされる (URLの有効期間 - MIN_URL_LIFETIMEまで)
+        self.s3.delete_object(Bucket=self.bucket_name, Key=key)
+        self.assertEqual(lookup_location('20190903', self.bucket_name, 300, 240, 60, base_time + 60 + 239),
+                         result)
+        self.assertIsNone(lookup_location('20190903', self.bucket_name, 300, 240, 60, base_time + 60 + 240))
+
+        get_location_list._cache.clear()
+        self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=b'dummy')
+        result = lookup_location('20190903', self.bucket_name, 60, 240, 60, base_time)
+        self.s3.delete_object(Bucket=self.bucket_name, Key=key)
+        self.assertEqual(lookup_location('20190903', self.bucket_name, 60, 240, 60, base_time + 29), result)
+        self.assertIsNone(lookup_location('20190903', self.bucket_name, 60, 240, 60, base_time + 30))
+
+        # 見つからない結果のキャッシュ期間はcache_ttlを超えない
+        get_location_list._cache.clear()
+        self.assertIsNone(lookup_location('20190903', self.bucket_name, 300, 10, 60, base_time))
+        self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=b'dummy')
+        self.assertIsNone(lookup_location('20190903', self.bucket_name, 300, 10, 60, base_time + 9))
+        self.assertIn('Location', lookup_location('20190903', self.bucket_name, 300, 10, 60, base_time + 10))
+        self.s3.delete_object(Bucket=self.bucket_name, Key=key)
+        get_location_list._cache.clear()
+
+    def test_get_ymd_list(self) -> None:
+        """
+        get_ymd_listのテスト
+        """
+        self.assertRaises(KeyError, get_ymd_list, {}, 31)
+        self.assertEqual(get_ymd_list({'ymd_list': ['20190831-20190902', '20190901', '20190905']}, 31),
+                         ['20190831', '20190901', '20190902', '20190905'])
+        self.assertEqual(get_ymd_list({'ymd_list': ['20190902-20190901']}, 31), [])
+        self.assertRaises(ValueError, get_ymd_list, {'ymd_list': ['2019090']}, 31)
+        self.assertRaises(ValueError, get_ymd_list, {'ymd_list': ['20190901-20191001']}, 30)
+
     def test_lambda_handler(self) -> None:
         """
         lambda_handlerのテスト
@@ -84,6 +156,45 @@ class TestGetLocationList(unittest.TestCase):
         r = requests.get(result['Location'])
         self.assertEqual(r.status_code, 200)
         self.assertEqual(r.content, b'dummy')
+        self.assertRaisesRegex(Exception, 'not found', lambda_handler, {'ymd': '20190801'}, None)
+
+        result = lambda_handler({'ymd_list': ['20190831-20190901']}, None)
+        self.assertEqual(result['Days'][0], {'ymd': '20190831', 'Error': 'not found'})
+        self.assertEqual(result['Days'][1]['ymd'], '20190901')
+        self.assertEqual(requests.get(result['Days'][1]['Location']).content, b'dummy')
+        self.assertRaisesRegex(Exception, 'not found', lambda_handler, {'ymd_list': ['20190101-20191231']}, None)
+
+        if old_download_bucket is None:
+            del os.environ['BUCKET_DOWNLOAD']
+        else:
+            os.environ['BUCKET_DOWNLOAD'] = old_download_bucket
+
+    def test_lambda_handler_segments(self) -> None:
+        """
+        lambda_handlerのテスト (分割して書き出されている場合)
+        """
+        old_download_bucket = os.environ.get('BUCKET_DOWNLOAD')
+        os.environ['BUCKET_DOWNLOAD'] = self.bucket_name
+
+        bodies = [b'segment0', b'segment1']
+        segments = []
+        for i, body in enumerate(bodies):
+            key = '20190902/1-abcd/part-{0:04d}.csv.gz'.format(i)
+            self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=body)
+            segments.append({'key': key, 'size': len(body), 'records': i + 1, 'md5': hashlib.md5(body).hexdigest()})
+        self.s3.put_object(Bucket=self.bucket_name, Key='20190902.manifest.json',
+                           Body=bytes(json.dumps({'ymd': '20190902', 'records': 3, 'size': 16, 'segments': segments}),
+                                      'utf-8'))
+
+        result = lambda_handler({'ymd': '20190902'}, None)
+        self.assertEqual(result['Records'], 3)
+        self.assertEqual(len(result['Segments']), 2)
+        for body, segment in zip(bodies, result['Segments']):
+            r = requests.get(segment['Location'])
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.content, body)
+            self.assertEqual(segment['Size'], len(body))
+            self.assertEqual(segment['MD5'], hashlib.md5(r.content).hexdigest())
 
         if old_download_bucket is None:
             del os.environ['BUCKET_DOWNLOAD']
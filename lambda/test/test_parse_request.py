@@ -9,10 +9,11 @@ import boto3
 import uuid
 import warnings
 import os
+from typing import Any, Dict, Set
 
 import sys
 sys.path.append('..')
-from parse_request import parse_request, push_location, lambda_handler
+from parse_request import parse_request, push_location, parse_requests, push_locations, handle_batch, lambda_handler
 
 
 class TestParseRequest(unittest.TestCase):
@@ -147,6 +148,48 @@ class TestParseRequest(unittest.TestCase):
         messages = self.sqs.receive_message(QueueUrl=self.queue_url)
         self.assertNotEqual([x['Body'] for x in messages['Messages'] if x['Body'] == location], [])
 
+    def test_parse_requests(self) -> None:
+        """
+        parse_requests関数のテスト
+        """
+        locations, results = parse_requests([
+            self.dummyRequest('cf5bff5c-2ffe-4f18-9593-bc666313f8c5'),
+            {},                                                         # INVALID
+            dict(self.dummyRequest('cf5bff5c-2ffe-4f18-9593-bc666313f8c5'), timestamp='x'),  # INVALID
+            self.dummyRequest('cf5bff5c-2ffe-4f18-9593-bc666313f8c6'),
+        ])
+        self.assertEqual(locations, [
+            (0, 'cf5bff5c-2ffe-4f18-9593-bc666313f8c5,35.744947,139.720168,1555055157'),
+            (3, 'cf5bff5c-2ffe-4f18-9593-bc666313f8c6,35.744947,139.720168,1555055157'),
+        ])
+        self.assertEqual([x['status'] for x in results], ['accepted', 'rejected', 'rejected', 'accepted'])
+        self.assertEqual(results[1]['reason'], 'invalid json format')
+        self.assertEqual(results[2]['reason'], 'invalid value')
+
+    def test_push_locations(self) -> None:
+        """
+        push_locations関数のテスト
+        """
+        self.assertEqual(push_locations([], self.queue_name), [])
+
+        # BATCH_SIZEを跨ぐ件数
+        locations = [(i, 'cf5bff5c-2ffe-4f18-9593-bc666313f9{:02d},35.744947,139.720168,1555055157'.format(i))
+                     for i in range(15)]
+        self.assertEqual(push_locations(locations, self.queue_name), [])
+        self.assertTrue(set([x[1] for x in locations]).issubset(self.drainQueue()))
+
+    def test_handle_batch(self) -> None:
+        """
+        handle_batch関数のテスト
+        """
+        self.assertRaises(TypeError, handle_batch, {}, self.queue_name)
+
+        result = handle_batch([self.dummyRequest('cf5bff5c-2ffe-4f18-9593-bc666313f8c7'), {}], self.queue_name)
+        self.assertEqual(result['accepted'], 1)
+        self.assertEqual(result['rejected'], 1)
+        self.assertEqual([x['status'] for x in result['results']], ['accepted', 'rejected'])
+        self.assertIn('cf5bff5c-2ffe-4f18-9593-bc666313f8c7,35.744947,139.720168,1555055157', self.drainQueue())
+
     def test_lambda_handler(self) -> None:
         """
         lambda_handler関数のテスト
@@ -169,7 +212,58 @@ class TestParseRequest(unittest.TestCase):
         messages = self.sqs.receive_message(QueueUrl=self.queue_url)
         self.assertNotEqual([x['Body'] for x in messages['Messages'] if x['Body'] == location], [])
 
+        # バッチモード
+        result = lambda_handler({'locations': [self.dummyRequest('cf5bff5c-2ffe-4f18-9593-bc666313f8c8'),
+                                               {'user_id': 'cf5bff5c-2ffe-4f18-9593-bc666313f8c9'}]}, None)
+        self.assertEqual(result['statusCode'], 200)
+        self.assertEqual(result['body']['accepted'], 1)
+        self.assertEqual(result['body']['rejected'], 1)
+        self.assertIn('cf5bff5c-2ffe-4f18-9593-bc666313f8c8,35.744947,139.720168,1555055157', self.drainQueue())
+
         if old_queue_name is None:
             del os.environ['QUEUE_NAME']
         else:
             os.environ['QUEUE_NAME'] = old_queue_name
+
+    def drainQueue(self) -> Set[str]:
+        """
+        テスト用キューに残っているメッセージをすべて取り出して削除する
+
+        Returns
+        -------
+        Set[str]
+            取り出したメッセージ本文
+        """
+        received = set()
+        while True:
+            messages = self.sqs.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=10)
+            if len(messages.get('Messages', [])) == 0:
+                return received
+            for message in messages['Messages']:
+                received.add(message['Body'])
+                self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message['ReceiptHandle'])
+
+    @staticmethod
+    def dummyRequest(user_id: str) -> Dict[str, Any]:
+        """
+        ダミーの位置情報リクエスト
+
+        Parameters
+        ----------
+        user_id: str
+            ユーザID
+
+        Returns
+        -------
+        Dict[str, Any]
+        """
+        return {
+            'user_id': user_id,
+            'location': {
+                'lat_north_south': 'N',
+                'latitude': '35.744947',
+                'lon_west_east': 'E',
+                'longitude': '139.720168'
+            },
+            'timestamp': 1555055157
+        }
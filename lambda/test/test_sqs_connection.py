@@ -0,0 +1,106 @@
+# coding=utf-8
+
+"""
+sqs_connection用テストファイル
+"""
+
+import unittest
+import boto3
+import botocore.exceptions
+import uuid
+import warnings
+
+import sys
+sys.path.append('..')
+import sqs_connection
+from sqs_connection import get_client, get_queue_url, invalidate, call_with_queue, is_stale_queue_error
+
+
+class TestSqsConnection(unittest.TestCase):
+    """
+    TestModule for sqs_connection
+    """
+    sqs, queue_url, queue_name = (None, None, None)
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        SQSクライアントを作成し、SQSにテスト用のキューを作成する
+        """
+        cls.sqs = boto3.client('sqs')
+        cls.queue_name = 'task3test' + str(uuid.uuid4())
+        response = cls.sqs.create_queue(QueueName=cls.queue_name)
+        cls.queue_url = response['QueueUrl']
+        # BOTO3かunittestの不具合避け
+        warnings.filterwarnings("ignore", category=ResourceWarning, message="unclosed.*<ssl.SSLSocket.*>")
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """
+        作成したキューの後片付け
+        """
+        cls.sqs.delete_queue(QueueUrl=cls.queue_url)
+
+    def test_get_client(self) -> None:
+        """
+        get_clientのテスト
+        """
+        invalidate()
+        client = get_client()
+        self.assertIs(get_client(), client)  # 二回目以降は同じクライアント
+
+    def test_get_queue_url(self) -> None:
+        """
+        get_queue_urlのテスト
+        """
+        invalidate()
+        self.assertEqual(get_queue_url(self.queue_name), self.queue_url)
+        self.assertEqual(sqs_connection._queue_urls[self.queue_name], self.queue_url)
+        self.assertEqual(get_queue_url(self.queue_name), self.queue_url)
+
+    def test_invalidate(self) -> None:
+        """
+        invalidateのテスト
+        """
+        client = get_client()
+        get_queue_url(self.queue_name)
+        invalidate()
+        self.assertEqual(sqs_connection._queue_urls, {})
+        self.assertIsNot(get_client(), client)
+
+    def test_call_with_queue(self) -> None:
+        """
+        call_with_queueのテスト
+        """
+        self.assertEqual(call_with_queue(self.queue_name, lambda sqs, queue_url: queue_url), self.queue_url)
+
+        # 古いキューURLが残っていても、作り直して再実行される
+        sqs_connection._queue_urls[self.queue_name] = self.queue_url + 'x'
+        result = call_with_queue(self.queue_name,
+                                 lambda sqs, queue_url: sqs.get_queue_attributes(QueueUrl=queue_url))
+        self.assertIn('ResponseMetadata', result)
+        self.assertEqual(get_queue_url(self.queue_name), self.queue_url)
+
+        # キューが存在しないエラー以外は再実行しない (一度目が成功している可能性がある)
+        calls = []
+
+        def fail(sqs, queue_url):
+            calls.append(queue_url)
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'RequestTimeout'}}, 'SendMessageBatch')
+        self.assertRaises(botocore.exceptions.ClientError, call_with_queue, self.queue_name, fail)
+        self.assertEqual(len(calls), 1)
+
+        def timeout(sqs, queue_url):
+            calls.append(queue_url)
+            raise botocore.exceptions.ReadTimeoutError(endpoint_url=queue_url)
+        self.assertRaises(botocore.exceptions.ReadTimeoutError, call_with_queue, self.queue_name, timeout)
+        self.assertEqual(len(calls), 2)
+
+    def test_is_stale_queue_error(self) -> None:
+        """
+        is_stale_queue_errorのテスト
+        """
+        for code in ['QueueDoesNotExist', 'AWS.SimpleQueueService.NonExistentQueue']:
+            self.assertTrue(is_stale_queue_error(botocore.exceptions.ClientError({'Error': {'Code': code}}, 'x')))
+        self.assertFalse(is_stale_queue_error(botocore.exceptions.ClientError({'Error': {'Code': 'Throttling'}}, 'x')))
+        self.assertFalse(is_stale_queue_error(ValueError()))
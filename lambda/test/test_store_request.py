@@ -9,11 +9,17 @@ import boto3
 import uuid
 import warnings
 import os
-from typing import List
+import time
+import gzip
+import hashlib
+import concurrent.futures
+from typing import Dict, List
 
 import sys
 sys.path.append('..')
-from store_request import retrieve_location, write_location, lambda_handler
+from store_request import get_deadline, LocationWriter, retrieve_location_parallel, lambda_handler
+from work_file import decode
+from dedup_filter import DedupFilter
 
 
 class TestStoreRequest(unittest.TestCase):
@@ -52,39 +58,139 @@ class TestStoreRequest(unittest.TestCase):
         """
         cls.sqs.delete_queue(QueueUrl=cls.queue_url)
 
-        cls.s3.delete_object(Bucket=cls.bucket_name, Key='work/test.csv')
+        cls.s3.delete_object(Bucket=cls.bucket_name, Key='dedup/filter.bin')
         cls.s3.delete_bucket(Bucket=cls.bucket_name)
 
-    def test_retrieve_location(self) -> None:
+    def test_get_deadline(self) -> None:
         """
-        retrieve_locationのテスト
+        get_deadlineのテスト
         """
-        # 空リスト
-        self.assertEqual(retrieve_location(self.queue_name), [])
+        class DummyContext:
+            @staticmethod
+            def get_remaining_time_in_millis() -> int:
+                return 60 * 1000
+
+        self.assertIsNone(get_deadline(None, 10))
+        now = time.time()
+        self.assertAlmostEqual(get_deadline(DummyContext(), 10), now + 50, delta=1)
+
+    def test_location_writer(self) -> None:
+        """
+        LocationWriterのテスト
+        """
+        deleted = list()
+        writer = LocationWriter('test', self.bucket_name, 'work3/', max_bytes=64 * 1024 * 1024, max_records=10,
+                                part_size=5 * 1024 * 1024, delete_handles=deleted.extend)
+
+        # 15件(うち重複2件)を書き込むと、10件目で一つ目のオブジェクトが区切られる
+        writer.write(self.dummyMessages(self.dummyLocationList()[:12]))
+        self.assertEqual(writer.keys, ['work3/test-0000.csv.gz'])
+        self.assertEqual(len(deleted), 12)
+        writer.write(self.dummyMessages(self.dummyLocationList()[12:]))
+        self.assertEqual(len(deleted), 12)  # 書き込み完了までは削除されない
+        writer.close()
+        self.assertEqual(writer.keys, ['work3/test-0000.csv.gz', 'work3/test-0001.csv.gz'])
+        self.assertEqual(len(deleted), 15)
+        self.assertEqual(writer.total_records, 13)
+
+        body = b''.join([gzip.decompress(self.s3.get_object(Bucket=self.bucket_name, Key=key)['Body'].read())
+                         for key in writer.keys])
+        self.assertEqual(sorted(body.decode('ascii').split('\n')), sorted(self.dummyObjectBody().split('\n')))
+
+        # パートサイズを超える場合はマルチパートアップロードになる。S3への送信とSQSからの削除はロックの外で行う
+        locked = list()
+        writer = LocationWriter('multi', self.bucket_name, 'work3/', max_bytes=64 * 1024 * 1024, max_records=1000000,
+                                part_size=5 * 1024 * 1024,
+                                delete_handles=lambda x: locked.append(writer.lock.locked()) or deleted.extend(x))
+        upload_part = writer.s3.upload_part
+        writer.s3.upload_part = lambda **kwargs: locked.append(writer.lock.locked()) or upload_part(**kwargs)
+        locations = [os.urandom(64).hex() for _ in range(200000)]
+        for i in range(0, len(locations), 10):
+            writer.write(self.dummyMessages(locations[i:i + 10]))
+        self.assertGreater(len(writer.objects['work3/'].parts), 0)
+        writer.close()
+        body = self.s3.get_object(Bucket=self.bucket_name, Key='work3/multi-0000.csv.gz')['Body'].read()
+        self.assertEqual(gzip.decompress(body).decode('ascii'), '\n'.join(locations) + '\n')
+        self.assertGreater(len(locked), 1)
+        self.assertNotIn(True, locked)
+
+        # 複数スレッドから書き込んでも、パートの送信を待ってからオブジェクトを完成させる
+        writer = LocationWriter('threads', self.bucket_name, 'work3/', max_bytes=64 * 1024 * 1024,
+                                max_records=150000, part_size=5 * 1024 * 1024, delete_handles=deleted.extend,
+                                dedup=DedupFilter(len(locations), 0.000001, float('inf')))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda i: writer.write(self.dummyMessages(locations[i:i + 10])),
+                              range(0, len(locations), 10)))
+        writer.close()
+        self.assertEqual(writer.keys, ['work3/threads-0000.csv.gz', 'work3/threads-0001.csv.gz'])
+        body = b''.join([gzip.decompress(self.s3.get_object(Bucket=self.bucket_name, Key=key)['Body'].read())
+                         for key in writer.keys])
+        self.assertEqual(sorted(body.decode('ascii').splitlines()), sorted(locations))
+
+        # バイナリ形式
+        writer = LocationWriter('bin', self.bucket_name, 'work3/', max_bytes=64 * 1024 * 1024, max_records=1000,
+                                part_size=5 * 1024 * 1024, delete_handles=deleted.extend, fmt='bin.gz')
+        writer.write(self.dummyMessages(self.dummyLocationList() + ['invalid,record',
+                                                                    str(uuid.uuid4()) + ',35.7,139.7,1555055157000']))
+        writer.close()
+        self.assertEqual(writer.keys, ['work3/bin-0000.bin.gz'])
+        self.assertEqual(writer.total_records, 13)
+        body = self.s3.get_object(Bucket=self.bucket_name, Key='work3/bin-0000.bin.gz')['Body'].read()
+        self.assertEqual(sorted(decode(body, 'bin.gz').decode('ascii').split('\n')),
+                         sorted(self.dummyObjectBody().split('\n')))
+
+        # 日付(JST)毎の振り分け。タイムスタンプが不正なレコードはprefix直下に書き出す
+        writer = LocationWriter('part', self.bucket_name, 'work3/', max_bytes=64 * 1024 * 1024, max_records=1000,
+                                part_size=5 * 1024 * 1024, delete_handles=deleted.extend, partitioned=True)
+        writer.write(self.dummyMessages([
+            '3313c918-55e4-4d15-879e-000000000000,35.7,135.1,1567263599',  # 2019/8/31 23:59:59(JST)
+            '3313c918-55e4-4d15-879e-000000000001,35.7,135.1,1567263600',  # 2019/9/1 00:00:00(JST)
+            'invalid,record']))
+        writer.close()
+        self.assertEqual(sorted(writer.keys), ['work3/created_date=20190831/part-0000.csv.gz',
+                                               'work3/created_date=20190901/part-0000.csv.gz',
+                                               'work3/part-0000.csv.gz'])
+        body = self.s3.get_object(Bucket=self.bucket_name,
+                                  Key='work3/created_date=20190901/part-0000.csv.gz')['Body'].read()
+        self.assertEqual(gzip.decompress(body), b'3313c918-55e4-4d15-879e-000000000001,35.7,135.1,1567263600\n')
+
+        for key in ['work3/test-0000.csv.gz', 'work3/test-0001.csv.gz', 'work3/multi-0000.csv.gz',
+                    'work3/threads-0000.csv.gz', 'work3/threads-0001.csv.gz', 'work3/bin-0000.bin.gz'] + writer.keys:
+            self.s3.delete_object(Bucket=self.bucket_name, Key=key)
+
+    def test_retrieve_location_parallel(self) -> None:
+        """
+        retrieve_location_parallelのテスト
+        """
+        deleted = list()
+        writer = LocationWriter('parallel', self.bucket_name, 'work4/', max_bytes=64 * 1024 * 1024, max_records=1000,
+                                part_size=5 * 1024 * 1024, delete_handles=deleted.extend)
+
+        # 空のキュー
+        retrieve_location_parallel(self.queue_name, 4, None, 0, None, writer)
+        self.assertEqual(writer.records, 0)
 
         # ダミーデータ
         for location in self.dummyLocationList():
             self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=location)
 
-        # キューへの投入順序は保証されないのでsetで比較する
-        self.assertEqual(set(retrieve_location(self.queue_name)), set(self.dummyLocationList()))
+        # 打ち切り時刻を過ぎている場合は取り出さない
+        retrieve_location_parallel(self.queue_name, 4, time.time() - 1, 0, None, writer)
+        self.assertEqual(writer.records, 0)
 
-        # すべて取得した後なので空になっているはず
-        self.assertEqual(retrieve_location(self.queue_name), [])
+        # 重複は取り除かれている
+        retrieve_location_parallel(self.queue_name, 4, None, 0, 60, writer)
+        self.assertEqual(writer.records, len(set(self.dummyLocationList())))
+        writer.close()
+        self.assertEqual(len(deleted), len(self.dummyLocationList()))
 
-    def test_write_location(self) -> None:
-        """
-        write_locationのテスト
-        """
-        # ダミーデータの書き込み
-        file_name = 'test.csv'
-        folder = 'work/'
-        write_location(file_name, sorted(list(set(self.dummyLocationList()))), bucket=self.bucket_name, prefix=folder)
+        body = self.s3.get_object(Bucket=self.bucket_name, Key='work4/parallel-0000.csv.gz')['Body'].read()
+        self.assertEqual(sorted(gzip.decompress(body).decode('ascii').split('\n')),
+                         sorted(self.dummyObjectBody().split('\n')))
+        self.s3.delete_object(Bucket=self.bucket_name, Key='work4/parallel-0000.csv.gz')
 
-        result = self.s3.get_object(Bucket=self.bucket_name, Key=folder + file_name)
-        body = result['Body'].read()
-        self.maxDiff = None
-        self.assertEqual(body.decode('ascii'), self.dummyObjectBody())
+        # 書き込み後に削除しているので、キューは空になっている
+        self.assertNotIn('Messages', self.sqs.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=10))
 
     def test_lambda_handler(self) -> None:
         """
@@ -110,15 +216,20 @@ class TestStoreRequest(unittest.TestCase):
         self.assertIn('Contents', list_object)
         self.assertEqual(len(list_object['Contents']), 1)
         key = list_object['Contents'][0]['Key']
+        self.assertTrue(key.startswith('work/created_date=20190412/'))  # 日付(JST)毎に振り分けられている
 
         get_object = self.s3.get_object(Bucket=self.bucket_name, Key=key)
         self.assertIn('Body', get_object)
-        body = get_object['Body'].read()
+        body = gzip.decompress(get_object['Body'].read())
 
         self.assertEqual(sorted(body.decode('ascii').split('\n')), sorted(self.dummyObjectBody().split('\n')))
 
         self.s3.delete_object(Bucket=self.bucket_name, Key=key)
 
+        # 重複判定用のフィルタが保存されている
+        list_object = self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix='dedup/')
+        self.assertEqual([x['Key'] for x in list_object['Contents']], ['dedup/filter.bin'])
+
         # 環境変数戻す
         for k in envs.keys():
             if old_values[k] is None:
@@ -154,6 +265,24 @@ class TestStoreRequest(unittest.TestCase):
             'cf5bff5c-2ffe-4f18-9593-bc666313f809,35.744947,139.720168,1555055100'
         ]
 
+    @staticmethod
+    def dummyMessages(locations: List[str]) -> List[Dict[str, str]]:
+        """
+        receive_messageの結果の形式のダミーメッセージ
+
+        Parameters
+        ----------
+        locations: List[str]
+            メッセージ本文のリスト
+
+        Returns
+        -------
+        List[Dict[str, str]]
+        """
+        return [{'ReceiptHandle': 'handle' + str(i) + location,
+                 'MD5OfBody': hashlib.md5(location.encode('ascii')).hexdigest(),
+                 'Body': location} for i, location in enumerate(locations)]
+
     @staticmethod
     def dummyObjectBody() -> str:
         """
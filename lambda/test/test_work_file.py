@@ -0,0 +1,87 @@
+# coding=utf-8
+
+"""
+work_file用テストファイル
+"""
+
+import unittest
+import io
+
+import sys
+sys.path.append('..')
+from work_file import parse_format, get_format, get_date_str, get_partition_prefix, get_partition_date, \
+    encode_record, decode_records, create_compressor, iter_lines, decode, RECORD
+
+
+class TestWorkFile(unittest.TestCase):
+    """
+    TestModule for work_file
+    """
+    FORMATS = ['csv', 'csv.gz', 'csv.zst', 'bin', 'bin.gz', 'bin.zst']
+
+    def test_parse_format(self) -> None:
+        """
+        parse_formatのテスト
+        """
+        self.assertEqual(parse_format('csv'), ('csv', ''))
+        self.assertEqual(parse_format('csv.gz'), ('csv', 'gz'))
+        self.assertEqual(parse_format('bin.zst'), ('bin', 'zst'))
+        self.assertRaises(ValueError, parse_format, 'txt')
+        self.assertRaises(ValueError, parse_format, 'csv.bz2')
+
+    def test_get_format(self) -> None:
+        """
+        get_formatのテスト
+        """
+        self.assertEqual(get_format('work/1566624557.csv'), 'csv')
+        self.assertEqual(get_format('work/1566624557-0000.csv.gz'), 'csv.gz')
+        self.assertEqual(get_format('work/1566624557-0000.bin.zst'), 'bin.zst')
+        self.assertEqual(get_format('work.bin/1566624557.csv'), 'csv')
+        self.assertRaises(ValueError, get_format, 'work/1566624557.txt')
+
+    def test_partition(self) -> None:
+        """
+        get_date_str, get_partition_prefix, get_partition_dateのテスト
+        """
+        self.assertEqual(get_date_str(1567263599), '20190831')  # 2019/8/31 23:59:59(JST)
+        self.assertEqual(get_date_str(1567263600), '20190901')  # 2019/9/1 00:00:00(JST)
+        self.assertEqual(get_partition_prefix('work/', '20190901'), 'work/created_date=20190901/')
+        self.assertEqual(get_partition_date('work/created_date=20190901/1566624557-0000.csv.gz'), '20190901')
+        self.assertIsNone(get_partition_date('work/1566624557.csv'))
+        self.assertIsNone(get_partition_date('work/created_date=20190901'))
+
+    def test_encode_record(self) -> None:
+        """
+        encode_record, decode_recordsのテスト
+        """
+        line = b'cf5bff5c-2ffe-4f18-9593-bc666313f8c5,35.744947,-139.720168,1555055157\n'
+        self.assertEqual(encode_record(line, 'csv.gz'), line)
+
+        record = encode_record(line, 'bin')
+        self.assertEqual(len(record), RECORD.size)
+        self.assertEqual(decode_records(record * 2), line * 2)
+
+        self.assertRaises(ValueError, encode_record, b'cf5bff5c-2ffe-4f18-9593-bc666313f8c5,35.7,139.7\n', 'bin')
+        self.assertRaises(ValueError, encode_record, b'x,35.7,139.7,1555055157\n', 'bin')
+        self.assertRaises(ValueError, encode_record, b'cf5bff5c-2ffe-4f18-9593-bc666313f8c5,x,139.7,1\n', 'bin')
+        # int32に収まらないタイムスタンプ (ミリ秒単位など)
+        self.assertRaises(ValueError, encode_record, b'cf5bff5c-2ffe-4f18-9593-bc666313f8c5,35.7,139.7,2147483648\n',
+                          'bin')
+        self.assertRaises(ValueError, encode_record, b'cf5bff5c-2ffe-4f18-9593-bc666313f8c5,35.7,139.7,1555055157000\n',
+                          'bin')
+        self.assertEqual(len(encode_record(b'cf5bff5c-2ffe-4f18-9593-bc666313f8c5,35.7,139.7,2147483647\n', 'bin')),
+                         RECORD.size)
+
+    def test_iter_lines_and_decode(self) -> None:
+        """
+        create_compressor, iter_lines, decodeのテスト
+        """
+        lines = [bytes('cf5bff5c-2ffe-4f18-9593-bc666313f8c5,{},139.7,{}\n'.format(35.7 + i / 10000, 1555055157 + i),
+                       'ascii') for i in range(1000)]
+        for fmt in self.FORMATS:
+            compressor = create_compressor(fmt)
+            data = b''.join([compressor.compress(encode_record(line, fmt)) for line in lines]) + compressor.flush()
+            self.assertEqual(list(iter_lines(io.BytesIO(data), fmt)), lines, fmt)
+            self.assertEqual(decode(data, fmt), b''.join(lines), fmt)
+
+        self.assertRaises(ValueError, decode, b'x' * (RECORD.size + 1), 'bin')
@@ -0,0 +1,346 @@
+# coding=utf-8
+
+"""
+store_request, retrieve_request共通で使用する、作業用フォルダ(s3://.../work)のオブジェクト形式
+形式はオブジェクトのキーの拡張子で判別する
+store_requestは、レコードのタイムスタンプの日付(JST)毎に"work/created_date=YYYYMMDD/"以下に振り分けて書き出す
+
+  .csv / .csv.gz / .csv.zst    "ユーザID,緯度,経度,タイムスタンプ\\n"のテキスト (無圧縮 / gzip / zstd)
+  .bin / .bin.gz / .bin.zst    1レコード36バイトの固定長バイナリ (無圧縮 / gzip / zstd)
+                               UUID(16バイト), 緯度(float64), 経度(float64), タイムスタンプ(int32) のリトルエンディアン
+
+zstdを使用する場合は、zstandardパッケージが必要
+"""
+
+import gzip
+import io
+import struct
+import time
+import uuid
+import zlib
+from typing import Any, BinaryIO, Iterator, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:  # zstdを使用しない環境
+    zstandard = None
+
+ENCODING_CSV = 'csv'
+ENCODING_BINARY = 'bin'
+COMPRESSION_NONE = ''
+COMPRESSION_GZIP = 'gz'
+COMPRESSION_ZSTD = 'zst'
+
+DEFAULT_FORMAT = 'csv.gz'
+
+RECORD = struct.Struct('<16sddi')  # UUID, 緯度, 経度, タイムスタンプ
+READ_RECORDS = 65536                # バイナリ形式を読み込むときに一度に読むレコード数
+INT32_MIN, INT32_MAX = -2 ** 31, 2 ** 31 - 1  # バイナリ形式で扱えるタイムスタンプの範囲
+
+PARTITION_PREFIX = 'created_date='  # 日付毎に振り分けたフォルダの名前
+tz = 9 * 3600                       # JST
+
+
+def get_base_time(t: int) -> int:
+    """
+    その日の0:00(JST)を求める
+
+    Parameters
+    ----------
+    t: int
+        UNIX時間
+
+    Returns
+    -------
+    int
+        その日の0:00のUNIX時間
+    """
+    return (t + tz) - (t + tz) % (24 * 3600) - tz
+
+
+def get_date_str(t: int) -> str:
+    """
+    日付の文字列(YYYYMMDD)を求める
+
+    Parameters
+    ----------
+    t: int
+        UNIX時間
+
+    Returns
+    -------
+    str
+        日付の文字列(JST)
+    """
+    return time.strftime('%Y%m%d', time.gmtime(t + tz))
+
+
+def get_partition_prefix(prefix: str, date_str: str) -> str:
+    """
+    日付毎に振り分けたフォルダのprefixを求める
+
+    Parameters
+    ----------
+    prefix: str
+        作業用フォルダのprefix (例: 'work/')
+    date_str: str
+        日付の文字列(YYYYMMDD)
+
+    Returns
+    -------
+    str
+        フォルダのprefix (例: 'work/created_date=20190901/')
+    """
+    return prefix + PARTITION_PREFIX + date_str + '/'
+
+
+def get_partition_date(key: str) -> Optional[str]:
+    """
+    オブジェクトのキーから、振り分けられた日付を取得する
+
+    Parameters
+    ----------
+    key: str
+        オブジェクトのキー (例: 'work/created_date=20190901/1566624557-0000.csv.gz')
+
+    Returns
+    -------
+    Optional[str]
+        日付の文字列(YYYYMMDD)。振り分けられていないオブジェクトの場合はNone
+    """
+    for name in key.split('/')[:-1]:
+        if name.startswith(PARTITION_PREFIX):
+            return name[len(PARTITION_PREFIX):]
+    return None
+
+
+def parse_format(fmt: str) -> Tuple[str, str]:
+    """
+    形式名(拡張子)をレコード形式と圧縮形式に分解する
+
+    Parameters
+    ----------
+    fmt: str
+        形式名。"csv", "csv.gz", "bin.zst"など
+
+    Returns
+    -------
+    str, str
+        レコード形式(ENCODING_*), 圧縮形式(COMPRESSION_*)
+
+    Raises
+    ------
+    ValueError
+        未知の形式
+    """
+    encoding, _, compression = fmt.partition('.')
+    if encoding not in (ENCODING_CSV, ENCODING_BINARY) \
+            or compression not in (COMPRESSION_NONE, COMPRESSION_GZIP, COMPRESSION_ZSTD):
+        raise ValueError('unknown format: ' + fmt)
+    if compression == COMPRESSION_ZSTD and zstandard is None:
+        raise ValueError('zstandard is not installed')
+    return encoding, compression
+
+
+def get_format(key: str) -> str:
+    """
+    オブジェクトのキーの拡張子から形式名を取得する
+
+    Parameters
+    ----------
+    key: str
+        オブジェクトのキー (例: 'work/1566624557-0000.csv.gz')
+
+    Returns
+    -------
+    str
+        形式名 (例: 'csv.gz')
+
+    Raises
+    ------
+    ValueError
+        未知の形式
+    """
+    name = key.rsplit('/', 1)[-1]
+    for encoding in (ENCODING_CSV, ENCODING_BINARY):
+        for compression in (COMPRESSION_NONE, COMPRESSION_GZIP, COMPRESSION_ZSTD):
+            fmt = encoding + ('.' + compression if compression else '')
+            if name.endswith('.' + fmt):
+                return fmt
+    raise ValueError('unknown format: ' + key)
+
+
+def encode_record(line: bytes, fmt: str) -> bytes:
+    """
+    "ユーザID,緯度,経度,タイムスタンプ\\n"の1行を、指定された形式のレコードに変換する (圧縮はしない)
+
+    Parameters
+    ----------
+    line: bytes
+        レコード1行のbyte列 (改行付き)
+    fmt: str
+        形式名
+
+    Returns
+    -------
+    bytes
+        変換後のレコード
+
+    Raises
+    ------
+    ValueError
+        バイナリ形式に変換できない不正な行
+    """
+    if parse_format(fmt)[0] == ENCODING_CSV:
+        return line
+    fields = line.strip().split(b',')
+    if len(fields) != 4:
+        raise ValueError('invalid record')
+    timestamp = int(fields[3])
+    if not INT32_MIN <= timestamp <= INT32_MAX:  # RECORD.packはstruct.errorになるため、ここで判定する
+        raise ValueError('timestamp out of range')
+    return RECORD.pack(uuid.UUID(fields[0].decode('ascii')).bytes, float(fields[1]), float(fields[2]), timestamp)
+
+
+def decode_records(data: bytes) -> bytes:
+    """
+    バイナリ形式のレコード列を"ユーザID,緯度,経度,タイムスタンプ\\n"のテキストに変換する
+
+    Parameters
+    ----------
+    data: bytes
+        バイナリ形式のレコード列 (RECORD.sizeの倍数)
+
+    Returns
+    -------
+    bytes
+        テキスト形式のレコード列
+    """
+    lines = list()
+    for user_id, latitude, longitude, timestamp in RECORD.iter_unpack(data):
+        h = user_id.hex()
+        lines.append('{0}-{1}-{2}-{3}-{4},{5!r},{6!r},{7}\n'.format(
+            h[:8], h[8:12], h[12:16], h[16:20], h[20:], latitude, longitude, timestamp))
+    return bytes(''.join(lines), 'ascii')
+
+
+def create_compressor(fmt: str) -> Any:
+    """
+    指定された形式の圧縮用オブジェクトを作成する
+    compress(bytes) -> bytes, flush() -> bytes を持つ
+
+    Parameters
+    ----------
+    fmt: str
+        形式名
+
+    Returns
+    -------
+    Any
+        圧縮用オブジェクト
+    """
+    compression = parse_format(fmt)[1]
+    if compression == COMPRESSION_GZIP:
+        return zlib.compressobj(wbits=31)  # gzip形式
+    if compression == COMPRESSION_ZSTD:
+        return zstandard.ZstdCompressor().compressobj()
+    return NoCompressor()
+
+
+class NoCompressor:
+    """
+    無圧縮の場合に使用する、入力をそのまま返す圧縮用オブジェクト
+    """
+
+    @staticmethod
+    def compress(data: bytes) -> bytes:
+        return data
+
+    @staticmethod
+    def flush() -> bytes:
+        return b''
+
+
+def open_decompressed(fd: BinaryIO, fmt: str) -> BinaryIO:
+    """
+    圧縮されたストリームを展開しながら読み込むストリームを返す
+
+    Parameters
+    ----------
+    fd: BinaryIO
+        オブジェクトの内容を読み込むストリーム
+    fmt: str
+        形式名
+
+    Returns
+    -------
+    BinaryIO
+        展開後の内容を読み込むストリーム
+    """
+    compression = parse_format(fmt)[1]
+    if compression == COMPRESSION_GZIP:
+        return gzip.GzipFile(fileobj=fd, mode='rb')
+    if compression == COMPRESSION_ZSTD:
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(fd))
+    return fd
+
+
+def iter_lines(fd: BinaryIO, fmt: str) -> Iterator[bytes]:
+    """
+    オブジェクトの内容を"ユーザID,緯度,経度,タイムスタンプ\\n"の行単位で読み込む
+
+    Parameters
+    ----------
+    fd: BinaryIO
+        オブジェクトの内容を読み込むストリーム (圧縮されたまま)
+    fmt: str
+        形式名
+
+    Returns
+    -------
+    Iterator[bytes]
+        レコード1行のbyte列
+    """
+    stream = open_decompressed(fd, fmt)
+    if parse_format(fmt)[0] == ENCODING_CSV:
+        yield from stream
+        return
+
+    while True:
+        data = stream.read(RECORD.size * READ_RECORDS)
+        if len(data) == 0:
+            break
+        while len(data) % RECORD.size != 0:  # 途中で区切られた場合は続きを読む
+            rest = stream.read(RECORD.size - len(data) % RECORD.size)
+            if len(rest) == 0:
+                raise ValueError('truncated record')
+            data += rest
+        yield from io.BytesIO(decode_records(data))
+
+
+def decode(data: bytes, fmt: str) -> bytes:
+    """
+    オブジェクトの内容全体を"ユーザID,緯度,経度,タイムスタンプ\\n"のテキストに変換する
+
+    Parameters
+    ----------
+    data: bytes
+        オブジェクトの内容 (圧縮されたまま)
+    fmt: str
+        形式名
+
+    Returns
+    -------
+    bytes
+        テキスト形式のレコード列
+    """
+    encoding, compression = parse_format(fmt)
+    if compression == COMPRESSION_GZIP:
+        data = gzip.decompress(data)
+    elif compression == COMPRESSION_ZSTD:
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if encoding == ENCODING_BINARY:
+        if len(data) % RECORD.size != 0:
+            raise ValueError('truncated record')
+        data = decode_records(data)
+    return data
@@ -15,6 +15,7 @@ create external table spectrum.location_original(
     location 's3://me32as8cme32as8c-task3-location/work/';
 
 --  分割後
+--  retrieve_requestは登録済みのpartitionをPARTITION_CACHE_FILEに記録するので、テーブルを作り直した場合はそのファイルも削除する
 create external table spectrum.location(
     user_id char(36),
     latitude double precision,
@@ -26,3 +27,15 @@ create external table spectrum.location(
     stored as textfile
     location 's3://me32as8cme32as8c-task3-location/parted/';
 
+
+--  分割後 (Parquet形式)
+--  retrieve_requestをOUTPUT_FORMAT=parquetで実行する (FOLDER_PARTED=parted_parquet/, TABLE_LOCATION=spectrum.location_parquetが既定値となる)
+create external table spectrum.location_parquet(
+    user_id varchar(36),
+    latitude double precision,
+    longitude double precision,
+    created_at integer
+    )
+    partitioned by (created_date char(8))
+    stored as parquet
+    location 's3://me32as8cme32as8c-task3-location/parted_parquet/';
@@ -19,20 +19,82 @@ import gzip
 import os
 import psycopg2
 import psycopg2.extensions
-from typing import BinaryIO
+import psycopg2.pool
+import botocore.exceptions
+import io
+import hashlib
+import json
+import uuid
+import shutil
+import zlib
+import collections
+import concurrent.futures
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
 from get_connection_string import get_connection_string
+import retrieve_request
+from retrieve_request import MultipartUpload
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 DEFAULT_BUCKET_DOWNLOAD = 'me32as8cme32as8c-task3-download'
-DEFAULT_TABLE_LOCATION = 'spectrum.location'
+DEFAULT_FETCH_SIZE = '10000'                             # サーバサイドカーソルで一度に取得するレコード数 (0なら一度に全件取得する)
+DEFAULT_EXPORT_ENGINE = 'cursor'                         # 書き出し方法 (EXPORT_ENGINES参照)
+DEFAULT_UNLOAD_IAM_ROLE = 'arn:aws:iam::026845558380:role/redshift-role'  # UNLOADでS3に書き込むためのIAMロール
+DEFAULT_UNLOAD_PREFIX = '_unload/'                       # UNLOADの書き出し先 (ダウンロード用バケット内)
+DEFAULT_UNLOAD_PARALLEL = '0'                            # UNLOADをスライス毎に並列に書き出すかどうか (書き出した後に連結する)
+DEFAULT_BUCKET_LOCATION = 'me32as8cme32as8c-task3-location'  # EXPORT_ENGINE=s3の場合に読み込むバケット
+DEFAULT_EXPORT_WORKERS = '8'                             # EXPORT_ENGINE=s3の場合に、並列に変換するオブジェクト数
+DEFAULT_UPLOAD_PART_SIZE = str(8 * 1024 * 1024)          # EXPORT_ENGINE=s3の場合の、マルチパートアップロードの一パートのサイズ
+DEFAULT_COLLECT_WORKERS = '4'                            # 複数日を書き出す場合に、同時に処理する日数 (Redshiftへの接続数)
+DEFAULT_SEGMENT_SIZE = '0'                               # 一日分を分割して書き出す場合の、一つのファイルのサイズ(圧縮後)の目安 (0なら分割しない)
+DEFAULT_COMPRESS_LEVEL = '6'                             # EXPORT_ENGINE=s3の場合の、gzipの圧縮レベル (1なら速度優先)
+DEFAULT_SEGMENT_GRACE_SECONDS = '600'                    # 置き換えたセグメントを残す期間(秒)。get_location_listのCACHE_TTL+URL_EXPIRES以上
+
+EXPORT_ENGINE_CURSOR = 'cursor'   # カーソルで全レコードを取得し、pythonで書き出す (従来の方法)
+EXPORT_ENGINE_UNLOAD = 'unload'   # RedshiftのUNLOADでS3に直接書き出す
+EXPORT_ENGINE_S3 = 's3'           # Redshiftを使わず、S3格納用フォルダのオブジェクトを直接変換して書き出す
+EXPORT_ENGINES = (EXPORT_ENGINE_CURSOR, EXPORT_ENGINE_UNLOAD, EXPORT_ENGINE_S3)
+ROW_FORMAT = '%s,%s,%s,%s\r\n'   # カーソルで取得した1レコードの書式
+MIN_PART_SIZE = 5 * 1024 * 1024   # マルチパートアップロードの最後以外のパートの最小サイズ
+READ_SIZE = 1024 * 1024           # S3格納用フォルダのオブジェクトを展開しながら読み込む単位
+READ_ROWS = 65536                 # S3格納用フォルダのParquetを変換する単位(行数)
+TAG_RECORDS = 'records'           # 書き出したオブジェクトのタグ (レコード数)
+TAG_SOURCE = 'source'             # 書き出したオブジェクトのタグ (EXPORT_ENGINE=s3の場合の、元のオブジェクトの一覧のハッシュ値)
+MANIFEST_SUFFIX = '.manifest.json'  # 分割して書き出した場合のマニフェスト ("YYYYMMDD.manifest.json")
+STATUS_EXPORTED = 'exported'
+STATUS_SKIPPED = 'skipped'
+STATUS_ERROR = 'error'
+
+# 1レコードを"ユーザID,緯度,経度,タイムスタンプ\r\n"の1列にする。UNLOADは行末に"\n"を付けるので、"\r"だけを付ける
+# NULLはカーソルで取得した場合(str(None))と同じく"None"とする
+UNLOAD_COLUMNS = ' || \',\' || '.join(['nvl(cast({} as varchar), \'None\')'.format(x)
+                                      for x in ['user_id', 'latitude', 'longitude', 'created_at']]) + ' || chr(13)'
 
 s3 = boto3.client('s3')
 tz = 9 * 60 * 60   # JST(+9:00)
 
 
-def select_and_write_location(ymd: str, result_file: BinaryIO, table: str) -> int:
+def encode_rows(rows: List[tuple]) -> bytes:
+    """
+    レコードをまとめて"ユーザID,緯度,経度,タイムスタンプ\\r\\n"のテキストに変換する
+    1レコード毎に','.join([str(x) for x in row])としていた場合と同じ結果になる ('%s'はstr()と同じ)
+
+    Parameters
+    ----------
+    rows: List[tuple]
+        (ユーザID, 緯度, 経度, タイムスタンプ)のタプルのリスト
+
+    Returns
+    -------
+    bytes
+        テキスト形式のレコード列
+    """
+    return bytes(''.join([ROW_FORMAT % row for row in rows]), 'ascii')
+
+
+def select_and_write_location(ymd: str, result_file: BinaryIO, table: str, fetch_size: int = 0,
+                              conn: Optional[psycopg2.extensions.connection] = None) -> int:
     """
     Redshiftから該当日のデータを取得し、一時ファイルに書き出す
 
@@ -44,6 +106,11 @@ def select_and_write_location(ymd: str, result_file: BinaryIO, table: str) -> in
         一時ファイルのio
     table: str
         Redshift内のテーブル名
+    fetch_size: int
+        0より大きい場合は、サーバサイドカーソルでfetch_size件ずつ取得して書き出す。
+        0の場合は、全レコードを一度に取得してから書き出す
+    conn: Optional[psycopg2.extensions.connection]
+        Redshiftへの接続オブジェクト。Noneの場合は新たに接続する
 
     Returns
     -------
@@ -51,11 +118,25 @@ def select_and_write_location(ymd: str, result_file: BinaryIO, table: str) -> in
         書き込んだレコード数
     """
     records = 0
-    connection_string = get_connection_string()
-    with psycopg2.connect(connection_string) as conn:
+    query = 'select user_id, latitude, longitude, created_at from {} where created_date=\'{}\''.format(table, ymd)
+    if conn is None:
+        conn = psycopg2.connect(get_connection_string())
+    with conn:
+        if fetch_size > 0:
+            # 名前付きカーソルはサーバ側に結果を保持するので、メモリ使用量はfetch_size件分で済む
+            with conn.cursor(name='collect_location') as cursor:
+                cursor.itersize = fetch_size
+                cursor.execute(query)
+                while True:
+                    rows = cursor.fetchmany(fetch_size)
+                    if len(rows) == 0:
+                        break
+                    result_file.write(encode_rows(rows))
+                    records = records + len(rows)
+            return records
+
         with conn.cursor() as cursor:
-            cursor.execute('select user_id, latitude, longitude, created_at from {} where created_date=\'{}\''
-                           .format(table, ymd))
+            cursor.execute(query)
             for row in cursor:
                 result_file.write(bytes(','.join([str(x) for x in row]) + '\r\n', 'ascii'))
                 records = records + 1
@@ -63,6 +144,893 @@ def select_and_write_location(ymd: str, result_file: BinaryIO, table: str) -> in
     return records
 
 
+def get_unload_query(ymd: str, table: str, bucket: str, prefix: str, iam_role: str, parallel: bool) -> str:
+    """
+    該当日のデータをS3にgzip圧縮して書き出すUNLOAD文を作成する
+
+    Parameters
+    ----------
+    ymd:str
+        該当日となる年月日 (YYYYMMDD)
+    table: str
+        Redshift内のテーブル名
+    bucket: str
+        書き出し先のS3バケット名
+    prefix: str
+        書き出し先のprefix
+    iam_role: str
+        S3に書き込むためのIAMロール
+    parallel: bool
+        スライス毎に並列に書き出すかどうか
+
+    Returns
+    -------
+    str
+        UNLOAD文
+    """
+    query = 'select {0} from {1} where created_date=\'{2}\''.format(UNLOAD_COLUMNS, table, ymd)
+    return ('unload (\'{0}\') to \'s3://{1}/{2}\' iam_role \'{3}\' '
+            'gzip manifest verbose allowoverwrite parallel {4}').format(
+        query.replace('\'', '\'\''), bucket, prefix, iam_role, 'on' if parallel else 'off')
+
+
+def unload_location(ymd: str, table: str, bucket: str, prefix: str, iam_role: str, parallel: bool,
+                    conn: Optional[psycopg2.extensions.connection] = None) -> Tuple[List[str], int]:
+    """
+    Redshiftから該当日のデータをUNLOADでS3に書き出す
+
+    Parameters
+    ----------
+    ymd:str
+        該当日となる年月日 (YYYYMMDD)
+    table: str
+        Redshift内のテーブル名
+    bucket: str
+        書き出し先のS3バケット名
+    prefix: str
+        書き出し先のprefix (例: '_unload/20190901/')
+    iam_role: str
+        S3に書き込むためのIAMロール
+    parallel: bool
+        スライス毎に並列に書き出すかどうか
+    conn: Optional[psycopg2.extensions.connection]
+        Redshiftへの接続オブジェクト。Noneの場合は新たに接続する
+
+    Returns
+    -------
+    List[str], int
+        書き出したオブジェクトのキー, レコード数
+    """
+    if conn is None:
+        conn = psycopg2.connect(get_connection_string())
+    with conn:
+        with conn.cursor() as cursor:
+            cursor.execute(get_unload_query(ymd, table, bucket, prefix, iam_role, parallel))
+
+    # MANIFEST VERBOSEで書き出されたマニフェストから、ファイルの一覧とレコード数を取得する
+    manifest = json.loads(s3.get_object(Bucket=bucket, Key=prefix + 'manifest')['Body'].read())
+    url_prefix = 's3://{}/'.format(bucket)
+    keys = [x['url'][len(url_prefix):] for x in manifest['entries']]
+    records = sum([x['meta']['record_count'] for x in manifest['entries']])
+    return keys, records
+
+
+def merge_unloaded_file(bucket: str, keys: List[str], key: str) -> None:
+    """
+    UNLOADで書き出したオブジェクトを一つのオブジェクトにまとめる
+    gzipのメンバーを連結したものも、一つのgzipファイルとして読み込めるので、展開・再圧縮は行わない
+
+    Parameters
+    ----------
+    bucket: str
+        オブジェクトが格納されているバケット名
+    keys: List[str]
+        UNLOADで書き出したオブジェクトのキー
+    key: str
+        まとめたオブジェクトのキー
+    """
+    if len(keys) == 1:
+        s3.copy({'Bucket': bucket, 'Key': keys[0]}, bucket, key)
+        return
+
+    sizes = [s3.head_object(Bucket=bucket, Key=x)['ContentLength'] for x in keys]
+    if any([x < MIN_PART_SIZE for x in sizes[:-1]]):
+        # 小さなオブジェクトはパートにできないので、一時ファイルに連結してからアップロードする
+        with tempfile.TemporaryFile() as ftemp:
+            for x in keys:  # download_fileobjは書き込み位置を指定するので、連結には使えない
+                shutil.copyfileobj(s3.get_object(Bucket=bucket, Key=x)['Body'], ftemp)
+            ftemp.seek(0)
+            s3.upload_fileobj(Fileobj=ftemp, Bucket=bucket, Key=key)
+        return
+
+    # S3内でコピーしてパートとする
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+    try:
+        parts = []
+        for i, x in enumerate(keys):
+            response = s3.upload_part_copy(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=i + 1,
+                                           CopySource={'Bucket': bucket, 'Key': x})
+            parts.append({'ETag': response['CopyPartResult']['ETag'], 'PartNumber': i + 1})
+        s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+    except Exception:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+
+def unload_and_write_location(ymd: str, table: str, bucket: str, prefix: str, iam_role: str, parallel: bool,
+                              conn: Optional[psycopg2.extensions.connection] = None) -> int:
+    """
+    Redshiftから該当日のデータをUNLOADでS3に書き出し、"YYYYMMDD.csv.gz"にまとめる
+    pythonでは1レコードも扱わない
+
+    Parameters
+    ----------
+    ymd:str
+        該当日となる年月日 (YYYYMMDD)
+    table: str
+        Redshift内のテーブル名
+    bucket: str
+        ダウンロード用のS3バケット名
+    prefix: str
+        UNLOADの書き出し先のprefix (この下に日付毎のフォルダを作成する)
+    iam_role: str
+        S3に書き込むためのIAMロール
+    parallel: bool
+        スライス毎に並列に書き出すかどうか
+    conn: Optional[psycopg2.extensions.connection]
+        Redshiftへの接続オブジェクト。Noneの場合は新たに接続する
+
+    Returns
+    -------
+    int
+        書き込んだレコード数
+    """
+    unload_prefix = prefix + ymd + '/'
+    keys, records = unload_location(ymd, table, bucket, unload_prefix, iam_role, parallel, conn)
+    try:
+        # 空ファイルで無ければ、まとめて"YYYYMMDD.csv.gz"とする
+        if records > 0:
+            merge_unloaded_file(bucket, sorted(keys), ymd + '.csv.gz')
+    finally:
+        s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': x} for x in keys + [unload_prefix + 'manifest']],
+                                                 'Quiet': True})
+
+    return records
+
+
+class SegmentWriter:
+    """
+    一日分のデータを、それぞれが単独で展開できる複数のgzipファイル(セグメント)に分割して書き出す書き込み先
+    圧縮後のサイズがsegment_sizeを超えたところで、レコードの区切りでセグメントを区切ってアップロードする
+
+      YYYYMMDD/<実行ID>/part-0000.csv.gz, part-0001.csv.gz, ...   セグメント
+      YYYYMMDD.manifest.json                                      マニフェスト (最後に書き出す)
+
+    マニフェストは {"ymd": 年月日, "records": レコード数, "size": 合計サイズ,
+                    "segments": [{"key": キー, "size": サイズ, "records": レコード数, "md5": MD5(16進文字列)}],
+                    "expired": [{"key": キー, "delete_after": 削除してよい時刻(unix時間)}]}
+    実行毎に異なるprefixに書き出し、マニフェストを置き換えてから前回のセグメントを削除するので、
+    マニフェストが参照するセグメントは常に揃っている
+    ただし、get_location_listがキャッシュした署名付きURLから参照され続けるので、前回のセグメントはすぐには削除せず
+    "expired"に記録しておき、grace秒を過ぎたものを以降の書き出し時に削除する
+    """
+
+    def __init__(self, bucket: str, ymd: str, segment_size: int, level: int = 6,
+                 grace: int = int(DEFAULT_SEGMENT_GRACE_SECONDS)) -> None:
+        """
+        Parameters
+        ----------
+        bucket: str
+            ダウンロード用のS3バケット名
+        ymd: str
+            該当日となる年月日 (YYYYMMDD)
+        segment_size: int
+            一つのセグメントのサイズ(圧縮後)の目安
+        level: int
+            gzipの圧縮レベル
+        grace: int
+            置き換えた前回のセグメントを、削除せずに残す期間(秒)
+        """
+        self.bucket = bucket
+        self.ymd = ymd
+        self.segment_size = segment_size
+        self.level = level
+        self.grace = grace
+        self.prefix = '{0}/{1}-{2}/'.format(ymd, int(time.time()), uuid.uuid4().hex[:8])
+        self.segments = list()
+        self.compressor = None
+        self.chunks = list()
+        self.size = 0
+        self.records = 0
+
+    def write(self, data: bytes) -> int:
+        """
+        "...\\r\\n"で終わる、1レコード以上のテキストを書き込む
+
+        Parameters
+        ----------
+        data: bytes
+            書き込むテキスト
+
+        Returns
+        -------
+        int
+            書き込んだバイト数
+        """
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(self.level, wbits=31)  # gzip形式
+        self._append(self.compressor.compress(data), data.count(b'\n'))
+        return len(data)
+
+    def write_member(self, member: bytes, records: int) -> None:
+        """
+        圧縮済みのgzipのメンバーを書き込む
+        追加するとsegment_sizeを超える場合は、先に現在のセグメントをアップロードする
+        (メンバーは分割できないので、segment_sizeを超えるメンバーはそれだけで一つのセグメントとなる)
+
+        Parameters
+        ----------
+        member: bytes
+            gzipのメンバー ("...\\r\\n"で終わるテキストを圧縮したもの)
+        records: int
+            メンバーに含まれるレコード数
+        """
+        self._flush_compressor()
+        if self.records > 0 and self.size + len(member) > self.segment_size:
+            self._upload_segment()
+        self._append(member, records)
+
+    def _append(self, data: bytes, records: int) -> None:
+        """
+        圧縮済みのデータを現在のセグメントに追加し、サイズを超えたらアップロードする
+        """
+        self.chunks.append(data)
+        self.size += len(data)
+        self.records += records
+        if self.size >= self.segment_size:
+            self._upload_segment()
+
+    def _flush_compressor(self) -> None:
+        """
+        圧縮中のデータがあれば、gzipのメンバーとして完成させる
+        """
+        if self.compressor is not None:
+            data = self.compressor.flush()
+            self.chunks.append(data)
+            self.size += len(data)
+            self.compressor = None
+
+    def _upload_segment(self) -> None:
+        """
+        現在のセグメントをアップロードする
+        """
+        self._flush_compressor()
+        if self.records == 0:
+            return
+        body = b''.join(self.chunks)
+        key = '{0}part-{1:04d}.csv.gz'.format(self.prefix, len(self.segments))
+        s3.put_object(Bucket=self.bucket, Key=key, Body=body)
+        self.segments.append({'key': key, 'size': len(body), 'records': self.records,
+                              'md5': hashlib.md5(body).hexdigest()})
+        self.chunks = list()
+        self.size = 0
+        self.records = 0
+
+    def close(self) -> int:
+        """
+        残りのセグメントとマニフェストを書き出し、前回までに置き換えたセグメントのうちgrace秒を過ぎたものを削除する
+        1レコードも無い場合は何も書き出さない
+
+        Returns
+        -------
+        int
+            書き込んだレコード数
+        """
+        self._upload_segment()
+        records = sum([x['records'] for x in self.segments])
+        if records == 0:
+            return 0
+
+        manifest_key = self.ymd + MANIFEST_SUFFIX
+        previous = get_manifest(self.bucket, manifest_key)
+        now = time.time()
+        expired = list()
+        if previous is not None:
+            current = set([x['key'] for x in self.segments])
+            expired = [x for x in previous.get('expired', []) if x['key'] not in current]
+            expired += [{'key': x['key'], 'delete_after': int(now) + self.grace} for x in previous['segments']
+                        if x['key'] not in current]
+        manifest = {'ymd': self.ymd, 'records': records, 'size': sum([x['size'] for x in self.segments]),
+                    'segments': self.segments, 'expired': [x for x in expired if x['delete_after'] > now]}
+        s3.put_object(Bucket=self.bucket, Key=manifest_key, Body=bytes(json.dumps(manifest), 'utf-8'),
+                      ContentType='application/json')
+        old_keys = [x['key'] for x in expired if x['delete_after'] <= now]
+        if len(old_keys) > 0:
+            s3.delete_objects(Bucket=self.bucket, Delete={'Objects': [{'Key': x} for x in old_keys],
+                                                          'Quiet': True})
+        return records
+
+    def abort(self) -> None:
+        """
+        書き込みを中止し、アップロード済みのセグメントを削除する
+        """
+        if len(self.segments) > 0:
+            s3.delete_objects(Bucket=self.bucket, Delete={'Objects': [{'Key': x['key']} for x in self.segments],
+                                                          'Quiet': True})
+        self.segments = list()
+        self.chunks = list()
+        self.compressor = None
+
+
+def get_manifest(bucket: str, key: str) -> Optional[Dict[str, Any]]:
+    """
+    分割して書き出したときのマニフェストを読み込む
+
+    Parameters
+    ----------
+    bucket: str
+        ダウンロード用のS3バケット名
+    key: str
+        マニフェストのキー ("YYYYMMDD.manifest.json")
+
+    Returns
+    -------
+    Optional[Dict[str, Any]]
+        マニフェスト。存在しない場合はNone
+    """
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        return None
+
+
+def remove_stale_output(bucket: str, ymd: str, segmented: bool) -> None:
+    """
+    書き出した形式と異なる、以前の書き出し結果を削除する
+    SEGMENT_SIZEを変更した後も、get_location_listが以前の結果(マニフェストを優先する)を返さないようにする
+
+    Parameters
+    ----------
+    bucket: str
+        ダウンロード用のS3バケット名
+    ymd: str
+        該当日となる年月日 (YYYYMMDD)
+    segmented: bool
+        今回の書き出しでセグメントに分割したかどうか
+    """
+    if segmented:
+        s3.delete_object(Bucket=bucket, Key=ymd + '.csv.gz')
+        return
+
+    # マニフェストを先に削除して参照されなくしてから、セグメントを削除する (削除を待っていたものも含む)
+    manifest = get_manifest(bucket, ymd + MANIFEST_SUFFIX)
+    if manifest is None:
+        return
+    s3.delete_object(Bucket=bucket, Key=ymd + MANIFEST_SUFFIX)
+    keys = [x['key'] for x in manifest['segments'] + manifest.get('expired', [])]
+    if len(keys) > 0:
+        s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': x} for x in keys], 'Quiet': True})
+
+
+def list_parted_object(bucket: str, prefix: str) -> List[Dict[str, Any]]:
+    """
+    パーティション内の、Spectrumが読み込むオブジェクトの一覧を取得する
+
+    Parameters
+    ----------
+    bucket: str
+        オブジェクトが格納されているバケット名
+    prefix: str
+        パーティションのprefix (例: 'parted/created_date=20190901/')
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        list_objects_v2の'Contents'の要素 ('Key', 'ETag'など)。キーの昇順
+    """
+    result = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for response in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for x in response.get('Contents', []):
+            name = x['Key'][len(prefix):]
+            if name != '' and '/' not in name and not name.startswith('_') and not name.startswith('.'):
+                result.append(x)  # Spectrumは"_", "."で始まるファイルを読み込まない
+
+    return sorted(result, key=lambda x: x['Key'])
+
+
+def list_parted_file(bucket: str, prefix: str) -> List[str]:
+    """
+    パーティション内の、Spectrumが読み込むオブジェクトのキーの一覧を取得する
+
+    Parameters
+    ----------
+    bucket: str
+        オブジェクトが格納されているバケット名
+    prefix: str
+        パーティションのprefix (例: 'parted/created_date=20190901/')
+
+    Returns
+    -------
+    List[str]
+        オブジェクトのキーの一覧。キーの昇順
+    """
+    return [x['Key'] for x in list_parted_object(bucket, prefix)]
+
+
+def convert_parted_file(bucket: str, key: str, level: int = 6, member_size: int = 0) -> List[Tuple[bytes, int]]:
+    """
+    S3格納用フォルダのオブジェクトを、ダウンロード用の"ユーザID,緯度,経度,タイムスタンプ\\r\\n"のテキストに変換し、
+    gzipのメンバーとして圧縮する
+    member_sizeを指定した場合は、圧縮後のサイズがmember_size程度になったところで、レコードの区切りでメンバーを分ける
+
+    gzip圧縮したCSVは、展開しながら行末の"\\n"を"\\r\\n"に置き換える (値はretrieve_requestが書き出したまま)
+    Parquetは、カーソルで取得した場合と同じ書式で書き出す
+
+    Parameters
+    ----------
+    bucket: str
+        オブジェクトが格納されているバケット名
+    key: str
+        オブジェクトのキー
+    level: int
+        gzipの圧縮レベル
+    member_size: int
+        一つのメンバーのサイズ(圧縮後)の目安。0ならオブジェクト全体を一つのメンバーとする
+
+    Returns
+    -------
+    List[Tuple[bytes, int]]
+        gzip圧縮したテキスト(メンバー)と、そのレコード数の一覧
+    """
+    members = []
+    member = {'compressor': zlib.compressobj(level, wbits=31), 'chunks': [], 'size': 0, 'records': 0}
+
+    def finish_member() -> None:
+        if member['records'] > 0:
+            member['chunks'].append(member['compressor'].flush())
+            members.append((b''.join(member['chunks']), member['records']))
+        member.update({'compressor': zlib.compressobj(level, wbits=31), 'chunks': [], 'size': 0, 'records': 0})
+
+    def add_lines(text: bytes) -> None:  # "...\r\n"で終わるテキスト
+        data = member['compressor'].compress(text)
+        member['chunks'].append(data)
+        member['size'] += len(data)
+        member['records'] += text.count(b'\n')
+        if 0 < member_size <= member['size']:
+            finish_member()
+
+    body = s3.get_object(Bucket=bucket, Key=key)['Body']
+    if key.endswith('.parquet'):
+        if retrieve_request.pyarrow is None:
+            raise ValueError('pyarrow is not installed')
+        table = retrieve_request.pyarrow.parquet.read_table(io.BytesIO(body.read()))
+        for batch in table.to_batches(max_chunksize=READ_ROWS):
+            columns = [batch.column(x).to_pylist() for x in ['user_id', 'latitude', 'longitude', 'created_at']]
+            add_lines(encode_rows(list(zip(*columns))))
+        finish_member()
+        return members
+
+    rest = b''
+    with gzip.GzipFile(fileobj=body, mode='rb') as fin:  # gzipのメンバーが連結されたものも読み込める
+        for chunk in iter(lambda: fin.read(READ_SIZE), b''):
+            chunk = rest + chunk
+            end = chunk.rfind(b'\n') + 1  # メンバーをレコードの区切りで分けられるよう、最後の行は次に回す
+            rest = chunk[end:]
+            if end > 0:
+                add_lines(chunk[:end].replace(b'\n', b'\r\n'))
+    if rest != b'':  # 最終行に改行が無い場合
+        add_lines(rest + b'\r\n')
+    finish_member()
+    return members
+
+
+def export_parted_location(ymd: str, location_bucket: str, folder_parted: str, download_bucket: str, workers: int,
+                           part_size: int, level: int = 6, segment_size: int = 0,
+                           segment_grace: int = int(DEFAULT_SEGMENT_GRACE_SECONDS)) -> int:
+    """
+    Redshiftを使わず、S3格納用フォルダの該当日のパーティションを直接"YYYYMMDD.csv.gz"に書き出す
+    オブジェクト毎に並列に変換し、gzipのメンバーとしてキーの順に連結しながらアップロードする
+    セグメントに分割する場合は、変換時にsegment_size程度のメンバーに分けておくので、
+    compact_partitionでまとめた大きなオブジェクトがあってもセグメントはsegment_size程度となる
+
+    Parameters
+    ----------
+    ymd:str
+        該当日となる年月日 (YYYYMMDD)
+    location_bucket: str
+        S3格納用フォルダのバケット名
+    folder_parted: str
+        S3格納用フォルダのprefix (例: 'parted/')
+    download_bucket: str
+        ダウンロード用のS3バケット名
+    workers: int
+        並列に変換するオブジェクト数
+    part_size: int
+        マルチパートアップロードの一パートのサイズ
+    level: int
+        gzipの圧縮レベル
+    segment_size: int
+        0より大きい場合は、このサイズ程度のセグメントに分割して書き出す (SegmentWriter参照)
+    segment_grace: int
+        セグメントに分割する場合の、置き換えた前回のセグメントを残す期間(秒)
+
+    Returns
+    -------
+    int
+        書き込んだレコード数
+    """
+    keys = list_parted_file(location_bucket, folder_parted + 'created_date=' + ymd + '/')
+    records = 0
+    if segment_size > 0:
+        upload = SegmentWriter(download_bucket, ymd, segment_size, level, segment_grace)
+    else:
+        upload = MultipartUpload(download_bucket, ymd + '.csv.gz', part_size)
+
+    def write_member(result: List[Tuple[bytes, int]]) -> int:
+        for data, count in result:
+            if segment_size > 0:
+                upload.write_member(data, count)
+            else:
+                upload.write(data)
+        return sum([count for _, count in result])
+    try:
+        # 変換済みで連結待ちのオブジェクトがworkers * 2個を超えないように、順に投入する
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = collections.deque()
+            for key in keys:
+                futures.append(executor.submit(convert_parted_file, location_bucket, key, level, segment_size))
+                while len(futures) >= workers * 2:
+                    records += write_member(futures.popleft().result())
+            while len(futures) > 0:
+                records += write_member(futures.popleft().result())
+
+        # 空ファイルで無ければ、アップロードを完了する
+        if records > 0:
+            upload.close()
+        else:
+            upload.abort()
+    except Exception:
+        upload.abort()
+        raise
+
+    return records
+
+
+def get_parted_signature(bucket: str, prefix: str) -> str:
+    """
+    パーティション内のオブジェクトの一覧(キーとETag)のハッシュ値を求める
+    EXPORT_ENGINE=s3の場合に、前回書き出したときから変更があったかどうかの判定に使用する
+
+    Parameters
+    ----------
+    bucket: str
+        オブジェクトが格納されているバケット名
+    prefix: str
+        パーティションのprefix (例: 'parted/created_date=20190901/')
+
+    Returns
+    -------
+    str
+        ハッシュ値 (16進文字列)
+    """
+    md5 = hashlib.md5()
+    for x in list_parted_object(bucket, prefix):
+        md5.update(bytes('{0} {1}\n'.format(x['Key'], x['ETag']), 'utf-8'))
+    return md5.hexdigest()
+
+
+def count_location(ymd: str, table: str, conn: psycopg2.extensions.connection) -> int:
+    """
+    Redshiftから該当日のレコード数を取得する
+
+    Parameters
+    ----------
+    ymd:str
+        該当日となる年月日 (YYYYMMDD)
+    table: str
+        Redshift内のテーブル名
+    conn: psycopg2.extensions.connection
+        Redshiftへの接続オブジェクト
+
+    Returns
+    -------
+    int
+        レコード数
+    """
+    with conn:
+        with conn.cursor() as cursor:
+            cursor.execute('select count(*) from {} where created_date=\'{}\''.format(table, ymd))
+            return cursor.fetchone()[0]
+
+
+def get_output_tags(bucket: str, key: str) -> Optional[Dict[str, str]]:
+    """
+    書き出したオブジェクトのタグを取得する
+
+    Parameters
+    ----------
+    bucket: str
+        ダウンロード用のS3バケット名
+    key: str
+        オブジェクトのキー
+
+    Returns
+    -------
+    Optional[Dict[str, str]]
+        タグ。オブジェクトが存在しない場合はNone
+    """
+    try:
+        response = s3.get_object_tagging(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        return None
+    return dict([(x['Key'], x['Value']) for x in response['TagSet']])
+
+
+def get_config() -> Dict[str, Any]:
+    """
+    環境変数から設定を読み込む
+
+    Returns
+    -------
+    Dict[str, Any]
+        設定
+    """
+    folder_parted, table_location = retrieve_request.get_parted_location()  # OUTPUT_FORMATによって既定値が異なる
+    config = {
+        'bucket': os.environ.get('BUCKET_DOWNLOAD', DEFAULT_BUCKET_DOWNLOAD),
+        'table_location': table_location,
+        'fetch_size': int(os.environ.get('FETCH_SIZE', DEFAULT_FETCH_SIZE)),
+        'export_engine': os.environ.get('EXPORT_ENGINE', DEFAULT_EXPORT_ENGINE),
+        'unload_iam_role': os.environ.get('UNLOAD_IAM_ROLE', DEFAULT_UNLOAD_IAM_ROLE),
+        'unload_prefix': os.environ.get('UNLOAD_PREFIX', DEFAULT_UNLOAD_PREFIX),
+        'unload_parallel': os.environ.get('UNLOAD_PARALLEL', DEFAULT_UNLOAD_PARALLEL) == '1',
+        'location_bucket': os.environ.get('BUCKET_LOCATION', DEFAULT_BUCKET_LOCATION),
+        'folder_parted': folder_parted,
+        'export_workers': int(os.environ.get('EXPORT_WORKERS', DEFAULT_EXPORT_WORKERS)),
+        'upload_part_size': int(os.environ.get('UPLOAD_PART_SIZE', DEFAULT_UPLOAD_PART_SIZE)),
+        'compress_level': int(os.environ.get('COMPRESS_LEVEL', DEFAULT_COMPRESS_LEVEL)),
+        'collect_workers': int(os.environ.get('COLLECT_WORKERS', DEFAULT_COLLECT_WORKERS)),
+        'segment_size': int(os.environ.get('SEGMENT_SIZE', DEFAULT_SEGMENT_SIZE)),
+        'segment_grace': int(os.environ.get('SEGMENT_GRACE_SECONDS', DEFAULT_SEGMENT_GRACE_SECONDS)),
+    }
+    if config['export_engine'] not in EXPORT_ENGINES:
+        raise ValueError('unknown export engine: ' + config['export_engine'])
+    if config['export_engine'] == EXPORT_ENGINE_UNLOAD and config['segment_size'] > 0:
+        raise ValueError('SEGMENT_SIZE is not supported with EXPORT_ENGINE=unload')
+    return config
+
+
+def get_output_key(ymd: str, config: Dict[str, Any]) -> str:
+    """
+    該当日の書き出し結果を表すオブジェクトのキー。タグはこのオブジェクトに付ける
+
+    Parameters
+    ----------
+    ymd: str
+        該当日となる年月日 (YYYYMMDD)
+    config: Dict[str, Any]
+        設定 (get_config()の結果)
+
+    Returns
+    -------
+    str
+        分割する場合はマニフェスト("YYYYMMDD.manifest.json")、しない場合は"YYYYMMDD.csv.gz"
+    """
+    return ymd + (MANIFEST_SUFFIX if config['segment_size'] > 0 else '.csv.gz')
+
+
+def export_location(ymd: str, config: Dict[str, Any], conn: Optional[psycopg2.extensions.connection]) \
+        -> Tuple[int, Dict[str, str]]:
+    """
+    設定された方法で、該当日のデータを"YYYYMMDD.csv.gz"に書き出す
+
+    Parameters
+    ----------
+    ymd: str
+        該当日となる年月日 (YYYYMMDD)
+    config: Dict[str, Any]
+        設定 (get_config()の結果)
+    conn: Optional[psycopg2.extensions.connection]
+        Redshiftへの接続オブジェクト。EXPORT_ENGINE=s3の場合はNone
+
+    Returns
+    -------
+    int, Dict[str, str]
+        書き込んだレコード数, 書き出したオブジェクトに付けるタグ
+    """
+    bucket = config['bucket']
+    if config['export_engine'] == EXPORT_ENGINE_UNLOAD:
+        # RedshiftからS3に直接書き出す
+        records = unload_and_write_location(ymd, config['table_location'], bucket, config['unload_prefix'],
+                                            config['unload_iam_role'], config['unload_parallel'], conn)
+        return records, {TAG_RECORDS: str(records)}
+
+    if config['export_engine'] == EXPORT_ENGINE_S3:
+        # S3格納用フォルダのオブジェクトを直接変換して書き出す
+        signature = get_parted_signature(config['location_bucket'],
+                                         config['folder_parted'] + 'created_date=' + ymd + '/')
+        records = export_parted_location(ymd, config['location_bucket'], config['folder_parted'], bucket,
+                                         config['export_workers'], config['upload_part_size'],
+                                         config['compress_level'], config['segment_size'], config['segment_grace'])
+        return records, {TAG_RECORDS: str(records), TAG_SOURCE: signature}
+
+    if config['segment_size'] > 0:
+        # Redshiftからqueryし、セグメントに分割して書き出す
+        writer = SegmentWriter(bucket, ymd, config['segment_size'], config['compress_level'], config['segment_grace'])
+        try:
+            select_and_write_location(ymd, writer, config['table_location'], config['fetch_size'], conn)
+            records = writer.close()
+        except Exception:
+            writer.abort()
+            raise
+        return records, {TAG_RECORDS: str(records)}
+
+    with tempfile.TemporaryFile() as ftemp:
+        # Redshiftからqueryし、一時ファイルに圧縮して書き出す
+        with gzip.GzipFile(fileobj=ftemp, mode='w+b') as fout:
+            records = select_and_write_location(ymd, fout, config['table_location'], config['fetch_size'], conn)
+
+        # 空ファイルで無ければ、一時ファイルをS3にアップロードする
+        if records > 0:
+            ftemp.seek(0)
+            s3.upload_fileobj(Fileobj=ftemp, Bucket=bucket, Key=ymd + '.csv.gz')
+
+    return records, {TAG_RECORDS: str(records)}
+
+
+def get_exported_records(ymd: str, config: Dict[str, Any], conn: Optional[psycopg2.extensions.connection]) \
+        -> Optional[int]:
+    """
+    該当日の"YYYYMMDD.csv.gz"が既に書き出されていて、内容が最新かどうかを調べる
+    Redshiftを使う場合はレコード数、EXPORT_ENGINE=s3の場合は元のオブジェクトの一覧が一致すれば最新とする
+
+    Parameters
+    ----------
+    ymd: str
+        該当日となる年月日 (YYYYMMDD)
+    config: Dict[str, Any]
+        設定 (get_config()の結果)
+    conn: Optional[psycopg2.extensions.connection]
+        Redshiftへの接続オブジェクト。EXPORT_ENGINE=s3の場合はNone
+
+    Returns
+    -------
+    Optional[int]
+        最新のものが書き出されている場合はそのレコード数。書き出しが必要な場合はNone
+    """
+    tags = get_output_tags(config['bucket'], get_output_key(ymd, config))
+    if tags is None or TAG_RECORDS not in tags:
+        return None
+    records = int(tags[TAG_RECORDS])
+    if config['export_engine'] == EXPORT_ENGINE_S3:
+        signature = get_parted_signature(config['location_bucket'],
+                                         config['folder_parted'] + 'created_date=' + ymd + '/')
+        return records if tags.get(TAG_SOURCE) == signature else None
+    return records if records == count_location(ymd, config['table_location'], conn) else None
+
+
+def collect_day(ymd: str, config: Dict[str, Any], pool: Optional[psycopg2.pool.AbstractConnectionPool]) \
+        -> Dict[str, Any]:
+    """
+    該当日のデータを書き出す。既に最新のものが書き出されていれば何もしない
+
+    Parameters
+    ----------
+    ymd: str
+        該当日となる年月日 (YYYYMMDD)
+    config: Dict[str, Any]
+        設定 (get_config()の結果)
+    pool: Optional[psycopg2.pool.AbstractConnectionPool]
+        Redshiftへの接続のプール。EXPORT_ENGINE=s3の場合はNone
+
+    Returns
+    -------
+    Dict[str, Any]
+        処理結果 {'ymd': 年月日, 'status': STATUS_*, 'records': レコード数, 'elapsed': 所要時間(秒)}
+    """
+    start = time.perf_counter()
+    result = {'ymd': ymd, 'status': STATUS_ERROR, 'records': 0, 'elapsed': 0.0}
+    conn = None if pool is None else pool.getconn()
+    try:
+        records = get_exported_records(ymd, config, conn)
+        if records is not None:
+            result['status'] = STATUS_SKIPPED
+            result['records'] = records
+        else:
+            records, tags = export_location(ymd, config, conn)
+            if records > 0:
+                s3.put_object_tagging(Bucket=config['bucket'], Key=get_output_key(ymd, config),
+                                      Tagging={'TagSet': [{'Key': k, 'Value': v} for k, v in tags.items()]})
+            result['status'] = STATUS_EXPORTED
+            result['records'] = records
+        if result['records'] > 0:
+            remove_stale_output(config['bucket'], ymd, config['segment_size'] > 0)
+    except Exception as e:
+        logger.error('{0}: {1}'.format(ymd, e))
+    finally:
+        if conn is not None:
+            pool.putconn(conn)
+
+    result['elapsed'] = time.perf_counter() - start
+    logger.info('{0}: {1} {2} records, {3:.1f}s ({4:.0f} rows/s)'.format(
+        ymd, result['status'], result['records'], result['elapsed'],
+        result['records'] / result['elapsed'] if result['elapsed'] > 0 else 0))
+    return result
+
+
+def collect_days(ymd_list: List[str], config: Dict[str, Any],
+                 pool: Optional[psycopg2.pool.AbstractConnectionPool] = None) -> List[Dict[str, Any]]:
+    """
+    複数日のデータを、COLLECT_WORKERS日ずつ並行して書き出す
+    Redshiftへの接続は日を跨いで使い回す
+
+    Parameters
+    ----------
+    ymd_list: List[str]
+        対象となる年月日 (YYYYMMDD) の一覧
+    config: Dict[str, Any]
+        設定 (get_config()の結果)
+    pool: Optional[psycopg2.pool.AbstractConnectionPool]
+        Redshiftへの接続のプール (run_pipelineから呼び出される場合)。Noneの場合はここで作成する
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        日毎の処理結果 (collect_day()の結果)。ymd_listの順
+    """
+    workers = max(1, min(config['collect_workers'], len(ymd_list)))
+    own_pool = None
+    if config['export_engine'] == EXPORT_ENGINE_S3:
+        pool = None
+    elif pool is None:
+        pool = own_pool = psycopg2.pool.ThreadedConnectionPool(1, workers, get_connection_string())
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lambda x: collect_day(x, config, pool), ymd_list))
+    finally:
+        if own_pool is not None:
+            own_pool.closeall()
+
+
+def parse_ymd_args(args: List[str]) -> List[str]:
+    """
+    コマンドライン引数から対象となる年月日の一覧を求める
+    引数は"YYYYMMDD"または"YYYYMMDD-YYYYMMDD"(両端を含む期間)で、複数指定できる
+
+    Parameters
+    ----------
+    args: List[str]
+        コマンドライン引数
+
+    Returns
+    -------
+    List[str]
+        年月日 (YYYYMMDD) の一覧。重複は除く
+
+    Raises
+    ------
+    ValueError
+        日付の形式が不正
+    """
+    result = []
+    for arg in args:
+        first, _, last = arg.partition('-')
+        day = datetime.datetime.strptime(first, '%Y%m%d')
+        end = datetime.datetime.strptime(last, '%Y%m%d') if last else day
+        while day <= end:
+            ymd = day.strftime('%Y%m%d')
+            if ymd not in result:
+                result.append(ymd)
+            day += datetime.timedelta(days=1)
+
+    return result
+
+
 def main(ymd: str) -> str:
     """
     メイン
@@ -76,24 +1044,41 @@ def main(ymd: str) -> str:
     str:
         "success" or "error"
     """
-    bucket = os.environ.get('BUCKET_DOWNLOAD', DEFAULT_BUCKET_DOWNLOAD)
-    table_location = os.environ.get('TABLE_LOCATION', DEFAULT_TABLE_LOCATION)
+    return main_days([ymd])
 
-    try:
-        logger.info('start.')
 
-        with tempfile.TemporaryFile() as ftemp:
-            # Redshiftからqueryし、一時ファイルに圧縮して書き出す
-            with gzip.GzipFile(fileobj=ftemp, mode='w+b') as fout:
-                records = select_and_write_location(ymd, fout, table_location)
+def main_days(ymd_list: List[str], pool: Optional[psycopg2.pool.AbstractConnectionPool] = None) -> str:
+    """
+    複数日を対象とするメイン。日毎の処理結果の一覧をログに出力する
 
-            # 空ファイルで無ければ、一時ファイルをS3にアップロードする
-            if records > 0:
-                ftemp.seek(0)
-                s3.upload_fileobj(Fileobj=ftemp, Bucket=bucket, Key=ymd + '.csv.gz')
+    Parameters
+    ----------
+    ymd_list: List[str]
+        対象となる年月日 (YYYYMMDD) の一覧
+    pool: Optional[psycopg2.pool.AbstractConnectionPool]
+        Redshiftへの接続のプール (run_pipelineから呼び出される場合)。Noneの場合は新たに作成する
+
+    Returns
+    -------
+    str:
+        "success" or "error" (一日でも失敗した場合)
+    """
+    try:
+        logger.info('start.')
+        config = get_config()  # 不正な設定(EXPORT_ENGINEなど)も、他の失敗と同じくエラーとして返す
+        start = time.perf_counter()
+        results = collect_days(ymd_list, config, pool)
 
-        logger.info('finished.')
-        return 'success'
+        # 処理結果の一覧
+        for x in results:
+            logger.info('{0} {1:8s} {2:10d} records {3:8.1f}s'.format(x['ymd'], x['status'], x['records'],
+                                                                      x['elapsed']))
+        statuses = [x['status'] for x in results]
+        logger.info('finished. {0} days: {1} exported, {2} skipped, {3} errors, {4:.1f}s'.format(
+            len(results), statuses.count(STATUS_EXPORTED), statuses.count(STATUS_SKIPPED),
+            statuses.count(STATUS_ERROR), time.perf_counter() - start))
+        if STATUS_ERROR not in statuses:
+            return 'success'
     except Exception as e:
         logger.error(e)
 
@@ -104,8 +1089,8 @@ if __name__ == "__main__":
     if len(sys.argv) == 1:  # 引数なしの場合は昨日のデータ
         local_time = time.time() + tz
         local_yesterday_base_time = local_time - (local_time % (60 * 60 * 24)) - (60 * 60 * 24)
-        ymd_str = datetime.datetime.utcfromtimestamp(local_yesterday_base_time).strftime('%Y%m%d')  # YYYYMMDD
+        ymd_str_list = [datetime.datetime.utcfromtimestamp(local_yesterday_base_time).strftime('%Y%m%d')]  # YYYYMMDD
     else:
-        ymd_str = sys.argv[1]
+        ymd_str_list = parse_ymd_args(sys.argv[1:])  # "YYYYMMDD" or "YYYYMMDD-YYYYMMDD"
 
-    main(ymd_str)
+    main_days(ymd_str_list)
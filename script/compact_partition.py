@@ -0,0 +1,320 @@
+# coding=utf-8
+
+"""
+S3格納用フォルダ(s3://..../parted)の指定日のパーティションにある小さなオブジェクトを、目標サイズ程度のオブジェクトにまとめる。
+retrieve_requestは実行する度に、振り分けた日付のパーティションにオブジェクトを一つずつ追加するため、
+一日に数回実行したり遅れて届いたデータがあったりすると、パーティション内のオブジェクト数が増えてSpectrumの検索が遅くなる。
+
+まとめたオブジェクトは、Spectrumが読み込まない"_"で始まる名前で書き出した後、以下の手順で入れ替える
+  1. 入れ替え内容(まとめたオブジェクトと、元のオブジェクトの一覧)をパーティション内の"_compaction.json"に書き出す
+  2. 元のオブジェクトを削除する
+  3. まとめたオブジェクトを本来の名前にコピーし、"_"で始まるオブジェクトを削除する
+  4. "_compaction.json"を削除する
+途中で中断した場合は、次回の実行時に"_compaction.json"の内容に従って入れ替えを完了させるので、何度実行しても結果は同じになる
+S3では入れ替えをアトミックに行えないため、2から3の間はSpectrumからパーティションの一部のレコードが見えなくなる
+(先にコピーすると同じレコードが二重に見えるため、欠ける側を選んでいる)。collect_requestより前に実行すること
+
+gzip圧縮したCSVはgzipのメンバーを連結するだけなので、展開・再圧縮は行わない。Parquetは読み込んで一つのファイルに書き直す。
+retrieve_requestのチェックポイントに処理中のバッチが残っている場合、そのoutputsは回復時に削除されるため、まとめる対象から除く
+(まとめてしまうと、回復時に削除されずに再処理した結果と重複する)
+
+なお、全体の処理手順は以下の通り
+parse_request  ->  store_request  ->  retrieve_request  ->  [compact_partition]  -> collect_request
+"""
+
+import io
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+import datetime
+from typing import Any, Dict, List
+
+import retrieve_request
+from retrieve_request import MultipartUpload, s3, tz
+from retrieve_checkpoint import Checkpoint, delete_keys
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+DEFAULT_BUCKET_LOCATION = 'me32as8cme32as8c-task3-location'
+DEFAULT_TARGET_SIZE = str(128 * 1024 * 1024)    # まとめたオブジェクトの目標サイズ
+DEFAULT_MIN_SIZE = str(64 * 1024 * 1024)        # これより小さいオブジェクトをまとめる対象とする
+DEFAULT_PART_SIZE = str(8 * 1024 * 1024)        # マルチパートアップロードの一パートのサイズ
+
+JOURNAL_NAME = '_compaction.json'
+STAGING_PREFIX = '_'                            # Spectrumは"_", "."で始まるファイルを読み込まない
+READ_SIZE = 1024 * 1024
+EXTENSIONS = ('.csv.gz', '.parquet')            # まとめる対象の形式 (拡張子)
+
+
+def list_partition_object(bucket: str, prefix: str) -> List[Dict[str, Any]]:
+    """
+    パーティション内のオブジェクト一覧を取得する
+
+    Parameters
+    ----------
+    bucket: str
+        オブジェクトが格納されているバケット名
+    prefix: str
+        パーティションのprefix (例: 'parted/created_date=20190901/')
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        list_objects_v2の'Contents'の要素 ('Key', 'Size'など)。キーの昇順
+    """
+    result = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for response in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        result.extend([x for x in response.get('Contents', []) if x['Key'] != prefix])
+
+    return sorted(result, key=lambda x: x['Key'])
+
+
+def is_hidden(key: str) -> bool:
+    """
+    Spectrumが読み込まないオブジェクトかどうか
+    """
+    name = key.rsplit('/', 1)[-1]
+    return name.startswith('_') or name.startswith('.')
+
+
+def plan_compaction(objects: List[Dict[str, Any]], target_size: int, min_size: int) -> List[List[str]]:
+    """
+    まとめるオブジェクトの組を決める
+    min_sizeより小さいオブジェクトを形式毎にキーの順に並べ、合計がtarget_sizeに達するまでを一つの組とする
+    オブジェクトが一つしかない組はまとめる必要が無いので含めない
+
+    Parameters
+    ----------
+    objects: List[Dict[str, Any]]
+        パーティション内のオブジェクト一覧 (list_partition_objectの結果)
+    target_size: int
+        まとめたオブジェクトの目標サイズ
+    min_size: int
+        これより小さいオブジェクトをまとめる対象とする
+
+    Returns
+    -------
+    List[List[str]]
+        まとめるオブジェクトのキーの組の一覧
+    """
+    result = []
+    for extension in EXTENSIONS:
+        group, size = [], 0
+        for x in objects:
+            if is_hidden(x['Key']) or not x['Key'].endswith(extension) or x['Size'] >= min_size:
+                continue
+            group.append(x['Key'])
+            size += x['Size']
+            if size >= target_size:
+                result.append(group)
+                group, size = [], 0
+        result.append(group)
+
+    return [x for x in result if len(x) > 1]
+
+
+def merge_object(bucket: str, keys: List[str], key: str, part_size: int) -> None:
+    """
+    オブジェクトを一つにまとめて書き出す
+
+    Parameters
+    ----------
+    bucket: str
+        オブジェクトが格納されているバケット名
+    keys: List[str]
+        まとめるオブジェクトのキー
+    key: str
+        書き出すオブジェクトのキー
+    part_size: int
+        マルチパートアップロードの一パートのサイズ
+    """
+    if key.endswith('.parquet') and retrieve_request.pyarrow is None:
+        raise ValueError('pyarrow is not installed')
+
+    upload = MultipartUpload(bucket, key, part_size)
+    try:
+        if key.endswith('.parquet'):
+            writer = None
+            for x in keys:
+                table = retrieve_request.pyarrow.parquet.read_table(
+                    io.BytesIO(s3.get_object(Bucket=bucket, Key=x)['Body'].read()))
+                if writer is None:
+                    writer = retrieve_request.pyarrow.parquet.ParquetWriter(
+                        upload, table.schema, compression=retrieve_request.DEFAULT_PARQUET_COMPRESSION,
+                        use_dictionary=['user_id'])
+                writer.write_table(table)
+            writer.close()
+        else:
+            # gzipのメンバーを連結したものも、一つのgzipファイルとして読み込める
+            for x in keys:
+                body = s3.get_object(Bucket=bucket, Key=x)['Body']
+                for chunk in iter(lambda: body.read(READ_SIZE), b''):
+                    upload.write(chunk)
+        upload.close()
+    except Exception:
+        upload.abort()
+        raise
+
+
+def finish_compaction(bucket: str, prefix: str, journal: Dict[str, Any]) -> None:
+    """
+    入れ替え内容に従って、元のオブジェクトを削除してから、まとめたオブジェクトを本来の名前にコピーする
+    途中まで行われていた場合も、残りを行う (コピー済みのオブジェクトは"_"で始まる側が削除されるまで残る)
+
+    Parameters
+    ----------
+    bucket: str
+        オブジェクトが格納されているバケット名
+    prefix: str
+        パーティションのprefix
+    journal: Dict[str, Any]
+        入れ替え内容 {'outputs': [{'staging': 書き出したキー, 'key': 本来のキー}], 'inputs': [元のキー]}
+    """
+    existing = set([x['Key'] for x in list_partition_object(bucket, prefix)])
+    delete_keys(s3, bucket, [x for x in journal['inputs'] if x in existing])
+
+    for output in journal['outputs']:
+        if output['staging'] in existing:
+            s3.copy_object(Bucket=bucket, Key=output['key'],
+                           CopySource={'Bucket': bucket, 'Key': output['staging']})
+
+    delete_keys(s3, bucket, [x['staging'] for x in journal['outputs'] if x['staging'] in existing])
+    s3.delete_object(Bucket=bucket, Key=prefix + JOURNAL_NAME)
+
+
+def get_pending_outputs(bucket: str, checkpoint_key: str) -> List[str]:
+    """
+    retrieve_requestのチェックポイントから、処理中のバッチが書き出したオブジェクトの一覧を取得する
+
+    Parameters
+    ----------
+    bucket: str
+        チェックポイントが保存されているバケット名
+    checkpoint_key: str
+        チェックポイントのキー
+
+    Returns
+    -------
+    List[str]
+        処理中のバッチのoutputs。処理中のバッチが無い場合は空
+    """
+    checkpoint = Checkpoint(s3, bucket, checkpoint_key)
+    checkpoint.load()
+    if checkpoint.batch is None:
+        return []
+    return checkpoint.batch.get('outputs', [])
+
+
+def compact_partition(bucket: str, prefix: str, target_size: int, min_size: int, part_size: int,
+                      pending: List[str] = None) -> List[str]:
+    """
+    パーティション内の小さなオブジェクトをまとめる
+
+    Parameters
+    ----------
+    bucket: str
+        オブジェクトが格納されているバケット名
+    prefix: str
+        パーティションのprefix (例: 'parted/created_date=20190901/')
+    target_size: int
+        まとめたオブジェクトの目標サイズ
+    min_size: int
+        これより小さいオブジェクトをまとめる対象とする
+    part_size: int
+        マルチパートアップロードの一パートのサイズ
+    pending: List[str]
+        まとめる対象から除くオブジェクトのキー (get_pending_outputsの結果)
+
+    Returns
+    -------
+    List[str]
+        まとめて作成したオブジェクトのキー
+    """
+    # 前回中断した入れ替えがあれば完了させる
+    try:
+        journal = json.loads(s3.get_object(Bucket=bucket, Key=prefix + JOURNAL_NAME)['Body'].read())
+        logger.info('resume compaction: {}'.format(prefix))
+        finish_compaction(bucket, prefix, journal)
+    except s3.exceptions.NoSuchKey:
+        pass
+
+    # 入れ替え内容を書き出す前に中断した場合の、書き出し途中のオブジェクトは削除する
+    objects = list_partition_object(bucket, prefix)
+    delete_keys(s3, bucket, [x['Key'] for x in objects if is_hidden(x['Key'])])
+
+    if pending:
+        excluded = set(pending)
+        objects = [x for x in objects if x['Key'] not in excluded]
+    groups = plan_compaction(objects, target_size, min_size)
+    if len(groups) == 0:
+        return []
+
+    # 元のオブジェクトと名前が重ならないよう、実行毎に異なる名前にする
+    run_id = '{0}-{1}'.format(int(time.time()), uuid.uuid4().hex[:8])
+    journal = {'outputs': [], 'inputs': []}
+    for i, keys in enumerate(groups):
+        extension = [x for x in EXTENSIONS if keys[0].endswith(x)][0]
+        name = 'compact-{0}-{1:04d}{2}'.format(run_id, i, extension)
+        merge_object(bucket, keys, prefix + STAGING_PREFIX + name, part_size)
+        journal['outputs'].append({'staging': prefix + STAGING_PREFIX + name, 'key': prefix + name})
+        journal['inputs'].extend(keys)
+
+    s3.put_object(Bucket=bucket, Key=prefix + JOURNAL_NAME, Body=bytes(json.dumps(journal), 'utf-8'))
+    finish_compaction(bucket, prefix, journal)
+
+    return [x['key'] for x in journal['outputs']]
+
+
+def main(ymd_list: List[str]) -> str:
+    """
+    メイン
+
+    Parameters
+    ----------
+    ymd_list: List[str]
+        対象となる年月日 (YYYYMMDD) の一覧
+
+    Returns
+    -------
+    str
+        "success" or "error"
+    """
+    bucket = os.environ.get('BUCKET_LOCATION', DEFAULT_BUCKET_LOCATION)
+    folder_parted = retrieve_request.get_parted_location()[0]  # OUTPUT_FORMATによって既定値が異なる
+    target_size = int(os.environ.get('COMPACT_TARGET_SIZE', DEFAULT_TARGET_SIZE))
+    min_size = int(os.environ.get('COMPACT_MIN_SIZE', DEFAULT_MIN_SIZE))
+    part_size = int(os.environ.get('COMPACT_PART_SIZE', DEFAULT_PART_SIZE))
+    checkpoint_key = os.environ.get('CHECKPOINT_KEY', retrieve_request.DEFAULT_CHECKPOINT_KEY)
+
+    try:
+        logger.info('start.')
+        pending = get_pending_outputs(bucket, checkpoint_key)
+        if len(pending) > 0:
+            logger.info('{} objects of the pending retrieve_request batch are excluded'.format(len(pending)))
+        for ymd in ymd_list:
+            keys = compact_partition(bucket, folder_parted + 'created_date=' + ymd + '/', target_size, min_size,
+                                     part_size, pending)
+            logger.info('{0}: {1} objects created'.format(ymd, len(keys)))
+
+        logger.info('finished.')
+        return 'success'
+    except Exception as e:
+        logger.error(e)
+
+    return 'error'
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 1:  # 引数なしの場合は昨日のデータ
+        local_time = time.time() + tz
+        local_yesterday_base_time = local_time - (local_time % (60 * 60 * 24)) - (60 * 60 * 24)
+        ymd_str_list = [datetime.datetime.utcfromtimestamp(local_yesterday_base_time).strftime('%Y%m%d')]
+    else:
+        ymd_str_list = sys.argv[1:]
+
+    main(ymd_str_list)
@@ -0,0 +1,207 @@
+# coding=utf-8
+
+"""
+retrieve_requestが書き出す、geohashのタイル毎にまとめた位置情報(s3://..../tiles)の形式と読み込み
+レコードの緯度・経度のgeohashの先頭precision文字をタイルとし、日付毎に以下のオブジェクトを書き出す
+
+  tiles/created_date=YYYYMMDD/<バッチID>.csv.gz       タイル順に並べたレコード。タイル毎に連続した一つ以上のgzipメンバーとする
+  tiles/created_date=YYYYMMDD/<バッチID>.index.json   タイル -> オブジェクト内の位置 のインデックス
+
+インデックスは {"key": データのキー, "precision": タイルの文字数, "records": レコード数,
+                "tiles": {タイル: [offset, size, レコード数]}}
+ある地域のある日のレコードは、その日のインデックスを読み込み、該当するタイルの範囲だけをRange GETすれば得られる
+緯度・経度が数値でない、または範囲外のレコードはINVALID_TILEにまとめる
+"""
+
+import functools
+import gzip
+import json
+from typing import Any, Dict, List, Tuple
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'  # geohashで使用する文字
+INVALID_TILE = '_'                           # 緯度・経度が不正なレコードのタイル
+INDEX_SUFFIX = '.index.json'
+MAX_PRECISION = 12
+
+
+@functools.lru_cache(maxsize=65536)
+def _cell_geohash(latitude_index: int, longitude_index: int, precision: int) -> str:
+    """
+    セル(緯度・経度方向の分割番号)のgeohashを求める
+    """
+    bits = precision * 5
+    longitude_bits = (bits + 1) // 2
+    latitude_bits = bits // 2
+    value = 0
+    for i in range(bits):  # 経度から始めて、緯度と経度のビットを交互に並べる
+        if i % 2 == 0:
+            longitude_bits -= 1
+            value = (value << 1) | ((longitude_index >> longitude_bits) & 1)
+        else:
+            latitude_bits -= 1
+            value = (value << 1) | ((latitude_index >> latitude_bits) & 1)
+    return ''.join([BASE32[(value >> (5 * (precision - 1 - i))) & 31] for i in range(precision)])
+
+
+def encode_geohash(latitude: float, longitude: float, precision: int) -> str:
+    """
+    緯度・経度をgeohashに変換する
+    区間の境界上の値は、大きい側のセルに含める
+
+    Parameters
+    ----------
+    latitude: float
+        緯度 (-90 ～ 90)
+    longitude: float
+        経度 (-180 ～ 180)
+    precision: int
+        geohashの文字数 (1 ～ MAX_PRECISION)
+
+    Returns
+    -------
+    str
+        geohash
+
+    Raises
+    ------
+    ValueError
+        緯度・経度が範囲外
+    """
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('out of range: {0}, {1}'.format(latitude, longitude))
+    bits = precision * 5
+    latitude_cells = 1 << (bits // 2)
+    longitude_cells = 1 << ((bits + 1) // 2)
+    latitude_index = min(int((latitude + 90) / 180 * latitude_cells), latitude_cells - 1)
+    longitude_index = min(int((longitude + 180) / 360 * longitude_cells), longitude_cells - 1)
+    return _cell_geohash(latitude_index, longitude_index, precision)
+
+
+def get_tile(line: bytes, precision: int) -> str:
+    """
+    レコード行のタイルを求める
+
+    Parameters
+    ----------
+    line: bytes
+        "ユーザID,緯度,経度,タイムスタンプ\\n"のレコード行
+    precision: int
+        タイルの文字数
+
+    Returns
+    -------
+    str
+        タイル (geohashの先頭precision文字)。緯度・経度が不正な場合はINVALID_TILE
+    """
+    fields = line.split(b',', 3)
+    try:
+        return encode_geohash(float(fields[1]), float(fields[2]), precision)
+    except (IndexError, ValueError):
+        return INVALID_TILE
+
+
+def get_tile_prefix(folder: str, ymd: str) -> str:
+    """
+    日付毎のタイルのフォルダのprefixを求める
+
+    Parameters
+    ----------
+    folder: str
+        タイル用フォルダのprefix (例: 'tiles/')
+    ymd: str
+        年月日 (YYYYMMDD)
+
+    Returns
+    -------
+    str
+        フォルダのprefix (例: 'tiles/created_date=20190901/')
+    """
+    return folder + 'created_date=' + ymd + '/'
+
+
+def load_tile_index(s3: Any, bucket: str, prefix: str) -> List[Dict[str, Any]]:
+    """
+    日付毎のタイルのフォルダにある、すべてのインデックスを読み込む
+
+    Parameters
+    ----------
+    s3: Any
+        S3クライアント
+    bucket: str
+        タイルが格納されているバケット名
+    prefix: str
+        日付毎のタイルのフォルダのprefix (get_tile_prefixの結果)
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        インデックスの一覧 (データのキーの昇順)
+    """
+    keys = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for response in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys.extend([x['Key'] for x in response.get('Contents', []) if x['Key'].endswith(INDEX_SUFFIX)])
+
+    result = [json.loads(s3.get_object(Bucket=bucket, Key=x)['Body'].read()) for x in sorted(keys)]
+    return sorted(result, key=lambda x: x['key'])
+
+
+def get_tile_ranges(index_list: List[Dict[str, Any]], geohash: str) -> List[Tuple[str, int, int]]:
+    """
+    geohashに該当するタイルの、オブジェクト内の範囲を求める
+    geohashがタイルより短い場合は、それで始まるすべてのタイルが該当する (タイル順に並んでいるので、連続した範囲はまとめる)
+
+    Parameters
+    ----------
+    index_list: List[Dict[str, Any]]
+        インデックスの一覧 (load_tile_indexの結果)
+    geohash: str
+        対象となる地域のgeohash
+
+    Returns
+    -------
+    List[Tuple[str, int, int]]
+        (データのキー, 開始位置, 終了位置(含まない)) の一覧
+    """
+    result = []
+    for index in index_list:
+        tile = geohash[:index['precision']]
+        ranges = sorted([(x[0], x[0] + x[1]) for t, x in index['tiles'].items() if t.startswith(tile)])
+        for start, end in ranges:
+            if len(result) > 0 and result[-1][0] == index['key'] and result[-1][2] == start:
+                result[-1] = (index['key'], result[-1][1], end)
+            else:
+                result.append((index['key'], start, end))
+    return result
+
+
+def read_tile(s3: Any, bucket: str, prefix: str, geohash: str) -> bytes:
+    """
+    指定日の、geohashの地域内のレコードを読み込む
+
+    Parameters
+    ----------
+    s3: Any
+        S3クライアント
+    bucket: str
+        タイルが格納されているバケット名
+    prefix: str
+        日付毎のタイルのフォルダのprefix (get_tile_prefixの結果)
+    geohash: str
+        対象となる地域のgeohash。タイルより長い場合は、該当するタイルを読み込んだ後に絞り込む
+
+    Returns
+    -------
+    bytes
+        "ユーザID,緯度,経度,タイムスタンプ\\n"のレコード列
+    """
+    index_list = load_tile_index(s3, bucket, prefix)
+    result = []
+    for key, start, end in get_tile_ranges(index_list, geohash):
+        body = s3.get_object(Bucket=bucket, Key=key, Range='bytes={0}-{1}'.format(start, end - 1))['Body'].read()
+        result.append(gzip.decompress(body))  # 連続したgzipのメンバーはまとめて展開できる
+
+    data = b''.join(result)
+    if all([len(geohash) <= x['precision'] for x in index_list]):
+        return data
+    return b''.join([x + b'\n' for x in data.split(b'\n')[:-1] if get_tile(x, len(geohash)) == geohash])
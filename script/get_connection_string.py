@@ -2,14 +2,23 @@
 
 """
 retrieve_request, collect_request共通で使用するRedshiftへの接続文字列取得関数
+一つのプロセスで複数回呼び出される場合(run_pipeline)に備えて、読み込んだ設定ファイルの内容はキャッシュする
 """
 
+import contextlib
 import os
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+from typing import Iterator, Optional
+
+_cache = dict()  # 設定ファイル名 -> (更新時刻, 接続文字列)
 
 
 def get_connection_string(config_file: str = None) -> str:
     """
     Redshiftへのコネクション設定ファイル取得
+    設定ファイルが更新されていなければ、前回読み込んだ結果を返す
 
     Returns
     -------
@@ -18,10 +27,45 @@ def get_connection_string(config_file: str = None) -> str:
     """
     if config_file is None:
         config_file = os.environ.get('HOME', '/root') + '/.pgpass'
+    mtime = os.stat(config_file).st_mtime
+    if config_file in _cache and _cache[config_file][0] == mtime:
+        return _cache[config_file][1]
+
     with open(config_file, 'r') as fd:
         for line in fd:
             s_line = line.strip()
             if len(s_line) == 0 or s_line[0] == '#':
                 continue
             host, port, dbname, user, password = s_line.split(':')
-            return 'dbname={0} user={1} password={2} host={3} port={4}'.format(dbname, user, password, host, port)
+            result = 'dbname={0} user={1} password={2} host={3} port={4}'.format(dbname, user, password, host, port)
+            _cache[config_file] = (mtime, result)
+            return result
+
+
+@contextlib.contextmanager
+def connect(pool: Optional[psycopg2.pool.AbstractConnectionPool] = None, autocommit: bool = False) \
+        -> Iterator[psycopg2.extensions.connection]:
+    """
+    Redshiftに接続する。poolが指定された場合はプールから取得し、終了後にプールに戻す
+
+    Parameters
+    ----------
+    pool: Optional[psycopg2.pool.AbstractConnectionPool]
+        接続のプール。Noneの場合は新たに接続する
+    autocommit: bool
+        autocommitにするかどうか。プールに戻すときはFalseに戻す
+
+    Returns
+    -------
+    Iterator[psycopg2.extensions.connection]
+        Redshiftへの接続オブジェクト (with文で使用する)
+    """
+    conn = psycopg2.connect(get_connection_string()) if pool is None else pool.getconn()
+    try:
+        conn.autocommit = autocommit
+        with conn:
+            yield conn
+    finally:
+        if pool is not None:
+            conn.autocommit = False
+            pool.putconn(conn)
@@ -0,0 +1,466 @@
+# coding=utf-8
+
+"""
+S3格納用フォルダ(s3://..../parted)の指定日の位置情報と店舗の位置を突き合わせ、
+店舗から一定距離(MATCH_RADIUSメートル)以内にいたレコードを書き出す。
+
+  入力  s3://<BUCKET_LOCATION>/<SHOP_KEY>   "店舗内部ID,緯度,経度\\n"のCSV (shopテーブルから書き出したもの。例:
+        select shop_index, ST_Latitude(location), ST_Longitude(location) from shop where status = 0)
+  出力  s3://<BUCKET_LOCATION>/<FOLDER_MATCH>YYYYMMDD.csv.gz   "ユーザID,店舗内部ID,タイムスタンプ,距離(メートル)\\n"
+
+店舗はMATCH_RADIUS四方以上の格子(セル)毎にまとめておき、各レコードは周囲3x3のセルの店舗だけを候補として、
+NumPyの配列演算でまとめて距離(haversine)を求める
+パーティション内のオブジェクトを、gzip圧縮したCSVは展開後MATCH_CHUNK_BYTES程度の行の区切りで、Parquetはrow group毎に
+チャンクに分け、プロセスプールで並行して処理する (numpy, pyarrowパッケージが必要)
+compact_partitionで一日分が一つのオブジェクトにまとめられていても、チャンク単位で並行して処理できる
+経度±180度を跨ぐ候補は考慮しない
+
+なお、全体の処理手順は以下の通り
+parse_request  ->  store_request  ->  retrieve_request  ->  compact_partition  ->  [match_shop]
+"""
+
+import collections
+import concurrent.futures
+import datetime
+import gzip
+import io
+import logging
+import math
+import os
+import sys
+import time
+import zlib
+from typing import Iterable, Iterator, List, Tuple, Union
+
+import boto3
+
+import collect_request
+import retrieve_request
+from retrieve_request import MultipartUpload, tz
+
+try:
+    import numpy
+except ImportError:  # match_shopを使用しない環境
+    numpy = None
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+DEFAULT_BUCKET_LOCATION = 'me32as8cme32as8c-task3-location'
+DEFAULT_FOLDER_MATCH = 'matched/'                     # 突き合わせた結果を書き出すフォルダ
+DEFAULT_SHOP_KEY = 'shop/shop.csv'                    # 店舗の位置のCSV
+DEFAULT_MATCH_RADIUS = '100'                          # 店舗からの距離(メートル)
+DEFAULT_MATCH_PROCESSES = str(os.cpu_count() or 1)    # 並行して処理するプロセス数 (0なら同じプロセスで処理する)
+DEFAULT_UPLOAD_PART_SIZE = str(8 * 1024 * 1024)       # マルチパートアップロードの一パートのサイズ
+DEFAULT_MATCH_CHUNK_BYTES = str(32 * 1024 * 1024)     # gzip圧縮したCSVを分けるチャンクの、展開後のサイズ
+
+EARTH_RADIUS = 6371008.8   # 地球の平均半径(メートル)
+MATCH_BATCH_ROWS = 262144  # 一度に配列演算するレコード数
+MAX_MATCH_PAIRS = 2097152  # 一度に距離を求める(レコード, 店舗)の候補の組の数の上限 (これに比例してメモリを使用する)
+
+s3 = boto3.client('s3')
+_worker_shops = None  # プロセスプールの各プロセスに渡した店舗のインデックス
+
+
+class ShopIndex:
+    """
+    店舗を緯度・経度の格子(セル)毎にまとめたインデックス
+    セルの大きさは、緯度方向はradius、経度方向は店舗がある最も高緯度の地点でradius以上とするので、
+    radius以内の店舗は必ず周囲3x3のセルに含まれる
+    """
+
+    def __init__(self, shop_index: 'numpy.ndarray', latitude: 'numpy.ndarray', longitude: 'numpy.ndarray',
+                 radius: float) -> None:
+        """
+        Parameters
+        ----------
+        shop_index: numpy.ndarray
+            店舗内部ID
+        latitude: numpy.ndarray
+            店舗の緯度
+        longitude: numpy.ndarray
+            店舗の経度
+        radius: float
+            突き合わせる距離(メートル)
+        """
+        if numpy is None:
+            raise ValueError('numpy is not installed')
+        self.radius = radius
+        self.cell_latitude = math.degrees(radius / EARTH_RADIUS)
+        max_latitude = float(numpy.abs(latitude).max()) if len(latitude) > 0 else 0.0
+        self.cell_longitude = min(360.0, self.cell_latitude / math.cos(math.radians(
+            min(89.0, max_latitude + self.cell_latitude))))
+        self.width = int(math.ceil(360 / self.cell_longitude)) + 3
+
+        keys = self.get_cell_key(latitude, longitude)
+        order = numpy.argsort(keys, kind='stable')
+        self.shop_index = numpy.asarray(shop_index, dtype=numpy.int64)[order]
+        self.latitude = numpy.asarray(latitude, dtype=numpy.float64)[order]
+        self.longitude = numpy.asarray(longitude, dtype=numpy.float64)[order]
+        self.cell_keys, self.cell_start, self.cell_count = numpy.unique(keys[order], return_index=True,
+                                                                        return_counts=True)
+
+    def get_cell_key(self, latitude: 'numpy.ndarray', longitude: 'numpy.ndarray', dy: int = 0,
+                     dx: int = 0) -> 'numpy.ndarray':
+        """
+        緯度・経度を含むセル(から(dy, dx)だけ隣のセル)の番号を求める
+        """
+        y = numpy.floor((latitude + 90) / self.cell_latitude).astype(numpy.int64) + dy
+        x = numpy.floor((longitude + 180) / self.cell_longitude).astype(numpy.int64) + 1 + dx
+        return y * self.width + x
+
+    def match(self, latitude: 'numpy.ndarray', longitude: 'numpy.ndarray') \
+            -> Tuple['numpy.ndarray', 'numpy.ndarray', 'numpy.ndarray']:
+        """
+        radius以内にある店舗との組を求める
+
+        Parameters
+        ----------
+        latitude: numpy.ndarray
+            レコードの緯度 (不正な値はNaN)
+        longitude: numpy.ndarray
+            レコードの経度 (不正な値はNaN)
+
+        Returns
+        -------
+        numpy.ndarray, numpy.ndarray, numpy.ndarray
+            レコードの位置, 店舗内部ID, 距離(メートル)。レコードの位置, 店舗内部IDの昇順
+        """
+        result = []
+        if len(self.cell_keys) == 0:
+            latitude = latitude[:0]
+        for first in range(0, len(latitude), MATCH_BATCH_ROWS):
+            result.append(self._match_batch(latitude[first:first + MATCH_BATCH_ROWS],
+                                            longitude[first:first + MATCH_BATCH_ROWS], first))
+        if len(result) == 0:
+            return numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.float64)
+        return tuple([numpy.concatenate([x[i] for x in result]) for i in range(3)])
+
+    def _match_batch(self, latitude: 'numpy.ndarray', longitude: 'numpy.ndarray', first: int) \
+            -> Tuple['numpy.ndarray', 'numpy.ndarray', 'numpy.ndarray']:
+        """
+        MATCH_BATCH_ROWS件までのレコードについて、radius以内にある店舗との組を求める
+        店舗が密集している場所では候補の組が多くなるため、組の数がMAX_MATCH_PAIRSを超えないようにレコードを区切って求める
+        """
+        valid = numpy.nonzero((numpy.abs(latitude) <= 90) & (numpy.abs(longitude) <= 180))[0]  # NaNも除く
+        latitude, longitude = latitude[valid], longitude[valid]
+
+        # 周囲3x3のセル毎に、店舗のあるセルに該当するレコードの位置と、セル内の店舗の範囲を求める
+        cells = []
+        pairs = numpy.zeros(len(latitude), numpy.int64)  # レコード毎の候補の組の数
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                keys = self.get_cell_key(latitude, longitude, dy, dx)
+                position = numpy.minimum(numpy.searchsorted(self.cell_keys, keys), len(self.cell_keys) - 1)
+                found = numpy.nonzero(self.cell_keys[position] == keys)[0]
+                count = self.cell_count[position[found]]
+                cells.append((found, self.cell_start[position[found]], count))
+                pairs[found] += count
+
+        result = []
+        total = numpy.cumsum(pairs)
+        begin = 0
+        while begin < len(latitude):
+            base = int(total[begin - 1]) if begin > 0 else 0
+            end = max(begin + 1, int(numpy.searchsorted(total, base + MAX_MATCH_PAIRS, side='right')))
+            result.append(self._match_range(latitude, longitude, cells, begin, end))
+            begin = end
+        if len(result) == 0:
+            return numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.float64)
+        rows, shops, distance = [numpy.concatenate([x[i] for x in result]) for i in range(3)]
+        return valid[rows] + first, shops, distance
+
+    def _match_range(self, latitude: 'numpy.ndarray', longitude: 'numpy.ndarray',
+                     cells: List[Tuple['numpy.ndarray', 'numpy.ndarray', 'numpy.ndarray']], begin: int, end: int) \
+            -> Tuple['numpy.ndarray', 'numpy.ndarray', 'numpy.ndarray']:
+        """
+        begin番目からend番目(含まない)のレコードについて、候補の組を展開して距離を求める
+        """
+        rows, shops = [], []
+        for found, start, count in cells:
+            low, high = numpy.searchsorted(found, [begin, end])  # foundは昇順
+            found, start, count = found[low:high], start[low:high], count[low:high]
+            # セル内の店舗の数だけレコードを繰り返し、(レコード, 店舗)の組に展開する
+            rows.append(numpy.repeat(found, count))
+            shops.append(numpy.repeat(start - (numpy.cumsum(count) - count), count) + numpy.arange(count.sum()))
+        rows = numpy.concatenate(rows)
+        shops = numpy.concatenate(shops)
+
+        distance = haversine(latitude[rows], longitude[rows], self.latitude[shops], self.longitude[shops])
+        near = distance <= self.radius
+        rows, shops, distance = rows[near], self.shop_index[shops[near]], distance[near]
+        order = numpy.lexsort((shops, rows))
+        return rows[order], shops[order], distance[order]
+
+
+def haversine(latitude1: 'numpy.ndarray', longitude1: 'numpy.ndarray', latitude2: 'numpy.ndarray',
+              longitude2: 'numpy.ndarray') -> 'numpy.ndarray':
+    """
+    二点間の大円距離(メートル)を求める
+
+    Parameters
+    ----------
+    latitude1: numpy.ndarray
+        一点目の緯度
+    longitude1: numpy.ndarray
+        一点目の経度
+    latitude2: numpy.ndarray
+        二点目の緯度
+    longitude2: numpy.ndarray
+        二点目の経度
+
+    Returns
+    -------
+    numpy.ndarray
+        距離(メートル)
+    """
+    latitude1, longitude1 = numpy.radians(latitude1), numpy.radians(longitude1)
+    latitude2, longitude2 = numpy.radians(latitude2), numpy.radians(longitude2)
+    a = numpy.sin((latitude2 - latitude1) / 2) ** 2 \
+        + numpy.cos(latitude1) * numpy.cos(latitude2) * numpy.sin((longitude2 - longitude1) / 2) ** 2
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+def parse_shops(data: bytes, radius: float) -> ShopIndex:
+    """
+    "店舗内部ID,緯度,経度\\n"のCSVから、店舗のインデックスを作成する
+
+    Parameters
+    ----------
+    data: bytes
+        CSVの内容
+    radius: float
+        突き合わせる距離(メートル)
+
+    Returns
+    -------
+    ShopIndex
+        店舗のインデックス
+
+    Raises
+    ------
+    ValueError
+        CSVの形式が不正
+    """
+    if numpy is None:
+        raise ValueError('numpy is not installed')
+    rows = [x.split(b',') for x in data.split(b'\n') if x.strip() != b'']
+    if any([len(x) != 3 for x in rows]):
+        raise ValueError('invalid shop record')
+    return ShopIndex(numpy.array([int(x[0]) for x in rows], dtype=numpy.int64),
+                     numpy.array([float(x[1]) for x in rows], dtype=numpy.float64),
+                     numpy.array([float(x[2]) for x in rows], dtype=numpy.float64), radius)
+
+
+def read_chunks(bucket: str, key: str, chunk_bytes: int) -> Iterator[Union[bytes, 'pyarrow.Table']]:
+    """
+    S3格納用フォルダのオブジェクトを、突き合わせの単位(チャンク)に分けて読み込む
+
+    Parameters
+    ----------
+    bucket: str
+        オブジェクトが格納されているバケット名
+    key: str
+        オブジェクトのキー
+    chunk_bytes: int
+        gzip圧縮したCSVを分けるチャンクの、展開後のサイズ
+
+    Returns
+    -------
+    Iterator[Union[bytes, pyarrow.Table]]
+        gzip圧縮したCSVは、行の区切りで分けた"ユーザID,緯度,経度,タイムスタンプ\\n"のテキスト
+        Parquetは、row group毎のテーブル
+    """
+    if retrieve_request.pyarrow is None:
+        raise ValueError('pyarrow is not installed')
+    body = s3.get_object(Bucket=bucket, Key=key)['Body']
+    if key.endswith('.parquet'):
+        parquet_file = retrieve_request.pyarrow.parquet.ParquetFile(io.BytesIO(body.read()))
+        for i in range(parquet_file.num_row_groups):
+            yield parquet_file.read_row_group(i)
+        return
+
+    rest = b''
+    with gzip.GzipFile(fileobj=body, mode='rb') as fin:  # gzipのメンバーが連結されたものも読み込める
+        for data in iter(lambda: fin.read(chunk_bytes), b''):
+            data = rest + data
+            end = data.rfind(b'\n') + 1
+            rest = data[end:]
+            if end > 0:
+                yield data[:end]
+    if rest != b'':  # 最終行に改行が無い場合
+        yield rest + b'\n'
+
+
+def match_chunk(chunk: Union[bytes, 'pyarrow.Table'], shops: ShopIndex = None) -> Tuple[bytes, int]:
+    """
+    チャンク(read_chunksの結果)のレコードと店舗を突き合わせ、結果をgzipの一つのメンバーとして圧縮する
+    プロセスプールで実行する場合は、init_workerで受け取った店舗のインデックスを使う
+
+    Parameters
+    ----------
+    chunk: Union[bytes, pyarrow.Table]
+        "ユーザID,緯度,経度,タイムスタンプ\\n"のテキスト, またはParquetから読み込んだテーブル
+    shops: ShopIndex
+        店舗のインデックス。Noneの場合はinit_workerで受け取ったもの
+
+    Returns
+    -------
+    bytes, int
+        gzip圧縮した"ユーザID,店舗内部ID,タイムスタンプ,距離(メートル)\\n"のテキスト, レコード数
+    """
+    if retrieve_request.pyarrow is None:
+        raise ValueError('pyarrow is not installed')
+    shops = _worker_shops if shops is None else shops
+    table = retrieve_request.parse_parquet_rows(chunk) if isinstance(chunk, bytes) else chunk
+
+    rows, shop_index, distance = shops.match(table.column('latitude').to_numpy(zero_copy_only=False),
+                                             table.column('longitude').to_numpy(zero_copy_only=False))
+    user_id = table.column('user_id').take(rows).to_pylist()
+    created_at = table.column('created_at').take(rows).to_pylist()
+    text = ''.join(['{0},{1},{2},{3:.1f}\n'.format(*x)
+                    for x in zip(user_id, shop_index.tolist(), created_at, distance.tolist())])
+
+    compressor = zlib.compressobj(wbits=31)  # gzip形式
+    return compressor.compress(bytes(text, 'ascii')) + compressor.flush(), len(rows)
+
+
+def init_worker(shops: ShopIndex) -> None:
+    """
+    プロセスプールの各プロセスの初期化。店舗のインデックスを受け取る
+    """
+    global _worker_shops
+    _worker_shops = shops
+
+
+def map_chunks(chunks: Iterable[Union[bytes, 'pyarrow.Table']], shops: ShopIndex,
+               processes: int) -> Iterator[Tuple[bytes, int]]:
+    """
+    チャンク毎の突き合わせ(match_chunk)を、プロセスプールで並行して実行する
+    読み込み済みで結果を待つチャンクがprocesses * 2個を超えないように、順に投入する
+
+    Parameters
+    ----------
+    chunks: Iterable[Union[bytes, pyarrow.Table]]
+        チャンク (read_chunksの結果)
+    shops: ShopIndex
+        店舗のインデックス
+    processes: int
+        プロセス数。0なら同じプロセスで順に実行する
+
+    Returns
+    -------
+    Iterator[Tuple[bytes, int]]
+        chunksの順の、match_chunkの結果
+    """
+    if processes == 0:
+        for chunk in chunks:
+            yield match_chunk(chunk, shops)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=init_worker,
+                                                initargs=(shops,)) as executor:
+        futures = collections.deque()
+        for chunk in chunks:
+            futures.append(executor.submit(match_chunk, chunk))
+            while len(futures) >= processes * 2:
+                yield futures.popleft().result()
+        while len(futures) > 0:
+            yield futures.popleft().result()
+
+
+def match_partition(ymd: str, bucket: str, folder_parted: str, output_key: str, shops: ShopIndex, processes: int,
+                    part_size: int, chunk_bytes: int = int(DEFAULT_MATCH_CHUNK_BYTES)) -> int:
+    """
+    指定日のパーティション内の全オブジェクトを店舗と突き合わせ、一つのオブジェクトとして書き出す
+
+    Parameters
+    ----------
+    ymd: str
+        該当日となる年月日 (YYYYMMDD)
+    bucket: str
+        S3格納用フォルダのバケット名 (結果も同じバケットに書き出す)
+    folder_parted: str
+        S3格納用フォルダのprefix
+    output_key: str
+        結果を書き出すオブジェクトのキー
+    shops: ShopIndex
+        店舗のインデックス
+    processes: int
+        プロセス数
+    part_size: int
+        マルチパートアップロードの一パートのサイズ
+    chunk_bytes: int
+        gzip圧縮したCSVを分けるチャンクの、展開後のサイズ
+
+    Returns
+    -------
+    int
+        書き出したレコード数
+    """
+    keys = collect_request.list_parted_file(bucket, folder_parted + 'created_date=' + ymd + '/')
+    chunks = (chunk for key in keys for chunk in read_chunks(bucket, key, chunk_bytes))
+    upload = MultipartUpload(bucket, output_key, part_size)
+    records = 0
+    try:
+        for member, count in map_chunks(chunks, shops, processes):
+            if count > 0:  # gzipのメンバーを連結したものも、一つのgzipファイルとして読み込める
+                upload.write(member)
+                records += count
+        upload.close()
+    except Exception:
+        upload.abort()
+        raise
+
+    return records
+
+
+def main(ymd_list: List[str]) -> str:
+    """
+    メイン
+
+    Parameters
+    ----------
+    ymd_list: List[str]
+        対象となる年月日 (YYYYMMDD) の一覧
+
+    Returns
+    -------
+    str
+        "success" or "error"
+    """
+    bucket = os.environ.get('BUCKET_LOCATION', DEFAULT_BUCKET_LOCATION)
+    folder_parted = retrieve_request.get_parted_location()[0]  # OUTPUT_FORMATによって既定値が異なる
+    folder_match = os.environ.get('FOLDER_MATCH', DEFAULT_FOLDER_MATCH)
+    shop_key = os.environ.get('SHOP_KEY', DEFAULT_SHOP_KEY)
+    radius = float(os.environ.get('MATCH_RADIUS', DEFAULT_MATCH_RADIUS))
+    processes = int(os.environ.get('MATCH_PROCESSES', DEFAULT_MATCH_PROCESSES))
+    part_size = int(os.environ.get('UPLOAD_PART_SIZE', DEFAULT_UPLOAD_PART_SIZE))
+    chunk_bytes = int(os.environ.get('MATCH_CHUNK_BYTES', DEFAULT_MATCH_CHUNK_BYTES))
+
+    try:
+        logger.info('start.')
+        shops = parse_shops(s3.get_object(Bucket=bucket, Key=shop_key)['Body'].read(), radius)
+        for ymd in ymd_list:
+            start = time.time()
+            records = match_partition(ymd, bucket, folder_parted, folder_match + ymd + '.csv.gz', shops,
+                                      processes, part_size, chunk_bytes)
+            logger.info('{0}: {1} records matched ({2:.1f}s)'.format(ymd, records, time.time() - start))
+
+        logger.info('finished.')
+        return 'success'
+    except Exception as e:
+        logger.error(e)
+
+    return 'error'
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 1:  # 引数なしの場合は昨日のデータ
+        local_time = time.time() + tz
+        local_yesterday_base_time = local_time - (local_time % (60 * 60 * 24)) - (60 * 60 * 24)
+        ymd_str_list = [datetime.datetime.utcfromtimestamp(local_yesterday_base_time).strftime('%Y%m%d')]
+    else:
+        ymd_str_list = collect_request.parse_ymd_args(sys.argv[1:])
+
+    main(ymd_str_list)
@@ -8,8 +8,7 @@ fi
 
 cd "$(dirname $0)" || exit
 
-python3 retrieve_request.py
-
-python3 collect_request.py "${TARGET}"
+# retrieve_request, compact_partition, collect_requestを一つのプロセスで実行する
+python3 run_pipeline.py "${TARGET}"
 
 # aws lambda invoke --function-name stop-collect-server /dev/null
\ No newline at end of file
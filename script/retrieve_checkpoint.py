@@ -0,0 +1,211 @@
+# coding=utf-8
+
+"""
+retrieve_requestで使用する、処理の進行状況(チェックポイント)の記録
+作業用フォルダ(work/)のオブジェクトを一定数毎のバッチで処理し、バッチ毎に以下の状態をS3のJSONに記録する
+
+  started    処理を開始した。書き出したオブジェクトはまだ参照できない
+  uploading  書き出すオブジェクト(outputs)を確定し、完成させている途中。一部は参照できる状態になっている
+  committed  すべてのoutputsが完成した。元のオブジェクト(inputs)を削除している途中
+
+中断後に再実行した場合は、記録に従って以下のように回復するので、各オブジェクトはちょうど一度だけ処理される
+  started    何もしない (inputsは残っているので、再度処理される)
+  uploading  outputsを削除する (inputsは残っているので、再度処理される)
+  committed  残っているinputsを削除する
+"""
+
+import concurrent.futures
+import json
+import logging
+import time
+import botocore.exceptions
+from typing import Any, Dict, List
+
+logger = logging.getLogger()
+
+STATE_STARTED = 'started'
+STATE_UPLOADING = 'uploading'
+STATE_COMMITTED = 'committed'
+HISTORY_SIZE = 24   # 記録しておく完了済みバッチの数
+DELETE_BATCH_SIZE = 1000  # delete_objectsは一度に1000件まで
+
+
+class Checkpoint:
+    """
+    S3のJSONオブジェクトに記録するチェックポイント
+    {"batch": 処理中のバッチ or null, "history": [完了したバッチ]}
+    バッチは {"id": バッチID, "state": 状態, "inputs": [元のキー], "outputs": [書き出したキー]}
+    """
+
+    def __init__(self, s3: Any, bucket: str, key: str) -> None:
+        """
+        Parameters
+        ----------
+        s3: Any
+            S3クライアント
+        bucket: str
+            チェックポイントを保存するバケット名
+        key: str
+            チェックポイントのキー
+        """
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.batch = None
+        self.history = list()
+
+    def load(self) -> None:
+        """
+        S3から読み込む。存在しない場合は空の状態とする
+        """
+        try:
+            data = json.loads(self.s3.get_object(Bucket=self.bucket, Key=self.key)['Body'].read())
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            data = dict()
+        self.batch = data.get('batch')
+        self.history = data.get('history', [])
+
+    def save(self) -> None:
+        """
+        S3に保存する
+        """
+        body = json.dumps({'batch': self.batch, 'history': self.history[-HISTORY_SIZE:]})
+        self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(body, 'utf-8'))
+
+    def recover(self) -> None:
+        """
+        中断したバッチがあれば、記録された状態に従って回復する
+        """
+        self.load()
+        if self.batch is None:
+            return
+
+        state = self.batch['state']
+        logger.info('recover batch {0} ({1})'.format(self.batch['id'], state))
+        if state == STATE_UPLOADING:
+            delete_keys(self.s3, self.bucket, self.batch['outputs'])
+        elif state == STATE_COMMITTED:
+            delete_keys(self.s3, self.bucket, self.batch['inputs'])
+            self.history.append(self._summary())
+        self.batch = None
+        self.save()
+
+    def begin(self, batch_id: str, inputs: List[str]) -> None:
+        """
+        バッチの処理を開始する
+
+        Parameters
+        ----------
+        batch_id: str
+            バッチID。書き出すオブジェクトの名前に使用する
+        inputs: List[str]
+            処理する作業用フォルダのオブジェクトのキー
+        """
+        self.batch = {'id': batch_id, 'state': STATE_STARTED, 'inputs': inputs, 'outputs': [],
+                      'started_at': int(time.time())}
+        self.save()
+
+    def uploading(self, outputs: List[str]) -> None:
+        """
+        書き出すオブジェクトを確定する。この後、オブジェクトを完成させる
+
+        Parameters
+        ----------
+        outputs: List[str]
+            書き出すオブジェクトのキー
+        """
+        self.batch['state'] = STATE_UPLOADING
+        self.batch['outputs'] = outputs
+        self.save()
+
+    def commit(self) -> None:
+        """
+        すべてのオブジェクトが完成したことを記録する。この後、元のオブジェクトを削除する
+        """
+        self.batch['state'] = STATE_COMMITTED
+        self.save()
+
+    def finish(self) -> None:
+        """
+        元のオブジェクトの削除が完了したことを記録する
+        """
+        self.history.append(self._summary())
+        self.batch = None
+        self.save()
+
+    def _summary(self) -> Dict[str, Any]:
+        """
+        完了したバッチの記録
+        """
+        return {'id': self.batch['id'], 'inputs': self.batch['inputs'], 'outputs': self.batch['outputs'],
+                'finished_at': int(time.time())}
+
+
+def try_delete_keys(s3: Any, bucket: str, keys: List[str], workers: int = 1) -> Dict[str, str]:
+    """
+    オブジェクトをDELETE_BATCH_SIZE件ずつまとめて削除する。存在しないオブジェクトは無視する
+    削除できなかったオブジェクトがあっても中断せず、残りの削除を続ける
+
+    Parameters
+    ----------
+    s3: Any
+        S3クライアント
+    bucket: str
+        オブジェクトが格納されているバケット名
+    keys: List[str]
+        削除するオブジェクトのキー
+    workers: int
+        同時に実行するdelete_objectsの数
+
+    Returns
+    -------
+    Dict[str, str]
+        削除できなかったオブジェクトのキーと、その理由
+    """
+    def delete_batch(batch: List[str]) -> Dict[str, str]:
+        try:
+            response = s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': x} for x in batch], 'Quiet': True})
+        except botocore.exceptions.ClientError as e:  # バッチ全体が失敗した場合は、すべてのキーについて記録する
+            return dict([(x, str(e)) for x in batch])
+        return dict([(x['Key'], '{0}: {1}'.format(x.get('Code'), x.get('Message'))) for x in response.get('Errors', [])])
+
+    batches = [keys[i:i + DELETE_BATCH_SIZE] for i in range(0, len(keys), DELETE_BATCH_SIZE)]
+    failures = dict()
+    if workers <= 1 or len(batches) <= 1:
+        for batch in batches:
+            failures.update(delete_batch(batch))
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(delete_batch, batches):
+                failures.update(result)
+
+    for key, reason in failures.items():
+        logger.error('delete failed: {0} ({1})'.format(key, reason))
+    return failures
+
+
+def delete_keys(s3: Any, bucket: str, keys: List[str], workers: int = 1) -> None:
+    """
+    オブジェクトをまとめて削除する。存在しないオブジェクトは無視する
+
+    Parameters
+    ----------
+    s3: Any
+        S3クライアント
+    bucket: str
+        オブジェクトが格納されているバケット名
+    keys: List[str]
+        削除するオブジェクトのキー
+    workers: int
+        同時に実行するdelete_objectsの数
+
+    Raises
+    ------
+    RuntimeError
+        削除できなかったオブジェクトがある
+    """
+    failures = try_delete_keys(s3, bucket, keys, workers)
+    if len(failures) > 0:
+        raise RuntimeError('delete failed: {} objects'.format(len(failures)))
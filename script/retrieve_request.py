@@ -4,24 +4,59 @@
 S3作業用フォルダ(s3://..../work)にあるオブジェクトを読み込み、日付毎に振り分ける。
 振り分けた結果は、S3格納用フォルダ(s3://..../parted)に書き出される。
 ただし、このプログラムを実行した当日のデータは一時保管用フォルダに戻されて、翌日以降に書き出される。
+store_requestが日付毎に振り分けたオブジェクト(s3://..../work/created_date=YYYYMMDD/)は、
+当日以降の日付のものは読み込まずに残し、翌日以降に処理する。
+S3格納用フォルダにはgzip圧縮したCSVを書き出すが、OUTPUT_FORMAT=parquetの場合はParquet形式で書き出す。
+(Spectrumのテーブルは形式毎に分ける。redshift/ddl.sql参照)
+TILE_PRECISIONを指定すると、同じレコードをgeohashのタイル毎にまとめたものとインデックスを、
+タイル用フォルダ(s3://..../tiles)にも書き出す。(geohash_tile参照)
 
 なお、全体の処理手順は以下の通り
 parse_request  ->  store_request  ->  [retrieve_request]  -> collect_request
 """
 
+import array
 import boto3
+import collections
+import io
+import json
 import logging
 import tempfile
+import threading
+import concurrent.futures
 import os
 import datetime
 import time
+import zlib
 import smart_open
 import gzip
+import heapq
 import shutil
 import psycopg2
 import psycopg2.extensions
-from typing import Dict, List, BinaryIO, Type
-from get_connection_string import get_connection_string
+import psycopg2.pool
+import sys
+from typing import Callable, Dict, Iterable, List, BinaryIO, Optional, Set, Tuple, Type
+from get_connection_string import connect
+from retrieve_checkpoint import Checkpoint, try_delete_keys
+import geohash_tile
+
+try:
+    import numpy
+except ImportError:  # SPLIT_MODE=numpyを使用しない環境
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.csv
+    import pyarrow.parquet
+except ImportError:  # OUTPUT_FORMAT=parquetを使用しない環境
+    pyarrow = None
+
+# 作業用フォルダのオブジェクト形式は、書き出し側のstore_request(lambda)と共通のモジュールを使用する
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+import work_file  # noqa: E402
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -30,14 +65,56 @@ DEFAULT_BUCKET_LOCATION = 'me32as8cme32as8c-task3-location'
 DEFAULT_FOLDER_WORK = 'work/'
 DEFAULT_FOLDER_PARTED = 'parted/'
 DEFAULT_TABLE_LOCATION = 'spectrum.location'
+DEFAULT_FOLDER_PARTED_PARQUET = 'parted_parquet/'    # OUTPUT_FORMAT=parquetの場合のFOLDER_PARTEDの既定値
+DEFAULT_TABLE_LOCATION_PARQUET = 'spectrum.location_parquet'  # OUTPUT_FORMAT=parquetの場合のTABLE_LOCATIONの既定値
+DEFAULT_FETCH_WORKERS = '8'                          # 作業用フォルダのオブジェクトを並列に取得するスレッド数 (1なら逐次処理)
+DEFAULT_FETCH_QUEUE_SIZE = '16'                      # 取得済みで振り分け待ちのオブジェクト数の上限
+DEFAULT_FETCH_MAX_BYTES = str(256 * 1024 * 1024)     # 取得済みで振り分け待ちのオブジェクトの合計サイズの上限
+DEFAULT_SPLIT_MODE = 'line'                          # 振り分け方法 (SPLIT_MODES参照)
+DEFAULT_SPLIT_PROCESSES = '0'                        # 振り分けを行うプロセス数 (0なら取得と同じプロセスで行う)
+DEFAULT_STREAM_UPLOAD = '1'                          # 日付毎のデータを一時ファイルを介さずに圧縮しながらアップロードするかどうか
+DEFAULT_UPLOAD_PART_SIZE = str(8 * 1024 * 1024)      # 圧縮しながらアップロードする場合の、マルチパートアップロードの一パートのサイズ
+DEFAULT_LIST_WORKERS = '8'                           # 作業用フォルダの一覧をサブフォルダ毎に並列に取得するスレッド数 (1なら逐次処理)
+DEFAULT_DELETE_WORKERS = '4'                         # 処理済みのオブジェクトを並列に削除するスレッド数
+DEFAULT_CHECKPOINT_KEY = 'checkpoint/retrieve_request.json'  # 処理の進行状況を記録するオブジェクト (作業用フォルダの外に置く)
+DEFAULT_BATCH_SIZE = '1000'                          # 一度に処理する作業用フォルダのオブジェクト数
+DEFAULT_PARTITION_CACHE_FILE = os.path.expanduser('~/.retrieve_request_partitions')  # 登録済みのpartitionの記録 (空なら記録しない)
+DEFAULT_OUTPUT_FORMAT = 'csv.gz'                     # S3格納用フォルダに書き出す形式 (OUTPUT_FORMATS参照)
+DEFAULT_PARQUET_ROW_GROUP_ROWS = '1000000'           # Parquetのrow group一つあたりの行数
+DEFAULT_PARQUET_COMPRESSION = 'snappy'               # Parquetの圧縮形式
+DEFAULT_FOLDER_TILES = 'tiles/'                      # geohashのタイル毎にまとめたレコードを書き出すフォルダ
+DEFAULT_TILE_PRECISION = '0'                         # タイルとするgeohashの文字数 (0ならタイルを書き出さない)
+DEFAULT_TILE_BUFFER_BYTES = str(16 * 1024 * 1024)    # タイル毎にまとめる前のレコード行を、一時ファイルに書き出すまでに溜めるサイズ
+
+MAX_PARTITIONS_PER_ALTER = 100  # 一度のALTER TABLE ADD PARTITIONで追加できるpartitionの数 (Redshiftの上限)
+
+SPLIT_MODE_LINE = 'line'      # 1行毎にget_timestamp_and_bufferで解析する (従来の方法)
+SPLIT_MODE_BYTES = 'bytes'    # オブジェクト全体をbyte列のまま解析する
+SPLIT_MODE_NUMPY = 'numpy'    # オブジェクト全体をNumPyの配列演算で解析する (numpyパッケージが必要)
+SPLIT_MODES = (SPLIT_MODE_LINE, SPLIT_MODE_BYTES, SPLIT_MODE_NUMPY)
+MAX_TIMESTAMP_DIGITS = 18     # SPLIT_MODE_NUMPYで配列演算するタイムスタンプの最大桁数 (int64に収まる範囲)
+
+OUTPUT_FORMAT_CSV = 'csv.gz'       # gzip圧縮したCSV (spectrum.location)
+OUTPUT_FORMAT_PARQUET = 'parquet'  # Parquet (spectrum.location_parquet, pyarrowパッケージが必要)
+OUTPUT_FORMATS = (OUTPUT_FORMAT_CSV, OUTPUT_FORMAT_PARQUET)
+FLOAT_PATTERN = r'^[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?$'  # 数値として読める緯度・経度
+
+if pyarrow is not None:
+    PARQUET_SCHEMA = pyarrow.schema([('user_id', pyarrow.string()),
+                                     ('latitude', pyarrow.float64()),
+                                     ('longitude', pyarrow.float64()),
+                                     ('created_at', pyarrow.int32())])
+STRIP_CHARS = b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f'  # ASCIIの範囲でstr.strip()が取り除く文字
 
 s3 = boto3.client('s3')
 tz = 9 * 60 * 60   # JST(+9:00)
 
 
-def list_location_file(bucket: str, prefix: str) -> List[str]:
+def list_location_file(bucket: str, prefix: str, workers: int = 1) -> List[str]:
     """
     作業用フォルダ(S3)のファイル一覧を取得する
+    workersが2以上の場合は、直下のファイルとサブフォルダ(created_date=YYYYMMDD/など)の一覧を取得した後、
+    サブフォルダ毎の一覧を並列に取得する
 
     Parameters
     ----------
@@ -45,6 +122,8 @@ def list_location_file(bucket: str, prefix: str) -> List[str]:
         オブジェクトを書き込むS3バケット
     prefix: str
         オブジェクトのprefix
+    workers: int
+        並列に一覧を取得するスレッド数
 
     Returns
     ------
@@ -53,18 +132,58 @@ def list_location_file(bucket: str, prefix: str) -> List[str]:
         (例) "work/123456.csv"
     """
     result = []
+    if workers > 1:
+        sub_prefixes = []
+        paginator = s3.get_paginator('list_objects_v2')
+        for response in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+            result.extend([x['Key'] for x in response.get('Contents', []) if x['Key'] != prefix])
+            sub_prefixes.extend([x['Prefix'] for x in response.get('CommonPrefixes', [])])
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for keys in executor.map(lambda x: list_location_file(bucket, x), sub_prefixes):
+                result.extend(keys)
+        return result
 
     # フォルダ以下のファイル一覧を取得
     response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
 
     # フォルダ自身以外を一覧を追加
-    result.extend([x['Key'] for x in response['Contents'] if x['Key'] != prefix])
+    result.extend([x['Key'] for x in response.get('Contents', []) if x['Key'] != prefix])
 
     # 一度で取りきれなかった場合、取れなくなるまで繰り返す
     while 'NextContinuationToken' in response:
         token = response['NextContinuationToken']
         response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix, ContinuationToken=token)
-        result.extend([x['Key'] for x in response['Contents'] if x['Key'] != prefix])
+        result.extend([x['Key'] for x in response.get('Contents', []) if x['Key'] != prefix])
+
+    return result
+
+
+def select_closed_file(file_list: List[str], today: str) -> List[str]:
+    """
+    ファイル一覧から、処理対象のファイルを選択する
+    日付毎に振り分けられたファイルは、前日までの日付のもののみを対象とする
+
+    Parameters
+    ----------
+    file_list: List[str]
+        ファイル名の文字列一覧。
+        (例) "work/created_date=20190901/1566624557-0000.csv.gz"
+    today: str
+        当日の日付の文字列(YYYYMMDD)
+
+    Returns
+    ------
+    List[str]
+        処理対象のファイル名の文字列一覧。
+    """
+    result = []
+    for file in file_list:
+        if file.endswith('/'):  # フォルダ
+            continue
+        date_str = work_file.get_partition_date(file)
+        if date_str is None or date_str < today:
+            result.append(file)
 
     return result
 
@@ -89,16 +208,19 @@ def get_base_time(unix_time: int) -> int:
     return local_base_time - tz
 
 
-def separate_location(file: str, temporary_file_dict: Dict[int, BinaryIO], bucket: str) -> dict:
+def separate_location(file: str, temporary_file_dict: Dict[int, BinaryIO], bucket: str,
+                      open_sink: Callable[[int], BinaryIO] = None) -> dict:
     """
     レコードの基準時間毎に、保管用一時ファイルに振り分ける
 
     Parameters
     ----------
     file: str
-        ファイル名 (例: 'work/1566624557.csv')
+        ファイル名 (例: 'work/1566624557.csv')。形式は拡張子で判別する (work_file参照)
     temporary_file_dict: Dict[int, BinaryIO]
         作成されたtempfile.NamedTemporaryFileを保管するdict
+    open_sink: Callable[[int], BinaryIO]
+        基準時間を受け取り、その日の書き込み先を作成する関数。Noneの場合はtempfile.NamedTemporaryFileを作成する
     bucket: str
         オブジェクトを書き込むS3バケット
 
@@ -107,16 +229,834 @@ def separate_location(file: str, temporary_file_dict: Dict[int, BinaryIO], bucke
     Dict[int, BinaryIO]
         作成されたtempfile.NamedTemporaryFileを保管するdict
     """
-    with smart_open.open('s3://' + bucket + '/' + file, 'rb') as fd:
-        for line in fd:
-            timestamp, buffer = get_timestamp_and_buffer(line)
-            if timestamp > 0:                                   # 正常行か?
-                base_time = get_base_time(timestamp)
-                if base_time not in temporary_file_dict:
-                    temporary_file_dict[base_time] = tempfile.NamedTemporaryFile(delete=False)
+    fmt = work_file.get_format(file)
+    with smart_open.open('s3://' + bucket + '/' + file, 'rb', compression='disable') as fd:
+        return separate_lines(work_file.iter_lines(fd, fmt), temporary_file_dict, open_sink)
+
+
+def separate_lines(lines: Iterable[bytes], temporary_file_dict: Dict[int, BinaryIO],
+                   open_sink: Callable[[int], BinaryIO] = None) -> dict:
+    """
+    レコード行を基準時間毎に、保管用一時ファイルに振り分ける
+
+    Parameters
+    ----------
+    lines: Iterable[bytes]
+        レコード行のbyte列
+    temporary_file_dict: Dict[int, BinaryIO]
+        作成されたtempfile.NamedTemporaryFileを保管するdict
+    open_sink: Callable[[int], BinaryIO]
+        基準時間を受け取り、その日の書き込み先を作成する関数。Noneの場合はtempfile.NamedTemporaryFileを作成する
+
+    Returns
+    -------
+    Dict[int, BinaryIO]
+        作成されたtempfile.NamedTemporaryFileを保管するdict
+    """
+    for line in lines:
+        timestamp, buffer = get_timestamp_and_buffer(line)
+        if timestamp > 0:                                   # 正常行か?
+            base_time = get_base_time(timestamp)
+            if base_time not in temporary_file_dict:
+                temporary_file_dict[base_time] = open_temporary_file(base_time, open_sink)
+
+            temp_file = temporary_file_dict[base_time]
+            temp_file.write(buffer)
+
+    return temporary_file_dict
+
+
+def open_temporary_file(base_time: int, open_sink: Callable[[int], BinaryIO] = None) -> BinaryIO:
+    """
+    基準時間の日の書き込み先を作成する
+
+    Parameters
+    ----------
+    base_time: int
+        基準時間
+    open_sink: Callable[[int], BinaryIO]
+        基準時間を受け取り、その日の書き込み先を作成する関数。Noneの場合はtempfile.NamedTemporaryFileを作成する
+
+    Returns
+    -------
+    BinaryIO
+        書き込み先
+    """
+    if open_sink is None:
+        return tempfile.NamedTemporaryFile(delete=False)
+    return open_sink(base_time)
+
+
+class MultipartUpload:
+    """
+    書き込まれたデータをS3にマルチパートアップロードするファイル風オブジェクト
+    データがpart_sizeに達した分から送信するため、メモリ使用量はpart_size程度となる
+    オブジェクトはclose()で完成し、それまでは(マルチパートアップロードの途中なので)参照できない
+    """
+
+    def __init__(self, bucket: str, key: str, part_size: int) -> None:
+        """
+        Parameters
+        ----------
+        bucket: str
+            オブジェクトを格納するバケット名
+        key: str
+            オブジェクトのキー
+        part_size: int
+            マルチパートアップロードの一パートのサイズ (5MB以上)
+        """
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = list()
+        self.position = 0
+        self.closed = False
+
+    def write(self, data: bytes) -> int:
+        """
+        データを書き込む
+        """
+        self.buffer += data
+        self.position += len(data)
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def tell(self) -> int:
+        """
+        書き込んだデータのサイズ
+        """
+        return self.position
+
+    def flush(self) -> None:
+        pass
+
+    def _upload_part(self) -> None:
+        """
+        バッファのデータを、マルチパートアップロードの一パートとして送信する
+        """
+        if self.upload_id is None:
+            self.upload_id = s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        part_number = len(self.parts) + 1
+        response = s3.upload_part(Bucket=self.bucket, Key=self.key, PartNumber=part_number,
+                                  UploadId=self.upload_id, Body=bytes(self.buffer))
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = bytearray()
+
+    def close(self) -> None:
+        """
+        オブジェクトを完成させる
+        """
+        if self.closed:
+            return
+        if self.upload_id is None:
+            s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+        else:
+            self._upload_part()
+            s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                         MultipartUpload={'Parts': self.parts})
+        self.buffer = bytearray()
+        self.closed = True
+
+    def abort(self) -> None:
+        """
+        書き込みを中止する。送信済みのパートは破棄される
+        """
+        if self.closed:
+            return
+        if self.upload_id is not None:
+            s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        self.buffer = bytearray()
+        self.closed = True
+
+
+class GzipUploadSink:
+    """
+    書き込まれたデータをgzip圧縮しながら、S3にマルチパートアップロードする書き込み先
+    ローカルディスクを使用せず、メモリ使用量も一日あたりpart_size程度となる
+    """
+
+    def __init__(self, bucket: str, key: str, part_size: int) -> None:
+        """
+        Parameters
+        ----------
+        bucket: str
+            オブジェクトを格納するバケット名
+        key: str
+            オブジェクトのキー
+        part_size: int
+            マルチパートアップロードの一パートのサイズ (5MB以上)
+        """
+        self.upload = MultipartUpload(bucket, key, part_size)
+        self.compressor = zlib.compressobj(wbits=31)  # gzip形式
+
+    @property
+    def parts(self) -> List[dict]:
+        return self.upload.parts
+
+    def write(self, data: bytes) -> int:
+        """
+        データを圧縮して書き込む
+        """
+        self.upload.write(self.compressor.compress(data))
+        return len(data)
+
+    def close(self) -> None:
+        """
+        オブジェクトを完成させる
+        """
+        if not self.upload.closed:
+            self.upload.write(self.compressor.flush())
+            self.upload.close()
+
+    def abort(self) -> None:
+        """
+        書き込みを中止する
+        """
+        self.upload.abort()
+
+
+class ParquetUploadSink:
+    """
+    書き込まれたレコード行("ユーザID,緯度,経度,タイムスタンプ\\n")をParquet形式に変換しながら、
+    S3にマルチパートアップロードする書き込み先
+    row_group_rows行毎に一つのrow groupとして書き出すので、メモリ使用量は一日あたりrow_group_rows行分程度となる
+    user_idは辞書エンコーディングする
+    """
+
+    def __init__(self, bucket: str, key: str, part_size: int, row_group_rows: int,
+                 compression: str = DEFAULT_PARQUET_COMPRESSION) -> None:
+        """
+        Parameters
+        ----------
+        bucket: str
+            オブジェクトを格納するバケット名
+        key: str
+            オブジェクトのキー
+        part_size: int
+            マルチパートアップロードの一パートのサイズ (5MB以上)
+        row_group_rows: int
+            一つのrow groupの行数
+        compression: str
+            Parquetの圧縮形式 ('snappy', 'gzip'など)
+        """
+        if pyarrow is None:
+            raise ValueError('pyarrow is not installed')
+        self.upload = MultipartUpload(bucket, key, part_size)
+        self.row_group_rows = row_group_rows
+        self.writer = pyarrow.parquet.ParquetWriter(self.upload, PARQUET_SCHEMA, compression=compression,
+                                                    use_dictionary=['user_id'])
+        self.lines = list()
+        self.rows = 0
+
+    def write(self, data: bytes) -> int:
+        """
+        レコード行(改行付き、複数行可)を書き込む
+        """
+        self.lines.append(data)
+        self.rows += data.count(b'\n')
+        if self.rows >= self.row_group_rows:
+            self._write_row_group()
+        return len(data)
+
+    def _write_row_group(self) -> None:
+        """
+        溜まったレコード行を一つのrow groupとして書き出す
+        """
+        if self.rows > 0:
+            self.writer.write_table(parse_parquet_rows(b''.join(self.lines)), row_group_size=self.rows)
+        self.lines = list()
+        self.rows = 0
+
+    def close(self) -> None:
+        """
+        オブジェクトを完成させる
+        """
+        if not self.upload.closed:
+            self._write_row_group()
+            self.writer.close()
+            self.upload.close()
+
+    def abort(self) -> None:
+        """
+        書き込みを中止する
+        """
+        self.upload.abort()
+
+
+class TileUploadSink:
+    """
+    書き込まれたレコード行を別の書き込み先(sink)に渡しながら、geohashのタイル毎にまとめてgzip圧縮し、
+    close()でタイル順に並べたオブジェクトと、そのインデックスを書き出す書き込み先 (geohash_tile参照)
+    タイル数に比例してメモリを使わないよう、未圧縮のレコード行がbuffer_bytesに達したら、タイル順に並べて
+    タイル毎に圧縮し、一時ファイルに書き出す(ラン)。close()では各ランをタイル順にマージしながら連結する
+    (一つのタイルは、ランの数までのgzipメンバーが連続した範囲となる)
+    メモリに残るのは、ラン毎のタイルの位置(1タイルあたり十数バイト)と、書き出し中のインデックスのテキストのみ
+    """
+
+    def __init__(self, sink: BinaryIO, bucket: str, key: str, index_key: str, precision: int, part_size: int,
+                 buffer_bytes: int = int(DEFAULT_TILE_BUFFER_BYTES)) -> None:
+        """
+        Parameters
+        ----------
+        sink: BinaryIO
+            同じレコード行を書き込む書き込み先 (GzipUploadSink, ParquetUploadSink)
+        bucket: str
+            オブジェクトを格納するバケット名
+        key: str
+            タイル順に並べたオブジェクトのキー
+        index_key: str
+            インデックスのキー
+        precision: int
+            タイルとするgeohashの文字数
+        part_size: int
+            マルチパートアップロードの一パートのサイズ (5MB以上)
+        buffer_bytes: int
+            一時ファイルに書き出すまでに溜める、未圧縮のレコード行のサイズ
+        """
+        self.sink = sink
+        self.bucket = bucket
+        self.key = key
+        self.index_key = index_key
+        self.precision = precision
+        self.buffer_bytes = buffer_bytes
+        self.upload = MultipartUpload(bucket, key, part_size)
+        self.lines = collections.defaultdict(list)  # タイル -> 未圧縮のレコード行
+        self.buffered = 0
+        self.spill_file = None
+        self.runs = list()  # ラン毎の (タイルを連結したもの, 圧縮後のサイズ, レコード数) (タイル順、一時ファイル内で連続する)
+
+    def write(self, data: bytes) -> int:
+        """
+        レコード行(改行付き、複数行可)を書き込む
+        """
+        self.sink.write(data)
+        for line in data.split(b'\n')[:-1]:
+            self.lines[geohash_tile.get_tile(line, self.precision)].append(line)
+        self.buffered += len(data)
+        if self.buffered >= self.buffer_bytes:
+            self._spill()
+        return len(data)
+
+    def _compress_lines(self) -> Iterable[Tuple[str, bytes, int]]:
+        """
+        溜まったレコード行をタイル順に取り出し、タイル毎にgzipのメンバーとして圧縮する
+        """
+        for tile in sorted(self.lines.keys()):
+            tile_lines = self.lines.pop(tile)
+            data = b'\n'.join(tile_lines) + b'\n'
+            # 大半のタイルは数行なので、ウィンドウをデータの大きさに合わせて圧縮器の初期化を軽くする
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + max(9, min(15, len(data).bit_length())))
+            yield tile, compressor.compress(data) + compressor.flush(), len(tile_lines)
+        self.buffered = 0
+
+    def _spill(self) -> None:
+        """
+        溜まったレコード行を、一つのランとして一時ファイルに書き出す
+        """
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile()
+        tiles, sizes, counts = list(), array.array('L'), array.array('L')
+        for tile, member, records in self._compress_lines():
+            self.spill_file.write(member)
+            tiles.append(tile.ljust(self.precision))  # 固定長にして連結する (INVALID_TILEは空白で埋める)
+            sizes.append(len(member))
+            counts.append(records)
+        self.runs.append((''.join(tiles), sizes, counts))
+
+    def _run_tile(self, i: int, j: int) -> str:
+        """
+        i番目のランの、j番目のタイル
+        """
+        return self.runs[i][0][j * self.precision:(j + 1) * self.precision].rstrip()
+
+    def _merge_runs(self) -> Iterable[Tuple[str, bytes, int]]:
+        """
+        タイル順に、(タイル, 圧縮後のデータ, レコード数)を返す。ランがあればマージする
+        """
+        if len(self.runs) == 0:
+            yield from self._compress_lines()
+            return
+
+        self._spill()
+        offsets = list()  # ラン毎の、次に読み込む位置
+        offset = 0
+        for run in self.runs:
+            offsets.append(offset)
+            offset += sum(run[1])
+        heap = [(self._run_tile(i, 0), i, 0) for i, run in enumerate(self.runs) if len(run[1]) > 0]
+        heapq.heapify(heap)
+        while len(heap) > 0:
+            tile = heap[0][0]
+            members, records = list(), 0
+            while len(heap) > 0 and heap[0][0] == tile:  # 同じタイルは書き込んだ順(ランの順)に連結する
+                _, i, j = heapq.heappop(heap)
+                size = self.runs[i][1][j]
+                self.spill_file.seek(offsets[i])
+                members.append(self.spill_file.read(size))
+                offsets[i] += size
+                records += self.runs[i][2][j]
+                if j + 1 < len(self.runs[i][1]):
+                    heapq.heappush(heap, (self._run_tile(i, j + 1), i, j + 1))
+            yield tile, b''.join(members), records
+
+    def _close_spill_file(self) -> None:
+        """
+        一時ファイルを削除する
+        """
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+        self.runs = list()
+        self.lines = collections.defaultdict(list)
+        self.buffered = 0
+
+    def close(self) -> None:
+        """
+        オブジェクトとインデックスを完成させる
+        インデックスはタイル数が多いとdictでは大きくなるため、JSONのテキストとして書き出していく
+        """
+        if self.upload.closed:
+            return
+        self.sink.close()
+
+        index = io.BytesIO()
+        index.write(bytes('{{"key": {0}, "precision": {1}, "tiles": {{'.format(json.dumps(self.key), self.precision),
+                          'utf-8'))
+        total = 0
+        try:
+            for i, (tile, data, records) in enumerate(self._merge_runs()):
+                index.write(bytes('{0}{1}: [{2}, {3}, {4}]'.format(', ' if i > 0 else '', json.dumps(tile),
+                                                                    self.upload.tell(), len(data), records), 'utf-8'))
+                total += records
+                self.upload.write(data)
+        finally:
+            self._close_spill_file()
+        index.write(bytes('}}, "records": {}}}'.format(total), 'utf-8'))
+        self.upload.close()
+        s3.put_object(Bucket=self.bucket, Key=self.index_key, Body=index.getvalue(), ContentType='application/json')
+
+    def abort(self) -> None:
+        """
+        書き込みを中止する
+        """
+        self.sink.abort()
+        self.upload.abort()
+        self._close_spill_file()
+
+
+def parse_parquet_rows(data: bytes) -> 'pyarrow.Table':
+    """
+    振り分け済みのレコード行を、PARQUET_SCHEMAのテーブルに変換する
+    緯度・経度が数値でない場合、タイムスタンプがintegerに収まらない場合はNULLとする (テキスト形式をSpectrumで読んだ場合と同じ)
+
+    Parameters
+    ----------
+    data: bytes
+        "ユーザID,緯度,経度,タイムスタンプ\\n"のレコード列 (振り分け済みなので、フィールド数は4でタイムスタンプは整数)
+
+    Returns
+    -------
+    pyarrow.Table
+        変換後のテーブル
+    """
+    names = [x.name for x in PARQUET_SCHEMA]
+    table = pyarrow.csv.read_csv(
+        io.BytesIO(data),
+        read_options=pyarrow.csv.ReadOptions(column_names=names),
+        parse_options=pyarrow.csv.ParseOptions(quote_char=False),
+        convert_options=pyarrow.csv.ConvertOptions(column_types={x: pyarrow.string() for x in names},
+                                                   strings_can_be_null=False))
+
+    columns = [table.column('user_id')]
+    for name in ['latitude', 'longitude']:
+        column = pyarrow.compute.utf8_trim_whitespace(table.column(name))
+        is_number = pyarrow.compute.match_substring_regex(column, FLOAT_PATTERN)
+        columns.append(pyarrow.compute.cast(pyarrow.compute.if_else(is_number, column, None), pyarrow.float64()))
+
+    try:
+        created_at = pyarrow.compute.cast(table.column('created_at'), pyarrow.int64())
+    except pyarrow.ArrowInvalid:  # "+123"や"1_000"などint()では読める形式
+        created_at = pyarrow.array([int(x) for x in table.column('created_at').to_pylist()], pyarrow.int64())
+    in_range = pyarrow.compute.less_equal(created_at, 2 ** 31 - 1)
+    columns.append(pyarrow.compute.cast(pyarrow.compute.if_else(in_range, created_at, None), pyarrow.int32()))
+
+    return pyarrow.Table.from_arrays(columns, schema=PARQUET_SCHEMA)
+
+
+class ByteBudget:
+    """
+    取得済みで振り分け待ちのオブジェクトの合計サイズを上限以下に抑える
+    振り分けはfile_listの順に行うので、先頭のオブジェクトが後続に枠を奪われて取得できなくならないよう、
+    枠はfile_listの順(ticket)に確保する
+    上限より大きいオブジェクトも、他に保持しているものが無ければ確保できる
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        """
+        Parameters
+        ----------
+        max_bytes: int
+            合計サイズの上限
+        """
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.turn = 0           # 次に確保できるticket
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def acquire(self, ticket: int, size: int) -> None:
+        """
+        ticketの順番が来て、sizeバイト分の空きができるまで待つ
+        """
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.closed or (self.turn == ticket and (self.used == 0 or self.used + size <= self.max_bytes)))
+            self.used += size
+            self.turn += 1
+            self.condition.notify_all()
+
+    def release(self, size: int) -> None:
+        """
+        sizeバイト分を解放する
+        """
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+    def close(self) -> None:
+        """
+        待っているスレッドをすべて解放する (中断時)
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+def fetch_location(file: str, bucket: str, budget: ByteBudget, ticket: int) -> bytes:
+    """
+    作業用フォルダ(S3)のオブジェクトを、圧縮されたまま取得する
+    取得した分はbudgetから確保されるので、振り分け後に解放すること
+
+    Parameters
+    ----------
+    file: str
+        ファイル名 (例: 'work/1566624557.csv')
+    bucket: str
+        オブジェクトを読み込むS3バケット
+    budget: ByteBudget
+        取得済みのオブジェクトの合計サイズの上限
+    ticket: int
+        file_list内の順番
+
+    Returns
+    -------
+    bytes
+        オブジェクトの内容
+    """
+    try:
+        response = s3.get_object(Bucket=bucket, Key=file)
+    except Exception:
+        budget.acquire(ticket, 0)  # 後続が待ち続けないよう、順番だけは進める
+        raise
+
+    size = response['ContentLength']
+    budget.acquire(ticket, size)
+    try:
+        return response['Body'].read()
+    except Exception:
+        budget.release(size)
+        raise
+
+
+def separate_location_parallel(file_list: List[str], temporary_file_dict: Dict[int, BinaryIO], bucket: str,
+                               workers: int, queue_size: int, max_bytes: int, mode: str = SPLIT_MODE_LINE,
+                               processes: int = 0, open_sink: Callable[[int], BinaryIO] = None) -> dict:
+    """
+    作業用フォルダ(S3)のオブジェクトを複数スレッドで取得しながら、レコードの基準時間毎に保管用一時ファイルに振り分ける
+    取得はworkers並列で先行して行い、振り分け結果はfile_listの順に書き込むため、
+    結果はseparate_locationを順に呼んだ場合と同じになる
+    processes > 0の場合は、オブジェクト全体をプロセスプールに渡して振り分ける
+
+    Parameters
+    ----------
+    file_list: List[str]
+        ファイル名の文字列一覧。
+        (例) "work/123456.csv"
+    temporary_file_dict: Dict[int, BinaryIO]
+        作成されたtempfile.NamedTemporaryFileを保管するdict
+    open_sink: Callable[[int], BinaryIO]
+        基準時間を受け取り、その日の書き込み先を作成する関数。Noneの場合はtempfile.NamedTemporaryFileを作成する
+    bucket: str
+        オブジェクトを読み込むS3バケット
+    workers: int
+        取得するスレッド数
+    queue_size: int
+        取得済みで振り分け待ちのオブジェクト数の上限 (取得中のものを含む)
+    max_bytes: int
+        取得済みで振り分け待ちのオブジェクトの合計サイズの上限
+    mode: str
+        振り分け方法 (SPLIT_MODES参照)
+    processes: int
+        振り分けを行うプロセス数
+
+    Returns
+    -------
+    Dict[int, BinaryIO]
+        作成されたtempfile.NamedTemporaryFileを保管するdict
+    """
+    if mode not in SPLIT_MODES:
+        raise ValueError('unknown split mode: ' + mode)
+    if mode == SPLIT_MODE_NUMPY and numpy is None:
+        raise ValueError('numpy is not installed')
+
+    budget = ByteBudget(max_bytes)
+    window = max(workers, queue_size)
+    pending = collections.deque()    # 取得中のオブジェクト
+    splitting = collections.deque()  # プロセスプールで振り分け中のオブジェクト
+    files = enumerate(file_list)
 
-                temp_file = temporary_file_dict[base_time]
-                temp_file.write(buffer)
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=processes) if processes > 0 else None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        def fill() -> None:
+            # 振り分け待ちがwindow件になるまで取得を先行させる
+            while len(pending) < window:
+                ticket, file = next(files, (None, None))
+                if file is None:
+                    break
+                pending.append((file, executor.submit(fetch_location, file, bucket, budget, ticket)))
+
+        try:
+            fill()
+            while len(pending) > 0:
+                file, future = pending.popleft()
+                data = future.result()
+                fill()
+                try:
+                    fmt = work_file.get_format(file)
+                    if pool is not None:
+                        splitting.append(pool.submit(split_location_data, data, fmt, mode))
+                    elif mode == SPLIT_MODE_LINE:
+                        separate_lines(work_file.iter_lines(io.BytesIO(data), fmt), temporary_file_dict, open_sink)
+                    else:
+                        write_chunks(split_location_data(data, fmt, mode), temporary_file_dict, open_sink)
+                finally:
+                    budget.release(len(data))
+                del data
+
+                # プロセスプールに渡したものは、順に書き込む
+                while len(splitting) > 2 * processes:
+                    write_chunks(splitting.popleft().result(), temporary_file_dict, open_sink)
+            while len(splitting) > 0:
+                write_chunks(splitting.popleft().result(), temporary_file_dict, open_sink)
+        finally:
+            for future in [x[1] for x in pending] + list(splitting):
+                future.cancel()
+            budget.close()
+            if pool is not None:
+                pool.shutdown()
+
+    return temporary_file_dict
+
+
+def split_location_data(data: bytes, fmt: str, mode: str) -> Dict[int, bytes]:
+    """
+    オブジェクトの内容全体を、レコードの基準時間毎のbyte列に振り分ける
+    プロセスプールから呼び出される
+
+    Parameters
+    ----------
+    data: bytes
+        オブジェクトの内容 (圧縮されたまま)
+    fmt: str
+        形式名 (work_file参照)
+    mode: str
+        振り分け方法 (SPLIT_MODES参照)
+
+    Returns
+    -------
+    Dict[int, bytes]
+        基準時間 -> その日のレコード行 (改行付き) を連結したbyte列
+    """
+    text = work_file.decode(data, fmt)
+    if mode == SPLIT_MODE_BYTES:
+        return split_text_bytes(text)
+    if mode == SPLIT_MODE_NUMPY:
+        return split_text_numpy(text)
+
+    chunks = dict()
+    for line in io.BytesIO(text):
+        timestamp, buffer = get_timestamp_and_buffer(line)
+        if timestamp > 0:
+            chunks.setdefault(get_base_time(timestamp), []).append(buffer)
+    return {base_time: b''.join(lines) for base_time, lines in chunks.items()}
+
+
+def split_text_bytes(text: bytes) -> Dict[int, bytes]:
+    """
+    テキスト形式のレコード列を、str変換せずにbyte列のまま基準時間毎に振り分ける
+    無効行の判定はget_timestamp_and_bufferと同じ
+
+    Parameters
+    ----------
+    text: bytes
+        "ユーザID,緯度,経度,タイムスタンプ\\n"のレコード列
+
+    Returns
+    -------
+    Dict[int, bytes]
+        基準時間 -> その日のレコード行 (改行付き) を連結したbyte列
+    """
+    if not text.isascii():  # get_timestamp_and_bufferと同じく、ASCII以外を含む場合はエラー
+        text.decode('ascii')
+
+    chunks = dict()
+    lines, low, high = None, 0, 0  # 直前の行と同じ日付であれば、基準時間の計算を省く
+    for line in text.split(b'\n'):
+        s = line.strip(STRIP_CHARS)
+        head, _, field = s.rpartition(b',')
+        if head.count(b',') != 2:  # フィールド数が4でない
+            continue
+        try:
+            timestamp = int(field)
+        except ValueError:  # timestampが数値じゃない
+            continue
+        if timestamp <= 0:
+            continue
+        if not low <= timestamp < high:
+            low = timestamp - (timestamp + tz) % (60 * 60 * 24)
+            high = low + 60 * 60 * 24
+            lines = chunks.get(low)
+            if lines is None:
+                lines = chunks[low] = []
+        lines.append(s)
+
+    return {base_time: b'\n'.join(lines) + b'\n' for base_time, lines in chunks.items()}
+
+
+def split_text_numpy(text: bytes) -> Dict[int, bytes]:
+    """
+    テキスト形式のレコード列を、NumPyの配列演算で基準時間毎に振り分ける
+    行の区切り・カンマの位置・タイムスタンプの値・基準時間を配列として一括で求め、基準時間で安定ソートした後、
+    元のバッファ上で連続している行はまとめて切り出す
+    前後に空白がある、タイムスタンプが数字のみでないなど、配列演算で扱わない行はsplit_text_bytesで判定する
+    無効行の判定はget_timestamp_and_bufferと同じ
+
+    Parameters
+    ----------
+    text: bytes
+        "ユーザID,緯度,経度,タイムスタンプ\\n"のレコード列
+
+    Returns
+    -------
+    Dict[int, bytes]
+        基準時間 -> その日のレコード行 (改行付き) を連結したbyte列
+    """
+    if not text.isascii():  # get_timestamp_and_bufferと同じく、ASCII以外を含む場合はエラー
+        text.decode('ascii')
+    if len(text) == 0:
+        return dict()
+
+    buffer = numpy.frombuffer(text, dtype=numpy.uint8)
+    newlines = numpy.flatnonzero(buffer == ord('\n'))
+    starts = numpy.concatenate(([0], newlines + 1))              # 行の先頭
+    ends = numpy.concatenate((newlines, [len(text)]))             # 行の末尾 (改行の位置)
+    if starts[-1] == len(text):  # 末尾が改行で終わっている
+        starts, ends = starts[:-1], ends[:-1]
+    lengths = ends - starts
+
+    # カンマの数と最後のカンマの位置
+    commas = numpy.flatnonzero(buffer == ord(','))
+    comma_end = numpy.searchsorted(commas, ends)
+    comma_count = comma_end - numpy.searchsorted(commas, starts)
+    last_comma = commas[numpy.maximum(comma_end - 1, 0)] if len(commas) > 0 else numpy.zeros_like(starts)
+
+    # 前後に空白が無く、フィールド数が4で、タイムスタンプが適当な桁数の行を配列演算で扱う
+    field_length = ends - last_comma - 1
+    strip_chars = numpy.frombuffer(STRIP_CHARS, dtype=numpy.uint8)
+    nonempty = lengths > 0
+    first = buffer[numpy.where(nonempty, starts, 0)]
+    last = buffer[numpy.where(nonempty, ends - 1, 0)]
+    simple = nonempty & (comma_count == 3) \
+        & (field_length >= 1) & (field_length <= MAX_TIMESTAMP_DIGITS) \
+        & ~numpy.isin(first, strip_chars) & ~numpy.isin(last, strip_chars) \
+        & (ends < len(text))  # 改行で終わっていない最後の行は、改行を付け足すので別に扱う
+
+    # タイムスタンプを下の桁から足し合わせて求める。数字以外を含む行は配列演算では扱わない
+    timestamps = numpy.zeros(len(starts), dtype=numpy.int64)
+    digits = numpy.where(simple, field_length, 0)
+    for k in range(int(digits.max()) if len(digits) > 0 else 0):
+        has_digit = digits > k
+        digit = buffer[numpy.where(has_digit, ends - 1 - k, 0)].astype(numpy.int64) - ord('0')
+        simple &= ~has_digit | ((digit >= 0) & (digit <= 9))
+        timestamps += numpy.where(has_digit, digit, 0) * (10 ** k)
+    timestamps[~simple] = 0
+
+    valid = (timestamps > 0)
+    local_time = timestamps + tz
+    base_times = local_time - local_time % (60 * 60 * 24) - tz
+
+    # 配列演算で扱わない行は、1行ずつ判定する
+    irregular = dict()  # 行番号 -> 行のbyte列 (改行付き)
+    limit = numpy.iinfo(numpy.int64)
+    for row in numpy.flatnonzero(~simple & nonempty):
+        for base_time, chunk in split_text_bytes(text[starts[row]:ends[row]]).items():
+            if not limit.min <= base_time <= limit.max:  # int64で扱えない場合は全体を1行ずつ判定する
+                return split_text_bytes(text)
+            irregular[row] = chunk
+            valid[row] = True
+            base_times[row] = base_time
+
+    # 基準時間で安定ソートし、基準時間が同じで元のバッファ上で連続している行をまとめる
+    rows = numpy.flatnonzero(valid)
+    rows = rows[numpy.argsort(base_times[rows], kind='stable')]
+    if len(rows) == 0:
+        return dict()
+    sorted_base_times = base_times[rows]
+    sorted_simple = simple[rows]
+    breaks = numpy.ones(len(rows), dtype=bool)
+    breaks[1:] = (sorted_base_times[1:] != sorted_base_times[:-1]) | (rows[1:] != rows[:-1] + 1) \
+        | ~sorted_simple[1:] | ~sorted_simple[:-1]
+    run_starts = numpy.flatnonzero(breaks)
+    run_ends = numpy.concatenate((run_starts[1:], [len(rows)])) - 1
+
+    chunks = dict()
+    for first_index, last_index in zip(run_starts.tolist(), run_ends.tolist()):
+        row = int(rows[first_index])
+        if simple[row]:
+            chunk = text[starts[row]:ends[rows[last_index]] + 1]
+        else:
+            chunk = irregular[row]
+        chunks.setdefault(int(sorted_base_times[first_index]), []).append(chunk)
+
+    return {base_time: b''.join(chunk_list) for base_time, chunk_list in chunks.items()}
+
+
+def write_chunks(chunks: Dict[int, bytes], temporary_file_dict: Dict[int, BinaryIO],
+                 open_sink: Callable[[int], BinaryIO] = None) -> dict:
+    """
+    基準時間毎に振り分けたbyte列を、保管用一時ファイルに書き込む
+
+    Parameters
+    ----------
+    chunks: Dict[int, bytes]
+        基準時間 -> その日のレコード行を連結したbyte列
+    temporary_file_dict: Dict[int, BinaryIO]
+        作成されたtempfile.NamedTemporaryFileを保管するdict
+    open_sink: Callable[[int], BinaryIO]
+        基準時間を受け取り、その日の書き込み先を作成する関数。Noneの場合はtempfile.NamedTemporaryFileを作成する
+
+    Returns
+    -------
+    Dict[int, BinaryIO]
+        作成されたtempfile.NamedTemporaryFileを保管するdict
+    """
+    for base_time, chunk in chunks.items():
+        if base_time not in temporary_file_dict:
+            temporary_file_dict[base_time] = open_temporary_file(base_time, open_sink)
+        temporary_file_dict[base_time].write(chunk)
 
     return temporary_file_dict
 
@@ -152,9 +1092,10 @@ def get_timestamp_and_buffer(line: bytes) -> (int, bytes):
     return 0, b''
 
 
-def remove_location_file(file_list: List[str], bucket: str) -> None:
+def remove_location_file(file_list: List[str], bucket: str, workers: int = 1) -> Dict[str, str]:
     """
-    処理済みのファイルを削除
+    処理済みのファイルを、delete_objectsで1000件ずつまとめて削除
+    削除できなかったファイルがあっても中断せず、ファイル毎に記録して返す
 
     Parameters
     ----------
@@ -163,9 +1104,15 @@ def remove_location_file(file_list: List[str], bucket: str) -> None:
         (例) "work/123456.csv"
     bucket: str
         オブジェクトを書き込むS3バケット
+    workers: int
+        並列に削除するスレッド数
+
+    Returns
+    -------
+    Dict[str, str]
+        削除できなかったファイル名と、その理由
     """
-    for file in file_list:
-        s3.delete_object(Bucket=bucket, Key=file)
+    return try_delete_keys(s3, bucket, file_list, workers)
 
 
 def add_partition_to_redshift(conn: Type[psycopg2.extensions.connection], ymd: str, table: str, bucket: str, prefix: str) -> None:
@@ -191,6 +1138,77 @@ def add_partition_to_redshift(conn: Type[psycopg2.extensions.connection], ymd: s
                     location 's3://{2}/{3}created_date={1}/' '''.format(table, ymd, bucket, prefix))
 
 
+def load_partition_cache(cache_file: str) -> Set[str]:
+    """
+    登録済みのpartitionの記録を読み込む
+
+    Parameters
+    ----------
+    cache_file: str
+        記録を保存するファイル名。空文字列の場合は記録しない
+
+    Returns
+    -------
+    Set[str]
+        登録済みのpartition ("テーブル名 ロケーション"の文字列)
+    """
+    if cache_file == '' or not os.path.exists(cache_file):
+        return set()
+    with open(cache_file, 'r') as fd:
+        return set([x.strip() for x in fd if x.strip() != ''])
+
+
+def add_partitions_to_redshift(conn: Type[psycopg2.extensions.connection], ymd_list: Iterable[str], table: str,
+                               bucket: str, prefix: str, cache_file: str = '') -> List[str]:
+    """
+    Redshiftに複数のpartitionを、MAX_PARTITIONS_PER_ALTER件ずつまとめたALTER TABLEで追加
+    cache_fileに記録されている登録済みのpartitionは対象としない。すべて登録済みの場合はRedshiftにアクセスしない
+    ALTER TABLEが成功する毎に、追加したpartitionをcache_fileに記録する
+    なお、cache_fileはテーブルの削除・再作成を検知しないので、テーブルを作り直した場合はcache_fileも削除すること
+
+    Parameters
+    ----------
+    conn: Type[psycopg2.extensions.connection]
+        Redshiftへの接続オブジェクト
+    ymd_list: Iterable[str]
+        年月日(YYYYMMDD)の文字列の一覧
+    table: str
+        Redshift内のテーブル名
+    bucket: str
+        オブジェクトを書き込むS3バケット
+    prefix: str
+        バケットのprefix
+    cache_file: str
+        登録済みのpartitionを記録するファイル名。空文字列の場合は記録しない
+
+    Returns
+    -------
+    List[str]
+        ALTER TABLEを発行した年月日の一覧
+    """
+    cache = load_partition_cache(cache_file)
+    partitions = []
+    for ymd in sorted(set(ymd_list)):
+        location = 's3://{0}/{1}created_date={2}/'.format(bucket, prefix, ymd)
+        if table + ' ' + location not in cache:
+            partitions.append((ymd, location))
+    if len(partitions) == 0:
+        return []
+
+    for first in range(0, len(partitions), MAX_PARTITIONS_PER_ALTER):
+        chunk = partitions[first:first + MAX_PARTITIONS_PER_ALTER]
+        with conn.cursor() as cur:
+            cur.execute('alter table {0} add if not exists '.format(table)
+                        + ' '.join(['partition(created_date=\'{0}\') location \'{1}\''.format(ymd, location)
+                                    for ymd, location in chunk]))
+
+        if cache_file != '':
+            with open(cache_file, 'a') as fd:
+                fd.writelines([table + ' ' + location + '\n' for _, location in chunk])
+
+    return [ymd for ymd, _ in partitions]
+
+
 def get_date_str(unix_time: int) -> str:
     """
     指定されたunix_timeをJSTの日付に変換する
@@ -236,10 +1254,33 @@ def compress_and_upload(source_file_name: str, upload_file_name: str, ymd: str,
                           Key=prefix + 'created_date=' + ymd + '/' + upload_file_name + '.gz')
 
 
-def main() -> str:
+def get_parted_location() -> Tuple[str, str]:
+    """
+    環境変数から、S3格納用フォルダとSpectrumのテーブル名を求める
+    既定値はOUTPUT_FORMATによって異なる (テキスト形式のテーブルにParquetのpartitionを追加しないため)
+    S3格納用フォルダを読み込むcompact_partition, collect_request, match_shopも、同じ既定値を使うためにこれを呼び出す
+
+    Returns
+    -------
+    str, str
+        S3格納用フォルダのprefix (FOLDER_PARTED), Spectrumのテーブル名 (TABLE_LOCATION)
+    """
+    if os.environ.get('OUTPUT_FORMAT', DEFAULT_OUTPUT_FORMAT) == OUTPUT_FORMAT_PARQUET:
+        return (os.environ.get('FOLDER_PARTED', DEFAULT_FOLDER_PARTED_PARQUET),
+                os.environ.get('TABLE_LOCATION', DEFAULT_TABLE_LOCATION_PARQUET))
+    return (os.environ.get('FOLDER_PARTED', DEFAULT_FOLDER_PARTED),
+            os.environ.get('TABLE_LOCATION', DEFAULT_TABLE_LOCATION))
+
+
+def main(pool: Optional[psycopg2.pool.AbstractConnectionPool] = None) -> str:
     """
     メイン
 
+    Parameters
+    ----------
+    pool: Optional[psycopg2.pool.AbstractConnectionPool]
+        Redshiftへの接続のプール (run_pipelineから呼び出される場合)。Noneの場合は新たに接続する
+
     Returns
     -------
     str
@@ -247,49 +1288,142 @@ def main() -> str:
     """
     bucket = os.environ.get('BUCKET_LOCATION', DEFAULT_BUCKET_LOCATION)
     folder_work = os.environ.get('FOLDER_WORK', DEFAULT_FOLDER_WORK)
-    folder_parted = os.environ.get('FOLDER_PARTED', DEFAULT_FOLDER_PARTED)
-    table_location = os.environ.get('TABLE_LOCATION', DEFAULT_TABLE_LOCATION)
+    output_format = os.environ.get('OUTPUT_FORMAT', DEFAULT_OUTPUT_FORMAT)
+    folder_parted, table_location = get_parted_location()
+    fetch_workers = int(os.environ.get('FETCH_WORKERS', DEFAULT_FETCH_WORKERS))
+    fetch_queue_size = int(os.environ.get('FETCH_QUEUE_SIZE', DEFAULT_FETCH_QUEUE_SIZE))
+    fetch_max_bytes = int(os.environ.get('FETCH_MAX_BYTES', DEFAULT_FETCH_MAX_BYTES))
+    split_mode = os.environ.get('SPLIT_MODE', DEFAULT_SPLIT_MODE)
+    split_processes = int(os.environ.get('SPLIT_PROCESSES', DEFAULT_SPLIT_PROCESSES))
+    stream_upload = os.environ.get('STREAM_UPLOAD', DEFAULT_STREAM_UPLOAD) == '1'
+    upload_part_size = int(os.environ.get('UPLOAD_PART_SIZE', DEFAULT_UPLOAD_PART_SIZE))
+    parquet_row_group_rows = int(os.environ.get('PARQUET_ROW_GROUP_ROWS', DEFAULT_PARQUET_ROW_GROUP_ROWS))
+    parquet_compression = os.environ.get('PARQUET_COMPRESSION', DEFAULT_PARQUET_COMPRESSION)
+    folder_tiles = os.environ.get('FOLDER_TILES', DEFAULT_FOLDER_TILES)
+    tile_precision = int(os.environ.get('TILE_PRECISION', DEFAULT_TILE_PRECISION))
+    tile_buffer_bytes = int(os.environ.get('TILE_BUFFER_BYTES', DEFAULT_TILE_BUFFER_BYTES))
+    use_sink = stream_upload or output_format == OUTPUT_FORMAT_PARQUET  # Parquetは常にアップロードしながら変換する
+
+    list_workers = int(os.environ.get('LIST_WORKERS', DEFAULT_LIST_WORKERS))
+    delete_workers = int(os.environ.get('DELETE_WORKERS', DEFAULT_DELETE_WORKERS))
+    checkpoint_key = os.environ.get('CHECKPOINT_KEY', DEFAULT_CHECKPOINT_KEY)
+    batch_size = int(os.environ.get('BATCH_SIZE', DEFAULT_BATCH_SIZE))
+    partition_cache_file = os.environ.get('PARTITION_CACHE_FILE', DEFAULT_PARTITION_CACHE_FILE)
 
     temporary_file_dict = dict()
     try:
         logger.info('start.')
-        # ターゲットとなる全ファイル名を取得
-        file_list = list_location_file(bucket, folder_work)
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError('unknown output format: ' + output_format)
+        if not 0 <= tile_precision <= geohash_tile.MAX_PRECISION:
+            raise ValueError('invalid tile precision: {}'.format(tile_precision))
+        if tile_precision > 0 and not use_sink:
+            raise ValueError('TILE_PRECISION requires STREAM_UPLOAD=1')
 
-        # データを基準時間毎に振り分けて一時ファイルに保管する
-        for file in file_list:
-            temporary_file_dict = separate_location(file, temporary_file_dict, bucket)
+        # 前回中断したバッチがあれば回復する
+        checkpoint = Checkpoint(s3, bucket, checkpoint_key)
+        checkpoint.recover()
 
-        # 一旦クローズ
-        [t.close() for t in temporary_file_dict.values()]
-
-        # 結果をS3に保管する
+        # ターゲットとなる全ファイル名を取得
         now = int(time.time())
         today_base_time = get_base_time(now)
-        upload_file_name = str(now) + '.csv'
-        connection_string = get_connection_string()
-        with psycopg2.connect(connection_string) as conn:
-            conn.autocommit = True  # ALTER TABLEはBEGIN内で使えないので、autocommit=Trueにしておく
-
-            for base_time, temp_file in temporary_file_dict.items():
-                if base_time == today_base_time:
-                    # 本日分のデータはwork/ディレクトリに送り返す
-                    s3.upload_file(Filename=temp_file.name, Bucket=bucket, Key=folder_work + upload_file_name)
+        file_list = select_closed_file(list_location_file(bucket, folder_work, list_workers), get_date_str(today_base_time))
+
+        # ALTER TABLEはBEGIN内で使えないので、autocommit=Trueにしておく
+        with connect(pool, autocommit=True) as conn:
+
+            # batch_size個ずつ処理し、処理済みのファイルを削除する
+            for i in range(0, len(file_list), batch_size):
+                batch_list = file_list[i:i + batch_size]
+                batch_id = '{0}-{1:04d}'.format(now, i // batch_size)
+                upload_file_name = batch_id + '.csv'
+                checkpoint.begin(batch_id, batch_list)
+
+                def get_output_key(base_time: int) -> str:
+                    if base_time == today_base_time:
+                        # 本日分のデータはwork/ディレクトリの当日のフォルダに送り返す
+                        key = work_file.get_partition_prefix(folder_work, get_date_str(base_time)) + upload_file_name
+                        return key + '.gz' if use_sink else key
+                    prefix = folder_parted + 'created_date=' + get_date_str(base_time) + '/'
+                    if output_format == OUTPUT_FORMAT_PARQUET:
+                        return prefix + batch_id + '.parquet'
+                    return prefix + upload_file_name + '.gz'
+
+                def get_tile_keys(base_time: int) -> List[str]:
+                    if tile_precision == 0 or base_time == today_base_time:
+                        return []
+                    prefix = geohash_tile.get_tile_prefix(folder_tiles, get_date_str(base_time))
+                    return [prefix + upload_file_name + '.gz', prefix + batch_id + geohash_tile.INDEX_SUFFIX]
+
+                open_sink = None
+                if use_sink:
+                    def open_sink(base_time: int) -> BinaryIO:
+                        key = get_output_key(base_time)
+                        if key.endswith('.parquet'):
+                            sink = ParquetUploadSink(bucket, key, upload_part_size,
+                                                     parquet_row_group_rows, parquet_compression)
+                        else:
+                            sink = GzipUploadSink(bucket, key, upload_part_size)
+                        tile_keys = get_tile_keys(base_time)
+                        if len(tile_keys) > 0:
+                            return TileUploadSink(sink, bucket, tile_keys[0], tile_keys[1], tile_precision,
+                                                  upload_part_size, tile_buffer_bytes)
+                        return sink
+
+                # データを基準時間毎に振り分けて一時ファイル(またはアップロード中のオブジェクト)に保管する
+                temporary_file_dict = dict()
+                if fetch_workers > 1 or split_mode != SPLIT_MODE_LINE or split_processes > 0:
+                    separate_location_parallel(batch_list, temporary_file_dict, bucket, max(1, fetch_workers),
+                                               fetch_queue_size, fetch_max_bytes, split_mode, split_processes,
+                                               open_sink)
                 else:
-                    # 前日までのデータは圧縮してS3のparted/フォルダにコピーする
-                    ymd = get_date_str(base_time)  # YYYYMMDD
-                    add_partition_to_redshift(conn, ymd, table_location, bucket, folder_parted)
-                    compress_and_upload(temp_file.name, upload_file_name, ymd, bucket, folder_parted)
+                    for file in batch_list:
+                        temporary_file_dict = separate_location(file, temporary_file_dict, bucket, open_sink)
+
+                # 書き出すオブジェクトを記録してから、一旦クローズ (アップロード中のオブジェクトはここで完成する)
+                checkpoint.uploading([get_output_key(x) for x in temporary_file_dict.keys()]
+                                     + [y for x in temporary_file_dict.keys() for y in get_tile_keys(x)])
+                [t.close() for t in temporary_file_dict.values()]
+
+                # 結果をS3に保管する
+                partition_list = []
+                for base_time, temp_file in temporary_file_dict.items():
+                    if base_time == today_base_time:
+                        if not use_sink:
+                            # 本日分のデータはwork/ディレクトリの当日のフォルダに送り返す
+                            s3.upload_file(Filename=temp_file.name, Bucket=bucket, Key=get_output_key(base_time))
+                    else:
+                        # 前日までのデータは圧縮してS3のparted/フォルダにコピーする
+                        ymd = get_date_str(base_time)  # YYYYMMDD
+                        partition_list.append(ymd)
+                        if not use_sink:
+                            compress_and_upload(temp_file.name, upload_file_name, ymd, bucket, folder_parted)
+
+                # アップロードが完了してから、partitionをまとめて追加する (処理済みのファイルを削除する前に行う)
+                add_partitions_to_redshift(conn, partition_list, table_location, bucket, folder_parted,
+                                           partition_cache_file)
+
+                # 処理済みのファイルを削除
+                checkpoint.commit()
+                failures = remove_location_file(batch_list, bucket, delete_workers)
+                if len(failures) > 0:
+                    # committedのまま終了し、次回の実行時に残りを削除する
+                    raise RuntimeError('{} objects could not be removed'.format(len(failures)))
+                checkpoint.finish()
 
-        # 処理済みのファイルを削除
-        remove_location_file(file_list, bucket)
+                if not use_sink:
+                    [os.remove(t.name) for t in temporary_file_dict.values()]
+                temporary_file_dict = dict()
 
         logger.info('finished.')
         return 'success'
     except Exception as e:
         logger.error(e)
+        if use_sink:
+            [t.abort() for t in temporary_file_dict.values()]
     finally:
-        [os.remove(t.name) for t in temporary_file_dict.values()]
+        if not use_sink:
+            [os.remove(t.name) for t in temporary_file_dict.values()]
 
     return 'error'
 
@@ -0,0 +1,127 @@
+# coding=utf-8
+
+"""
+retrieve_request, compact_partition, collect_requestを一つのプロセスで順に実行する
+各スクリプトを別プロセスで起動する場合と比べて、インタプリタの起動やモジュールの読み込み、
+Redshiftへの接続やS3とのTLS接続を一度で済ませる
+
+  - Redshiftへの接続はプールし、retrieve_requestとcollect_requestで共有する
+  - S3クライアントは一つを全モジュールで共有する (HTTP接続も使い回される)
+  - 接続設定(.pgpass)はget_connection_stringがキャッシュする
+
+起動やモジュールの読み込み、接続に掛かった時間と、各処理の所要時間をログに出力する
+
+    python3 run_pipeline.py [YYYYMMDD | YYYYMMDD-YYYYMMDD ...]
+
+引数はcollect_requestと同じで、省略した場合は昨日のデータを対象とする
+いずれかの処理が失敗した場合は、以降の処理を行わない
+(retrieve_requestが中断したバッチの出力をまとめたり、途中までのデータを公開したりしないため)
+"""
+
+import time
+START = time.perf_counter()  # モジュールの読み込み時間を計測するため、最初に記録する
+
+import datetime  # noqa: E402
+import logging  # noqa: E402
+import os  # noqa: E402
+import sys  # noqa: E402
+from typing import List  # noqa: E402
+
+import boto3  # noqa: E402
+import botocore.config  # noqa: E402
+import psycopg2.pool  # noqa: E402
+
+import collect_request  # noqa: E402
+import compact_partition  # noqa: E402
+import get_connection_string  # noqa: E402
+import retrieve_request  # noqa: E402
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+DEFAULT_S3_MAX_POOL_CONNECTIONS = '32'  # 共有するS3クライアントのHTTP接続数の上限 (取得・削除・変換の各スレッドで使用する)
+
+tz = 9 * 60 * 60   # JST(+9:00)
+
+
+def share_s3_client(max_pool_connections: int) -> None:
+    """
+    全モジュールで一つのS3クライアントを使用するようにする
+
+    Parameters
+    ----------
+    max_pool_connections: int
+        HTTP接続数の上限
+    """
+    s3 = boto3.client('s3', config=botocore.config.Config(max_pool_connections=max_pool_connections))
+    for module in [retrieve_request, compact_partition, collect_request]:
+        module.s3 = s3
+
+
+def main(ymd_list: List[str]) -> str:
+    """
+    メイン
+
+    Parameters
+    ----------
+    ymd_list: List[str]
+        compact_partition, collect_requestの対象となる年月日 (YYYYMMDD) の一覧
+
+    Returns
+    -------
+    str
+        "success" or "error" (一つでも失敗した場合。以降の処理は行わない)
+    """
+    import_time = time.perf_counter() - START
+    max_pool_connections = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', DEFAULT_S3_MAX_POOL_CONNECTIONS))
+    collect_workers = int(os.environ.get('COLLECT_WORKERS', collect_request.DEFAULT_COLLECT_WORKERS))
+
+    logger.info('start.')
+    timings = [('import', import_time)]
+
+    start = time.perf_counter()
+    share_s3_client(max_pool_connections)
+    timings.append(('s3 client', time.perf_counter() - start))
+
+    start = time.perf_counter()
+    connection_string = get_connection_string.get_connection_string()
+    timings.append(('pgpass', time.perf_counter() - start))
+    start = time.perf_counter()
+    get_connection_string.get_connection_string()
+    timings.append(('pgpass (cached)', time.perf_counter() - start))
+
+    # collect_requestが並行して処理する日数分の接続を用意できるようにする
+    start = time.perf_counter()
+    pool = psycopg2.pool.ThreadedConnectionPool(1, max(1, collect_workers), connection_string)
+    timings.append(('connect', time.perf_counter() - start))
+
+    results = []
+    try:
+        for name, step in [('retrieve_request', lambda: retrieve_request.main(pool)),
+                           ('compact_partition', lambda: compact_partition.main(ymd_list)),
+                           ('collect_request', lambda: collect_request.main_days(ymd_list, pool))]:
+            start = time.perf_counter()
+            results.append(step())
+            timings.append((name, time.perf_counter() - start))
+            if results[-1] != 'success':
+                logger.error('{} failed, skip the remaining steps'.format(name))
+                break
+    finally:
+        pool.closeall()
+
+    for name, elapsed in timings:
+        logger.info('{0:20s} {1:10.1f}ms'.format(name, elapsed * 1000))
+    logger.info('finished. total {0:.3f}s ({1})'.format(time.perf_counter() - START, ', '.join(results)))
+
+    return 'success' if all([x == 'success' for x in results]) else 'error'
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 1:  # 引数なしの場合は昨日のデータ
+        local_time = time.time() + tz
+        local_yesterday_base_time = local_time - (local_time % (60 * 60 * 24)) - (60 * 60 * 24)
+        ymd_str_list = [datetime.datetime.utcfromtimestamp(local_yesterday_base_time).strftime('%Y%m%d')]
+    else:
+        ymd_str_list = collect_request.parse_ymd_args(sys.argv[1:])  # "YYYYMMDD" or "YYYYMMDD-YYYYMMDD"
+
+    main(ymd_str_list)
@@ -0,0 +1,92 @@
+# coding=utf-8
+
+"""
+match_shopの突き合わせ処理の所要時間計測用スクリプト
+
+    python3 bench_match_shop.py [レコード数] [店舗数] [距離(メートル)]
+
+都市の周辺に集まった店舗と一日分の位置情報を用意し、compact_partitionでまとめた後と同じく
+一つのオブジェクト(gzip圧縮したCSV)として一時的なバケットに置いて、
+プロセス数を変えてmatch_partitionの所要時間と処理件数(records/s)を出力する
+(S3を使用する。テストと同様にmotoのサーバーを使う場合は環境変数AWS_ENDPOINT_URLなどを設定しておく)
+"""
+
+import os
+import time
+import uuid
+import zlib
+
+import boto3
+import numpy
+
+import sys
+sys.path.append('..')
+import match_shop
+
+CHUNK_RECORDS = 100000  # CSVを作成する単位 (gzipのメンバー)
+CITIES = [(35.68, 139.77), (34.69, 135.50), (35.17, 136.91), (43.06, 141.35), (33.59, 130.40),
+          (34.39, 132.46), (38.27, 140.87), (35.01, 135.77), (34.69, 135.19), (35.44, 139.64)]
+
+
+def make_points(rng: numpy.random.Generator, count: int, scale: float) -> (numpy.ndarray, numpy.ndarray):
+    """
+    都市の周辺(標準偏差scale度)に集まった地点をcount個作成する
+    """
+    center = numpy.array(CITIES)[rng.integers(0, len(CITIES), count)]
+    return center[:, 0] + rng.normal(0, scale, count), center[:, 1] + rng.normal(0, scale, count)
+
+
+def make_object(rng: numpy.random.Generator, count: int) -> bytes:
+    """
+    一日分の位置情報を、一つのgzip圧縮したCSVにする (CHUNK_RECORDS件ずつのgzipのメンバーを連結する)
+    """
+    latitude, longitude = [x.tolist() for x in make_points(rng, count, 0.2)]
+    timestamp = (1567263600 + rng.integers(0, 86400, count)).tolist()
+    users = [str(uuid.uuid4()) for _ in range(10000)]
+    chunks = list()
+    for first in range(0, count, CHUNK_RECORDS):
+        lines = ['{0},{1!r},{2!r},{3}\n'.format(users[i % len(users)], latitude[i], longitude[i], timestamp[i])
+                 for i in range(first, min(count, first + CHUNK_RECORDS))]
+        compressor = zlib.compressobj(wbits=31)
+        chunks.append(compressor.compress(bytes(''.join(lines), 'ascii')) + compressor.flush())
+    return b''.join(chunks)
+
+
+def main(count: int, shop_count: int, radius: float) -> None:
+    """
+    メイン
+    """
+    rng = numpy.random.default_rng(0)
+    data = make_object(rng, count)
+    latitude, longitude = make_points(rng, shop_count, 0.1)
+
+    s3 = boto3.client('s3')
+    bucket = 'benchmatchshop' + str(uuid.uuid4())
+    s3.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': 'ap-northeast-1'})
+    s3.put_object(Bucket=bucket, Key='parted/created_date=20190901/compacted.csv.gz', Body=data)
+    print('object: {0} records, {1} bytes'.format(count, len(data)))
+
+    start = time.perf_counter()
+    shops = match_shop.ShopIndex(numpy.arange(shop_count), latitude, longitude, radius)
+    print('index: {0} shops, {1} cells {2:8.3f}s'.format(shop_count, len(shops.cell_keys),
+                                                        time.perf_counter() - start))
+
+    try:
+        for processes in sorted({0, 1, 2, os.cpu_count()}):
+            start = time.perf_counter()
+            matched = match_shop.match_partition('20190901', bucket, 'parted/', 'matched/20190901.csv.gz', shops,
+                                                 processes, int(match_shop.DEFAULT_UPLOAD_PART_SIZE),
+                                                 int(match_shop.DEFAULT_MATCH_CHUNK_BYTES))
+            elapsed = time.perf_counter() - start
+            print('processes={0:3d} {1:8.3f}s {2:10.0f} records/s {3} matched'.format(
+                processes, elapsed, count / elapsed, matched))
+    finally:
+        response = s3.list_objects_v2(Bucket=bucket)
+        if 'Contents' in response:
+            s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': x['Key']} for x in response['Contents']]})
+        s3.delete_bucket(Bucket=bucket)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2400000, int(sys.argv[2]) if len(sys.argv) > 2 else 30000,
+         float(sys.argv[3]) if len(sys.argv) > 3 else 100)
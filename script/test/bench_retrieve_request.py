@@ -0,0 +1,91 @@
+# coding=utf-8
+
+"""
+retrieve_requestの振り分け処理の所要時間計測用スクリプト
+S3にはmotoを使用する (pip install moto)
+
+    python3 bench_retrieve_request.py [オブジェクト数] [S3の応答遅延(ミリ秒)]
+
+store_requestが5分毎に書き出す1日分(288個)のオブジェクトを用意し、
+取得スレッド数を変えてseparate_location_parallelの所要時間を出力する (1スレッドが逐次処理に相当)
+motoは応答が速すぎるため、GetObjectの度に指定した遅延を入れて実際のS3の応答時間を模擬する
+続けて、遅延なしで振り分け方法とプロセス数を変えた場合の処理件数(records/s)を出力する
+"""
+
+import os
+import time
+import uuid
+import random
+import logging
+import boto3
+from moto import mock_aws
+
+import sys
+sys.path.append('..')
+import retrieve_request
+import work_file
+
+RECORDS_PER_OBJECT = 1000
+
+
+def put_dummy_objects(s3, bucket: str, count: int) -> list:
+    """
+    ダミーのオブジェクト(csv.gz, RECORDS_PER_OBJECT件ずつ)をcount個作成し、キーの一覧を返す
+    """
+    base_time = 1567263600  # 2019/9/1 00:00:00(JST)
+    keys = list()
+    for i in range(count):
+        lines = ['{0},{1!r},{2!r},{3}\n'.format(uuid.uuid4(), random.uniform(20, 46), random.uniform(122, 154),
+                                                base_time + random.randrange(-3600, 86400))
+                 for _ in range(RECORDS_PER_OBJECT)]
+        compressor = work_file.create_compressor('csv.gz')
+        body = compressor.compress(bytes(''.join(lines), 'ascii')) + compressor.flush()
+        key = 'work/{0}-{1:04d}.csv.gz'.format(base_time + i * 300, 0)
+        s3.put_object(Bucket=bucket, Key=key, Body=body)
+        keys.append(key)
+    return keys
+
+
+@mock_aws
+def main(count: int, latency_ms: float) -> None:
+    """
+    メイン
+    """
+    logging.getLogger().setLevel(logging.WARNING)
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-northeast-1')
+    os.environ.pop('AWS_ENDPOINT_URL', None)
+
+    s3 = boto3.client('s3')
+    bucket = 'task3bench' + str(uuid.uuid4())
+    s3.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': 'ap-northeast-1'})
+    keys = put_dummy_objects(s3, bucket, count)
+
+    def run(workers: int, mode: str, processes: int) -> float:
+        temporary_file_dict = dict()
+        start = time.perf_counter()
+        retrieve_request.separate_location_parallel(keys, temporary_file_dict, bucket, workers, workers,
+                                                    256 * 1024 * 1024, mode, processes)
+        elapsed = time.perf_counter() - start
+        [t.close() for t in temporary_file_dict.values()]
+        [os.remove(t.name) for t in temporary_file_dict.values()]
+        return elapsed
+
+    # GetObjectの度に遅延を入れる
+    latency = [latency_ms / 1000]
+    retrieve_request.s3 = boto3.client('s3')
+    retrieve_request.s3.meta.events.register('before-call.s3.GetObject', lambda **kwargs: time.sleep(latency[0]))
+
+    # 1スレッド, 先行取得1件の場合は、取得と振り分けを交互に行う逐次処理と同じ
+    for workers in [1, 2, 4, 8, 16, 32]:
+        print('workers={0:3d} {1:8.3f}s'.format(workers, run(workers, 'line', 0)))
+
+    latency[0] = 0
+    for mode in retrieve_request.SPLIT_MODES:
+        for processes in sorted({0, 1, 2, os.cpu_count()}):
+            elapsed = run(8, mode, processes)
+            print('mode={0:6s} processes={1:3d} {2:8.3f}s {3:10.0f} records/s'.format(
+                mode, processes, elapsed, count * RECORDS_PER_OBJECT / elapsed))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 288, float(sys.argv[2]) if len(sys.argv) > 2 else 30)
@@ -13,11 +13,14 @@ import tempfile
 import gzip
 import psycopg2
 import time
+import hashlib
 
 import sys
 
 sys.path.append('..')
-from collect_request import select_and_write_location, main
+from collect_request import select_and_write_location, encode_rows, get_unload_query, merge_unloaded_file, \
+    list_parted_file, convert_parted_file, export_parted_location, parse_ymd_args, main, main_days, \
+    SegmentWriter, get_manifest, remove_stale_output
 from get_connection_string import get_connection_string
 
 
@@ -135,6 +138,299 @@ class TestCollectRequest(unittest.TestCase):
                                    + '3313c918-55e4-4d15-879e-000000000001,35.72,135.12,1567273601\r\n'
                                    + '3313c918-55e4-4d15-879e-000000000002,35.73,135.13,1567273602\r\n', 'ascii'))
 
+    def test_select_and_location_fetch_size(self) -> None:
+        """
+        select_and_locationのテスト (サーバサイドカーソルで取得する場合)
+        """
+        for fetch_size in [1, 2, 10000]:
+            with tempfile.TemporaryFile() as ftemp:
+                records = select_and_write_location('20190901', ftemp, 'spectrum.test', fetch_size)
+                self.assertEqual(records, 3)
+
+                ftemp.seek(0)
+                self.assertEqual(ftemp.read(),
+                                 bytes('3313c918-55e4-4d15-879e-000000000000,35.71,135.11,1567273600\r\n'
+                                       + '3313c918-55e4-4d15-879e-000000000001,35.72,135.12,1567273601\r\n'
+                                       + '3313c918-55e4-4d15-879e-000000000002,35.73,135.13,1567273602\r\n', 'ascii'))
+
+    def test_encode_rows(self) -> None:
+        """
+        encode_rowsのテスト
+        """
+        rows = [('3313c918-55e4-4d15-879e-000000000000', 35.71, 135.11, 1567273600),
+                ('3313c918-55e4-4d15-879e-000000000001', 0.1 + 0.2, 1e-07, -1),
+                ('3313c918-55e4-4d15-879e-000000000002', None, 135.0, None)]
+        self.assertEqual(encode_rows(rows), b''.join([bytes(','.join([str(x) for x in row]) + '\r\n', 'ascii')
+                                                      for row in rows]))
+        self.assertEqual(encode_rows([]), b'')
+
+    def test_get_unload_query(self) -> None:
+        """
+        get_unload_queryのテスト
+        """
+        query = get_unload_query('20190901', 'spectrum.test', 'bucket', '_unload/20190901/', 'arn:role', False)
+        self.assertTrue(query.startswith('unload (\'select '))
+        self.assertIn('chr(13) from spectrum.test where created_date=\'\'20190901\'\'\')', query)
+        self.assertIn(' to \'s3://bucket/_unload/20190901/\' iam_role \'arn:role\' gzip manifest ', query)
+        self.assertTrue(query.endswith(' parallel off'))
+
+    def test_merge_unloaded_file(self) -> None:
+        """
+        merge_unloaded_fileのテスト
+        """
+        keys = ['_unload/20190901/0000_part_00.gz', '_unload/20190901/0001_part_00.gz']
+        self.s3.put_object(Bucket=self.download_bucket_name, Key=keys[0], Body=gzip.compress(b'a,1,2,3\r\n'))
+        self.s3.put_object(Bucket=self.download_bucket_name, Key=keys[1], Body=gzip.compress(b'b,1,2,3\r\n'))
+
+        for source, expected in [(keys[:1], b'a,1,2,3\r\n'), (keys, b'a,1,2,3\r\nb,1,2,3\r\n')]:
+            merge_unloaded_file(self.download_bucket_name, source, '20190901.csv.gz')
+            body = self.s3.get_object(Bucket=self.download_bucket_name, Key='20190901.csv.gz')['Body'].read()
+            self.assertEqual(gzip.decompress(body), expected)
+
+        self.s3.delete_objects(Bucket=self.download_bucket_name,
+                               Delete={'Objects': [{'Key': x} for x in keys + ['20190901.csv.gz']]})
+
+    def test_main_unload(self) -> None:
+        """"
+        mainのテスト (UNLOADで書き出す場合)
+        """
+        envs = {'BUCKET_DOWNLOAD': self.download_bucket_name,
+                'TABLE_LOCATION': 'spectrum.test',
+                'EXPORT_ENGINE': 'unload'}
+
+        # 環境変数上書き
+        old_values = dict()
+        for k, v in envs.items():
+            old_values[k] = os.environ.get(k)
+            os.environ[k] = v
+
+        self.assertEqual(main('20190901'), 'success')
+        body = self.s3.get_object(Bucket=self.download_bucket_name, Key='20190901.csv.gz')['Body'].read()
+        self.assertEqual(sorted(gzip.decompress(body).split(b'\n')),
+                         [b'',
+                          b'3313c918-55e4-4d15-879e-000000000000,35.71,135.11,1567273600\r',
+                          b'3313c918-55e4-4d15-879e-000000000001,35.72,135.12,1567273601\r',
+                          b'3313c918-55e4-4d15-879e-000000000002,35.73,135.13,1567273602\r'])
+        result = self.s3.list_objects_v2(Bucket=self.download_bucket_name, Prefix='_unload/')
+        self.assertEqual(result['KeyCount'], 0)  # UNLOADで書き出したファイルは削除されている
+
+        # 環境変数戻す
+        for k in envs.keys():
+            if old_values[k] is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = old_values[k]
+
+    def test_list_parted_file(self) -> None:
+        """
+        list_parted_fileのテスト
+        """
+        self.s3.put_object(Bucket=self.location_bucket_name, Key='parted/created_date=20190901/_compaction.json', Body=b'')
+        self.assertEqual(list_parted_file(self.location_bucket_name, 'parted/created_date=20190901/'),
+                         ['parted/created_date=20190901/test.csv.gz'])
+        self.s3.delete_object(Bucket=self.location_bucket_name, Key='parted/created_date=20190901/_compaction.json')
+
+    def test_convert_parted_file(self) -> None:
+        """
+        convert_parted_fileのテスト
+        """
+        [(data, records)] = convert_parted_file(self.location_bucket_name, 'parted/created_date=20190901/test.csv.gz')
+        self.assertEqual(records, 3)
+        self.assertEqual(gzip.decompress(data),
+                         bytes('3313c918-55e4-4d15-879e-000000000000,35.71,135.11,1567273600\r\n'
+                               + '3313c918-55e4-4d15-879e-000000000001,35.72,135.12,1567273601\r\n'
+                               + '3313c918-55e4-4d15-879e-000000000002,35.73,135.13,1567273602\r\n', 'ascii'))
+
+        # 最終行に改行が無い場合
+        key = 'parted/created_date=20190902/test.csv.gz'
+        self.s3.put_object(Bucket=self.location_bucket_name, Key=key, Body=gzip.compress(b'a,1,2,3\nb,1,2,3'))
+        [(data, records)] = convert_parted_file(self.location_bucket_name, key, 1)
+        self.assertEqual(records, 2)
+        self.assertEqual(gzip.decompress(data), b'a,1,2,3\r\nb,1,2,3\r\n')
+
+        # member_sizeを指定すると、レコードの区切りで複数のメンバーに分ける
+        lines = [bytes('3313c918-55e4-4d15-879e-{0:012d},35.7,135.1,{1}\n'.format(i, 1567450000 + i), 'ascii')
+                 for i in range(50000)]
+        self.s3.put_object(Bucket=self.location_bucket_name, Key=key, Body=gzip.compress(b''.join(lines)))
+        members = convert_parted_file(self.location_bucket_name, key, 1, 1)
+        self.assertGreater(len(members), 1)
+        for data, records in members:
+            self.assertEqual(gzip.decompress(data).count(b'\r\n'), records)  # メンバー単独で展開できる
+        self.assertEqual(b''.join([gzip.decompress(x[0]) for x in members]),
+                         b''.join(lines).replace(b'\n', b'\r\n'))
+        self.s3.delete_object(Bucket=self.location_bucket_name, Key=key)
+
+    def test_export_parted_location(self) -> None:
+        """
+        export_parted_locationのテスト
+        """
+        keys = ['parted/created_date=20190903/{}.csv.gz'.format(i) for i in range(5)]
+        for i, key in enumerate(keys):
+            self.s3.put_object(Bucket=self.location_bucket_name, Key=key, Body=gzip.compress(
+                bytes('3313c918-55e4-4d15-879e-{0:012d},35.7,135.1,{1}\n'.format(i, 1567450000 + i), 'ascii')))
+
+        records = export_parted_location('20190903', self.location_bucket_name, 'parted/', self.download_bucket_name,
+                                         2, 5 * 1024 * 1024)
+        self.assertEqual(records, 5)
+        body = self.s3.get_object(Bucket=self.download_bucket_name, Key='20190903.csv.gz')['Body'].read()
+        self.assertEqual(gzip.decompress(body), bytes(''.join(
+            ['3313c918-55e4-4d15-879e-{0:012d},35.7,135.1,{1}\r\n'.format(i, 1567450000 + i) for i in range(5)]),
+            'ascii'))
+
+        # データが無い場合は作成しない
+        self.assertEqual(export_parted_location('20190904', self.location_bucket_name, 'parted/',
+                                                self.download_bucket_name, 2, 5 * 1024 * 1024), 0)
+        result = self.s3.list_objects_v2(Bucket=self.download_bucket_name, Prefix='20190904.csv.gz')
+        self.assertEqual(result['KeyCount'], 0)
+
+        self.s3.delete_objects(Bucket=self.location_bucket_name, Delete={'Objects': [{'Key': x} for x in keys]})
+        self.s3.delete_object(Bucket=self.download_bucket_name, Key='20190903.csv.gz')
+
+    def test_segment_writer(self) -> None:
+        """
+        SegmentWriterのテスト
+        """
+        lines = [bytes('3313c918-55e4-4d15-879e-{0:012d},35.7,135.1,{1}\r\n'.format(i, 1567450000 + i), 'ascii')
+                 for i in range(100)]
+        writer = SegmentWriter(self.download_bucket_name, '20190905', 100, 1)
+        for i in range(0, 100, 10):  # 圧縮済みのメンバー単位でセグメントを区切る
+            writer.write_member(gzip.compress(b''.join(lines[i:i + 10])), 10)
+        writer.write(b'a,1,2,3\r\n')
+        self.assertEqual(writer.close(), 101)
+
+        manifest = get_manifest(self.download_bucket_name, '20190905.manifest.json')
+        self.assertEqual(manifest['records'], 101)
+        self.assertGreater(len(manifest['segments']), 1)
+        data = b''
+        for segment in manifest['segments']:
+            body = self.s3.get_object(Bucket=self.download_bucket_name, Key=segment['key'])['Body'].read()
+            self.assertEqual(len(body), segment['size'])
+            self.assertEqual(hashlib.md5(body).hexdigest(), segment['md5'])
+            self.assertEqual(gzip.decompress(body).count(b'\r\n'), segment['records'])  # セグメント単独で展開できる
+            data += gzip.decompress(body)
+        self.assertEqual(data, b''.join(lines) + b'a,1,2,3\r\n')
+
+        # メンバーを追加するとsegment_sizeを超える場合は、先にセグメントを区切る
+        member = gzip.compress(b''.join(lines[:10]))
+        writer = SegmentWriter(self.download_bucket_name, '20190905', len(member) * 2 + 1, 1, 0)
+        for i in range(0, 100, 10):
+            writer.write_member(gzip.compress(b''.join(lines[i:i + 10])), 10)
+        self.assertEqual(writer.close(), 100)
+        self.assertTrue(all([x['size'] <= writer.segment_size for x in writer.segments]))
+
+        # 書き直すと、前回のセグメントはgrace秒を過ぎてから削除される (grace=0ならすぐに削除される)
+        writer = SegmentWriter(self.download_bucket_name, '20190905', 1024 * 1024, 6, 0)
+        writer.write(b''.join(lines))
+        self.assertEqual(writer.close(), 100)
+        result = self.s3.list_objects_v2(Bucket=self.download_bucket_name, Prefix='20190905/')
+        self.assertEqual([x['Key'] for x in result['Contents']], [writer.segments[0]['key']])
+        previous = writer.segments[0]['key']
+
+        writer = SegmentWriter(self.download_bucket_name, '20190905', 1024 * 1024)
+        writer.write(b''.join(lines))
+        self.assertEqual(writer.close(), 100)
+        result = self.s3.list_objects_v2(Bucket=self.download_bucket_name, Prefix='20190905/')
+        self.assertEqual(sorted([x['Key'] for x in result['Contents']]), sorted([previous, writer.segments[0]['key']]))
+        manifest = get_manifest(self.download_bucket_name, '20190905.manifest.json')
+        self.assertEqual([x['key'] for x in manifest['expired']], [previous])
+        self.assertGreater(manifest['expired'][0]['delete_after'], time.time())
+
+        remove_stale_output(self.download_bucket_name, '20190905', False)  # 削除を待っているセグメントも削除する
+        result = self.s3.list_objects_v2(Bucket=self.download_bucket_name, Prefix='20190905')
+        self.assertEqual(result['KeyCount'], 0)
+
+    def test_remove_stale_output(self) -> None:
+        """
+        remove_stale_outputのテスト
+        """
+        writer = SegmentWriter(self.download_bucket_name, '20190906', 1024 * 1024)
+        writer.write(b'a,1,2,3\r\n')
+        writer.close()
+        self.s3.put_object(Bucket=self.download_bucket_name, Key='20190906.csv.gz', Body=gzip.compress(b'a,1,2,3\r\n'))
+
+        # 分割して書き出した場合は、"YYYYMMDD.csv.gz"を削除する
+        remove_stale_output(self.download_bucket_name, '20190906', True)
+        result = self.s3.list_objects_v2(Bucket=self.download_bucket_name, Prefix='20190906')
+        self.assertEqual(sorted([x['Key'] for x in result['Contents']]),
+                         ['20190906.manifest.json', writer.segments[0]['key']])
+
+        # 分割せずに書き出した場合は、マニフェストとセグメントを削除する
+        self.s3.put_object(Bucket=self.download_bucket_name, Key='20190906.csv.gz', Body=gzip.compress(b'a,1,2,3\r\n'))
+        remove_stale_output(self.download_bucket_name, '20190906', False)
+        result = self.s3.list_objects_v2(Bucket=self.download_bucket_name, Prefix='20190906')
+        self.assertEqual([x['Key'] for x in result['Contents']], ['20190906.csv.gz'])
+        remove_stale_output(self.download_bucket_name, '20190906', False)  # マニフェストが無くても良い
+
+        self.s3.delete_object(Bucket=self.download_bucket_name, Key='20190906.csv.gz')
+
+    def test_parse_ymd_args(self) -> None:
+        """
+        parse_ymd_argsのテスト
+        """
+        self.assertEqual(parse_ymd_args(['20190901']), ['20190901'])
+        self.assertEqual(parse_ymd_args(['20190830-20190902', '20190901', '20200228-20200301']),
+                         ['20190830', '20190831', '20190901', '20190902', '20200228', '20200229', '20200301'])
+        self.assertEqual(parse_ymd_args(['20190902-20190901']), [])
+        with self.assertRaises(ValueError):
+            parse_ymd_args(['2019-09-01'])
+
+    def test_main_days(self) -> None:
+        """"
+        main_daysのテスト (EXPORT_ENGINE=s3で複数日を書き出す場合)
+        """
+        envs = {'BUCKET_DOWNLOAD': self.download_bucket_name,
+                'BUCKET_LOCATION': self.location_bucket_name,
+                'FOLDER_PARTED': 'parted/',
+                'EXPORT_ENGINE': 's3',
+                'SEGMENT_SIZE': '0'}
+
+        # 環境変数上書き
+        old_values = dict()
+        for k, v in envs.items():
+            old_values[k] = os.environ.get(k)
+            os.environ[k] = v
+
+        self.assertEqual(main_days(['20190831', '20190901']), 'success')
+        result = self.s3.get_object_tagging(Bucket=self.download_bucket_name, Key='20190901.csv.gz')
+        self.assertIn({'Key': 'records', 'Value': '3'}, result['TagSet'])
+        result = self.s3.list_objects_v2(Bucket=self.download_bucket_name, Prefix='20190831.csv.gz')
+        self.assertEqual(result['KeyCount'], 0)
+
+        # 元のオブジェクトが変わっていなければ書き出さない
+        last_modified = self.s3.head_object(Bucket=self.download_bucket_name, Key='20190901.csv.gz')['LastModified']
+        time.sleep(1)
+        self.assertEqual(main_days(['20190901']), 'success')
+        self.assertEqual(self.s3.head_object(Bucket=self.download_bucket_name, Key='20190901.csv.gz')['LastModified'],
+                         last_modified)
+
+        # 分割の有無を切り替えると、以前の形式の結果は削除される
+        os.environ['SEGMENT_SIZE'] = str(1024 * 1024)
+        self.assertEqual(main_days(['20190901']), 'success')
+        self.assertEqual(get_manifest(self.download_bucket_name, '20190901.manifest.json')['records'], 3)
+        result = self.s3.list_objects_v2(Bucket=self.download_bucket_name, Prefix='20190901.csv.gz')
+        self.assertEqual(result['KeyCount'], 0)
+        os.environ['SEGMENT_SIZE'] = '0'
+        self.assertEqual(main_days(['20190901']), 'success')
+        self.assertIsNone(get_manifest(self.download_bucket_name, '20190901.manifest.json'))
+        result = self.s3.list_objects_v2(Bucket=self.download_bucket_name, Prefix='20190901/')
+        self.assertEqual(result['KeyCount'], 0)
+        self.assertIn({'Key': 'records', 'Value': '3'},
+                      self.s3.get_object_tagging(Bucket=self.download_bucket_name, Key='20190901.csv.gz')['TagSet'])
+
+        # 不正な設定は例外とせず、エラーとして返す
+        os.environ['EXPORT_ENGINE'] = 'unknown'
+        self.assertEqual(main_days(['20190901']), 'error')
+        os.environ['EXPORT_ENGINE'] = 'unload'
+        os.environ['SEGMENT_SIZE'] = str(1024 * 1024)
+        self.assertEqual(main_days(['20190901']), 'error')
+
+        # 環境変数戻す
+        for k in envs.keys():
+            if old_values[k] is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = old_values[k]
+
     def test_main(self) -> None:
         """"
         mainのテスト
@@ -0,0 +1,227 @@
+# coding=utf-8
+
+"""
+compact_partition用テストファイル
+"""
+
+import unittest
+import boto3
+import uuid
+import os
+import io
+import gzip
+import json
+import warnings
+import pyarrow.parquet
+
+import sys
+
+sys.path.append('..')
+from compact_partition import list_partition_object, plan_compaction, merge_object, get_pending_outputs, \
+    compact_partition, main
+import retrieve_request
+from retrieve_request import ParquetUploadSink
+
+
+class TestCompactPartition(unittest.TestCase):
+    """
+    TestModule for compact_partition
+    """
+    s3, bucket_name = (None, None)
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        テスト用バケットを用意するなど
+        """
+        cls.s3 = boto3.client('s3')
+        cls.bucket_name = 'task3test' + str(uuid.uuid4())
+        cls.s3.create_bucket(Bucket=cls.bucket_name,
+                             CreateBucketConfiguration={'LocationConstraint': 'ap-northeast-1'})
+
+        # BOTO3かunittestの不具合避け
+        warnings.filterwarnings("ignore", category=ResourceWarning, message="unclosed.*<ssl.SSLSocket.*>")
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """
+        後片付け
+        """
+        response = cls.s3.list_objects_v2(Bucket=cls.bucket_name)
+        if 'Contents' in response:
+            cls.s3.delete_objects(Bucket=cls.bucket_name,
+                                  Delete={'Objects': [{'Key': x['Key']} for x in response['Contents']]})
+        cls.s3.delete_bucket(Bucket=cls.bucket_name)
+
+    def putDummyObjects(self, prefix: str, count: int) -> bytes:
+        """
+        gzip圧縮したCSVのオブジェクトをcount個作成し、全体の内容を返す
+        """
+        result = b''
+        for i in range(count):
+            body = bytes('3313c918-55e4-4d15-879e-{0:012d},35.7,135.1,{1}\n'.format(i, 1567263600 + i), 'ascii')
+            self.s3.put_object(Bucket=self.bucket_name, Key='{0}{1}.csv.gz'.format(prefix, 1567296000 + i),
+                               Body=gzip.compress(body))
+            result += body
+        return result
+
+    def readPartition(self, prefix: str) -> bytes:
+        """
+        パーティション内のgzip圧縮したCSVを、Spectrumと同じく"_"で始まるものを除いて読み込む
+        """
+        return b''.join([gzip.decompress(self.s3.get_object(Bucket=self.bucket_name, Key=x['Key'])['Body'].read())
+                         for x in list_partition_object(self.bucket_name, prefix)
+                         if x['Key'].endswith('.csv.gz') and not x['Key'].rsplit('/', 1)[-1].startswith('_')])
+
+    def test_plan_compaction(self) -> None:
+        """
+        plan_compactionのテスト
+        """
+        objects = [{'Key': 'p/1.csv.gz', 'Size': 10},
+                   {'Key': 'p/2.csv.gz', 'Size': 100},   # min_size以上
+                   {'Key': 'p/3.csv.gz', 'Size': 20},
+                   {'Key': 'p/4.csv.gz', 'Size': 30},
+                   {'Key': 'p/5.csv.gz', 'Size': 10},
+                   {'Key': 'p/_6.csv.gz', 'Size': 10},   # Spectrumが読まない
+                   {'Key': 'p/7.parquet', 'Size': 10},
+                   {'Key': 'p/8.parquet', 'Size': 10},
+                   {'Key': 'p/9.txt', 'Size': 10}]
+        self.assertEqual(plan_compaction(objects, 50, 100),
+                         [['p/1.csv.gz', 'p/3.csv.gz', 'p/4.csv.gz'], ['p/7.parquet', 'p/8.parquet']])
+        self.assertEqual(plan_compaction(objects, 1000, 100),
+                         [['p/1.csv.gz', 'p/3.csv.gz', 'p/4.csv.gz', 'p/5.csv.gz'], ['p/7.parquet', 'p/8.parquet']])
+        self.assertEqual(plan_compaction(objects[:2], 1000, 100), [])
+
+    def test_merge_object(self) -> None:
+        """
+        merge_objectのテスト
+        """
+        # gzip
+        expected = self.putDummyObjects('parted1/', 3)
+        keys = [x['Key'] for x in list_partition_object(self.bucket_name, 'parted1/')]
+        merge_object(self.bucket_name, keys, 'merged1/merged.csv.gz', 5 * 1024 * 1024)
+        body = self.s3.get_object(Bucket=self.bucket_name, Key='merged1/merged.csv.gz')['Body'].read()
+        self.assertEqual(gzip.decompress(body), expected)
+
+        # Parquet
+        lines = [bytes('3313c918-55e4-4d15-879e-{0:012d},35.7,135.1,{1}\n'.format(i, 1567263600 + i), 'ascii')
+                 for i in range(4)]
+        for i in range(2):
+            sink = ParquetUploadSink(self.bucket_name, 'parted1/{}.parquet'.format(i), 5 * 1024 * 1024, 1000)
+            sink.write(b''.join(lines[i * 2:i * 2 + 2]))
+            sink.close()
+        merge_object(self.bucket_name, ['parted1/0.parquet', 'parted1/1.parquet'], 'merged1/merged.parquet',
+                     5 * 1024 * 1024)
+        body = self.s3.get_object(Bucket=self.bucket_name, Key='merged1/merged.parquet')['Body'].read()
+        self.assertEqual([x['created_at'] for x in pyarrow.parquet.read_table(io.BytesIO(body)).to_pylist()],
+                         [1567263600 + i for i in range(4)])
+
+        # pyarrowが無い場合
+        pyarrow_module = retrieve_request.pyarrow
+        retrieve_request.pyarrow = None
+        try:
+            self.assertRaisesRegex(ValueError, 'pyarrow', merge_object, self.bucket_name,
+                                   ['parted1/0.parquet', 'parted1/1.parquet'], 'merged1/merged2.parquet',
+                                   5 * 1024 * 1024)
+        finally:
+            retrieve_request.pyarrow = pyarrow_module
+
+    def test_compact_partition(self) -> None:
+        """
+        compact_partitionのテスト
+        """
+        prefix = 'parted2/created_date=20190901/'
+        expected = self.putDummyObjects(prefix, 5)
+
+        keys = compact_partition(self.bucket_name, prefix, 1024 * 1024, 1024 * 1024, 5 * 1024 * 1024)
+        self.assertEqual(len(keys), 1)
+        self.assertEqual([x['Key'] for x in list_partition_object(self.bucket_name, prefix)], keys)
+        self.assertEqual(self.readPartition(prefix), expected)
+
+        # 再実行しても変わらない
+        self.assertEqual(compact_partition(self.bucket_name, prefix, 1024 * 1024, 1024 * 1024, 5 * 1024 * 1024), [])
+        self.assertEqual([x['Key'] for x in list_partition_object(self.bucket_name, prefix)], keys)
+
+        # 後から追加されたオブジェクトもまとめられる
+        self.s3.put_object(Bucket=self.bucket_name, Key=prefix + '1567400000.csv.gz',
+                           Body=gzip.compress(b'3313c918-55e4-4d15-879e-000000000099,35.7,135.1,1567263699\n'))
+        keys = compact_partition(self.bucket_name, prefix, 1024 * 1024, 1024 * 1024, 5 * 1024 * 1024)
+        self.assertEqual([x['Key'] for x in list_partition_object(self.bucket_name, prefix)], keys)
+        self.assertEqual(sorted(self.readPartition(prefix).splitlines()),
+                         sorted((expected + b'3313c918-55e4-4d15-879e-000000000099,35.7,135.1,1567263699\n')
+                                .splitlines()))
+
+    def test_compact_partition_resume(self) -> None:
+        """
+        入れ替えの途中で中断した場合のテスト
+        """
+        prefix = 'parted3/created_date=20190901/'
+        expected = self.putDummyObjects(prefix, 3)
+        inputs = [x['Key'] for x in list_partition_object(self.bucket_name, prefix)]
+
+        # まとめたオブジェクトを書き出し、元のオブジェクトの一部を削除した後、コピーする前に中断した
+        merge_object(self.bucket_name, inputs, prefix + '_compact-1-0000.csv.gz', 5 * 1024 * 1024)
+        self.s3.delete_object(Bucket=self.bucket_name, Key=inputs[0])
+        self.s3.put_object(Bucket=self.bucket_name, Key=prefix + '_compaction.json', Body=bytes(json.dumps({
+            'outputs': [{'staging': prefix + '_compact-1-0000.csv.gz', 'key': prefix + 'compact-1-0000.csv.gz'}],
+            'inputs': inputs}), 'utf-8'))
+        # 書き出し途中で中断したオブジェクト
+        self.s3.put_object(Bucket=self.bucket_name, Key=prefix + '_compact-2-0000.csv.gz', Body=b'')
+
+        self.assertEqual(compact_partition(self.bucket_name, prefix, 1024 * 1024, 1024 * 1024, 5 * 1024 * 1024), [])
+        self.assertEqual([x['Key'] for x in list_partition_object(self.bucket_name, prefix)],
+                         [prefix + 'compact-1-0000.csv.gz'])
+        self.assertEqual(self.readPartition(prefix), expected)
+
+    def test_compact_partition_pending(self) -> None:
+        """
+        retrieve_requestの処理中のバッチが書き出したオブジェクトを除く場合のテスト
+        """
+        prefix = 'parted5/created_date=20190901/'
+        self.putDummyObjects(prefix, 3)
+        inputs = [x['Key'] for x in list_partition_object(self.bucket_name, prefix)]
+
+        self.assertEqual(get_pending_outputs(self.bucket_name, 'checkpoint5/retrieve_request.json'), [])
+        self.s3.put_object(Bucket=self.bucket_name, Key='checkpoint5/retrieve_request.json', Body=bytes(json.dumps({
+            'batch': {'id': '1', 'state': 'uploading', 'inputs': ['work/a.csv'], 'outputs': [inputs[2]]},
+            'history': []}), 'utf-8'))
+        pending = get_pending_outputs(self.bucket_name, 'checkpoint5/retrieve_request.json')
+        self.assertEqual(pending, [inputs[2]])
+
+        keys = compact_partition(self.bucket_name, prefix, 1024 * 1024, 1024 * 1024, 5 * 1024 * 1024, pending)
+        self.assertEqual(len(keys), 1)
+        self.assertEqual([x['Key'] for x in list_partition_object(self.bucket_name, prefix)], [inputs[2]] + keys)
+
+        # 残りが一つだけなら、まとめない
+        self.s3.delete_object(Bucket=self.bucket_name, Key=keys[0])
+        self.assertEqual(compact_partition(self.bucket_name, prefix, 1024 * 1024, 1024 * 1024, 5 * 1024 * 1024,
+                                           pending), [])
+
+    def test_main(self) -> None:
+        """
+        mainのテスト
+        """
+        envs = {'BUCKET_LOCATION': self.bucket_name,
+                'FOLDER_PARTED': 'parted4/'}
+
+        # 環境変数上書き
+        old_values = dict()
+        for k, v in envs.items():
+            old_values[k] = os.environ.get(k)
+            os.environ[k] = v
+
+        expected = self.putDummyObjects('parted4/created_date=20190901/', 3)
+        self.assertEqual(main(['20190901', '20190902']), 'success')
+        self.assertEqual(len(list_partition_object(self.bucket_name, 'parted4/created_date=20190901/')), 1)
+        self.assertEqual(self.readPartition('parted4/created_date=20190901/'), expected)
+
+        # 環境変数戻す
+        for k in envs.keys():
+            if old_values[k] is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = old_values[k]
+
+
+if __name__ == "__main__":
+    unittest.main()
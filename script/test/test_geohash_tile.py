@@ -0,0 +1,61 @@
+# coding=utf-8
+
+"""
+geohash_tile用テストファイル
+"""
+
+import unittest
+
+import sys
+
+sys.path.append('..')
+from geohash_tile import encode_geohash, get_tile, get_tile_prefix, get_tile_ranges, INVALID_TILE
+
+
+class TestGeohashTile(unittest.TestCase):
+    """
+    TestModule for geohash_tile
+    """
+
+    def test_encode_geohash(self) -> None:
+        """
+        encode_geohashのテスト
+        """
+        self.assertEqual(encode_geohash(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(encode_geohash(35.681236, 139.767125, 7), 'xn76urx')
+        self.assertEqual(encode_geohash(35.681236, 139.767125, 1), 'x')
+        self.assertEqual(encode_geohash(-90, -180, 5), '00000')
+        self.assertEqual(encode_geohash(90, 180, 5), 'zzzzz')
+        self.assertEqual(encode_geohash(0, 0, 2), 's0')  # 境界上は大きい側
+        self.assertRaises(ValueError, encode_geohash, 90.1, 0, 5)
+        self.assertRaises(ValueError, encode_geohash, float('nan'), 0, 5)
+
+    def test_get_tile(self) -> None:
+        """
+        get_tileのテスト
+        """
+        self.assertEqual(get_tile(b'3313c918-55e4-4d15-879e-d9fb076a86df,35.681236,139.767125,1567263600\n', 4),
+                         'xn76')
+        self.assertEqual(get_tile(b'3313c918-55e4-4d15-879e-d9fb076a86df, 35.681236 ,139.767125,1567263600', 4),
+                         'xn76')
+        self.assertEqual(get_tile(b'3313c918-55e4-4d15-879e-d9fb076a86df,a,139.767125,1567263600\n', 4), INVALID_TILE)
+        self.assertEqual(get_tile(b'3313c918-55e4-4d15-879e-d9fb076a86df,135.7,1567263600\n', 4), INVALID_TILE)
+        self.assertEqual(get_tile(b'', 4), INVALID_TILE)
+
+    def test_get_tile_prefix(self) -> None:
+        """
+        get_tile_prefixのテスト
+        """
+        self.assertEqual(get_tile_prefix('tiles/', '20190901'), 'tiles/created_date=20190901/')
+
+    def test_get_tile_ranges(self) -> None:
+        """
+        get_tile_rangesのテスト
+        """
+        index_list = [{'key': 'a.csv.gz', 'precision': 3, 'records': 6,
+                       'tiles': {'_': [0, 10, 1], 'xn0': [10, 20, 2], 'xn7': [30, 5, 1], 'xp0': [35, 10, 2]}},
+                      {'key': 'b.csv.gz', 'precision': 3, 'records': 1, 'tiles': {'xn7': [0, 8, 1]}}]
+        self.assertEqual(get_tile_ranges(index_list, 'xn'), [('a.csv.gz', 10, 35), ('b.csv.gz', 0, 8)])
+        self.assertEqual(get_tile_ranges(index_list, 'xn76'), [('a.csv.gz', 30, 35), ('b.csv.gz', 0, 8)])
+        self.assertEqual(get_tile_ranges(index_list, 'x'), [('a.csv.gz', 10, 45), ('b.csv.gz', 0, 8)])
+        self.assertEqual(get_tile_ranges(index_list, 'u'), [])
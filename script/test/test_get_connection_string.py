@@ -32,5 +32,16 @@ class TestGetConnectionString(unittest.TestCase):
                 fd.write(b'hogehoge.com:5432:name:scott:tiger\n\n')
             self.assertEqual(get_connection_string(temp_file.name),
                              'dbname=name user=scott password=tiger host=hogehoge.com port=5432')
+
+            # 更新されていなければキャッシュした内容を返し、更新されていれば読み直す
+            mtime = os.stat(temp_file.name).st_mtime
+            with open(temp_file.name, 'wb') as fd:
+                fd.write(b'fugafuga.com:5439:name:scott:tiger\n')
+            os.utime(temp_file.name, (mtime, mtime))
+            self.assertEqual(get_connection_string(temp_file.name),
+                             'dbname=name user=scott password=tiger host=hogehoge.com port=5432')
+            os.utime(temp_file.name, (mtime + 1, mtime + 1))
+            self.assertEqual(get_connection_string(temp_file.name),
+                             'dbname=name user=scott password=tiger host=fugafuga.com port=5439')
         finally:
             os.remove(temp_file.name)
@@ -0,0 +1,223 @@
+# coding=utf-8
+
+"""
+match_shop用テストファイル
+"""
+
+import unittest
+import boto3
+import uuid
+import os
+import gzip
+import warnings
+import numpy
+
+import sys
+
+sys.path.append('..')
+import match_shop
+from match_shop import ShopIndex, haversine, parse_shops, read_chunks, match_chunk, match_partition, main
+from retrieve_request import ParquetUploadSink
+
+SHOPS = b'1,35.681236,139.767125\n2,35.681236,139.768225\n3,34.702485,135.495951\n'  # 東京駅, その約100m東, 大阪駅
+LOCATIONS = b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.681236,139.767125,1567263600\n' \
+            b'3313c918-55e4-4d15-879e-d9fb076a86d1,35.681236,139.767675,1567263601\n' \
+            b'3313c918-55e4-4d15-879e-d9fb076a86d2,34.7025,135.4960,1567263602\n' \
+            b'3313c918-55e4-4d15-879e-d9fb076a86d3,35.0,139.0,1567263603\n' \
+            b'3313c918-55e4-4d15-879e-d9fb076a86d4,a,139.767125,1567263604\n'
+SPLIT = LOCATIONS.index(b'\n', 100) + 1  # 2行目と3行目の間
+
+
+class TestMatchShop(unittest.TestCase):
+    """
+    TestModule for match_shop
+    """
+    s3, bucket_name = (None, None)
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        テスト用バケットを用意するなど
+        """
+        cls.s3 = boto3.client('s3')
+        cls.bucket_name = 'task3test' + str(uuid.uuid4())
+        cls.s3.create_bucket(Bucket=cls.bucket_name,
+                             CreateBucketConfiguration={'LocationConstraint': 'ap-northeast-1'})
+
+        # BOTO3かunittestの不具合避け
+        warnings.filterwarnings("ignore", category=ResourceWarning, message="unclosed.*<ssl.SSLSocket.*>")
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """
+        後片付け
+        """
+        response = cls.s3.list_objects_v2(Bucket=cls.bucket_name)
+        if 'Contents' in response:
+            cls.s3.delete_objects(Bucket=cls.bucket_name,
+                                  Delete={'Objects': [{'Key': x['Key']} for x in response['Contents']]})
+        cls.s3.delete_bucket(Bucket=cls.bucket_name)
+
+    def test_haversine(self) -> None:
+        """
+        haversineのテスト
+        """
+        self.assertAlmostEqual(float(haversine(35.681236, 139.767125, 35.681236, 139.767125)), 0)
+        self.assertAlmostEqual(float(haversine(0, 0, 1, 0)), 111195, delta=1)
+        self.assertAlmostEqual(float(haversine(35.681236, 139.767125, 34.702485, 135.495951)), 403000, delta=1000)
+
+    def test_shop_index(self) -> None:
+        """
+        ShopIndexのテスト (全ての組の距離を求めた結果と比較する)
+        """
+        rng = numpy.random.default_rng(0)
+        latitude, longitude = rng.uniform(35, 35.1, 500), rng.uniform(139, 139.1, 500)
+        shops = ShopIndex(numpy.arange(500) + 1, latitude, longitude, 300)
+        location_latitude, location_longitude = rng.uniform(35, 35.1, 5000), rng.uniform(139, 139.1, 5000)
+        location_latitude[0] = numpy.nan
+
+        rows, shop_index, distance = shops.match(location_latitude, location_longitude)
+        expected = haversine(location_latitude[:, None], location_longitude[:, None], latitude[None, :],
+                             longitude[None, :])
+        expected_rows, expected_shops = numpy.nonzero(expected <= 300)
+        self.assertGreater(len(rows), 0)
+        self.assertEqual(rows.tolist(), expected_rows.tolist())
+        self.assertEqual(shop_index.tolist(), (expected_shops + 1).tolist())
+        self.assertTrue(numpy.allclose(distance, expected[expected_rows, expected_shops]))
+
+        # 候補の組がMAX_MATCH_PAIRSを超える場合は、レコードを区切って求める (一件で超える場合も含む)
+        old_max_pairs = match_shop.MAX_MATCH_PAIRS
+        try:
+            for max_pairs in [1000, 1]:
+                match_shop.MAX_MATCH_PAIRS = max_pairs
+                result = shops.match(location_latitude, location_longitude)
+                self.assertEqual(result[0].tolist(), rows.tolist())
+                self.assertEqual(result[1].tolist(), shop_index.tolist())
+                self.assertTrue(numpy.allclose(result[2], distance))
+        finally:
+            match_shop.MAX_MATCH_PAIRS = old_max_pairs
+
+        # 店舗が無い場合
+        shops = ShopIndex(numpy.zeros(0), numpy.zeros(0), numpy.zeros(0), 300)
+        self.assertEqual(len(shops.match(location_latitude, location_longitude)[0]), 0)
+
+    def test_parse_shops(self) -> None:
+        """
+        parse_shopsのテスト
+        """
+        shops = parse_shops(SHOPS, 100)
+        self.assertEqual(sorted(shops.shop_index.tolist()), [1, 2, 3])
+        self.assertEqual(len(parse_shops(b'', 100).shop_index), 0)
+        self.assertRaises(ValueError, parse_shops, b'1,35.681236\n', 100)
+
+    def test_read_chunks(self) -> None:
+        """
+        read_chunksのテスト
+        """
+        # gzipのメンバーを連結したCSVは、展開後chunk_bytes程度の行の区切りで分ける
+        self.s3.put_object(Bucket=self.bucket_name, Key='chunks/data.csv.gz',
+                           Body=gzip.compress(LOCATIONS[:SPLIT]) + gzip.compress(LOCATIONS[SPLIT:]))
+        chunks = list(read_chunks(self.bucket_name, 'chunks/data.csv.gz', 100))
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all([x.endswith(b'\n') for x in chunks]))
+        self.assertEqual(b''.join(chunks), LOCATIONS)
+        self.assertEqual(list(read_chunks(self.bucket_name, 'chunks/data.csv.gz', 1024)), [LOCATIONS])
+
+        # 最終行に改行が無い場合
+        self.s3.put_object(Bucket=self.bucket_name, Key='chunks/noeol.csv.gz', Body=gzip.compress(LOCATIONS[:-1]))
+        self.assertEqual(b''.join(read_chunks(self.bucket_name, 'chunks/noeol.csv.gz', 100)), LOCATIONS)
+
+        # Parquetはrow group毎に分ける
+        sink = ParquetUploadSink(self.bucket_name, 'chunks/data.parquet', 5 * 1024 * 1024, 2)
+        for line in LOCATIONS.splitlines(keepends=True):
+            sink.write(line)
+        sink.close()
+        chunks = list(read_chunks(self.bucket_name, 'chunks/data.parquet', 100))
+        self.assertEqual([x.num_rows for x in chunks], [2, 2, 1])
+
+    def test_match_chunk(self) -> None:
+        """
+        match_chunkのテスト
+        """
+        shops = parse_shops(SHOPS, 100)
+        expected = b'3313c918-55e4-4d15-879e-d9fb076a86d0,1,1567263600,0.0\n' \
+                   b'3313c918-55e4-4d15-879e-d9fb076a86d0,2,1567263600,99.4\n' \
+                   b'3313c918-55e4-4d15-879e-d9fb076a86d1,1,1567263601,49.7\n' \
+                   b'3313c918-55e4-4d15-879e-d9fb076a86d1,2,1567263601,49.7\n' \
+                   b'3313c918-55e4-4d15-879e-d9fb076a86d2,3,1567263602,4.8\n'
+        member, records = match_chunk(LOCATIONS, shops)
+        self.assertEqual(records, 5)
+        self.assertEqual(gzip.decompress(member), expected)
+
+        sink = ParquetUploadSink(self.bucket_name, 'parquet/data.parquet', 5 * 1024 * 1024, 1000)
+        sink.write(LOCATIONS)
+        sink.close()
+        member, records = match_chunk(next(read_chunks(self.bucket_name, 'parquet/data.parquet', 100)), shops)
+        self.assertEqual(records, 5)
+        self.assertEqual(gzip.decompress(member), expected)
+
+    def test_match_partition(self) -> None:
+        """
+        match_partitionのテスト
+        """
+        prefix = 'parted1/created_date=20190901/'
+        self.s3.put_object(Bucket=self.bucket_name, Key=prefix + '1.csv.gz',
+                           Body=gzip.compress(LOCATIONS[:SPLIT]))
+        self.s3.put_object(Bucket=self.bucket_name, Key=prefix + '2.csv.gz',
+                           Body=gzip.compress(LOCATIONS[SPLIT:]))
+        self.s3.put_object(Bucket=self.bucket_name, Key=prefix + '_3.csv.gz', Body=gzip.compress(LOCATIONS))
+
+        shops = parse_shops(SHOPS, 100)
+        for processes in [0, 2]:
+            for chunk_bytes in [1024, 60]:  # 60の場合はオブジェクト内も一行ずつのチャンクに分ける
+                records = match_partition('20190901', self.bucket_name, 'parted1/', 'matched1/20190901.csv.gz',
+                                          shops, processes, 5 * 1024 * 1024, chunk_bytes)
+                self.assertEqual(records, 5)
+                body = self.s3.get_object(Bucket=self.bucket_name, Key='matched1/20190901.csv.gz')['Body'].read()
+                self.assertEqual(gzip.decompress(body), b'3313c918-55e4-4d15-879e-d9fb076a86d0,1,1567263600,0.0\n'
+                                                        b'3313c918-55e4-4d15-879e-d9fb076a86d0,2,1567263600,99.4\n'
+                                                        b'3313c918-55e4-4d15-879e-d9fb076a86d1,1,1567263601,49.7\n'
+                                                        b'3313c918-55e4-4d15-879e-d9fb076a86d1,2,1567263601,49.7\n'
+                                                        b'3313c918-55e4-4d15-879e-d9fb076a86d2,3,1567263602,4.8\n')
+
+        # 該当日のデータが無い場合は空のオブジェクトとなる
+        self.assertEqual(match_partition('20190902', self.bucket_name, 'parted1/', 'matched1/20190902.csv.gz',
+                                         shops, 0, 5 * 1024 * 1024), 0)
+
+    def test_main(self) -> None:
+        """
+        mainのテスト
+        """
+        envs = {'BUCKET_LOCATION': self.bucket_name,
+                'FOLDER_PARTED': 'parted2/',
+                'FOLDER_MATCH': 'matched2/',
+                'SHOP_KEY': 'shop2/shop.csv',
+                'MATCH_RADIUS': '10',
+                'MATCH_PROCESSES': '1'}
+
+        # 環境変数上書き
+        old_values = dict()
+        for k, v in envs.items():
+            old_values[k] = os.environ.get(k)
+            os.environ[k] = v
+
+        self.assertEqual(main(['20190901']), 'error')  # 店舗のCSVが無い
+
+        self.s3.put_object(Bucket=self.bucket_name, Key='shop2/shop.csv', Body=SHOPS)
+        self.s3.put_object(Bucket=self.bucket_name, Key='parted2/created_date=20190901/1.csv.gz',
+                           Body=gzip.compress(LOCATIONS))
+        self.assertEqual(main(['20190901']), 'success')
+        body = self.s3.get_object(Bucket=self.bucket_name, Key='matched2/20190901.csv.gz')['Body'].read()
+        self.assertEqual(gzip.decompress(body), b'3313c918-55e4-4d15-879e-d9fb076a86d0,1,1567263600,0.0\n'
+                                                b'3313c918-55e4-4d15-879e-d9fb076a86d2,3,1567263602,4.8\n')
+
+        # 環境変数戻す
+        for k in envs.keys():
+            if old_values[k] is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = old_values[k]
+
+
+if __name__ == "__main__":
+    unittest.main()
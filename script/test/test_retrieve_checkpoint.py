@@ -0,0 +1,128 @@
+# coding=utf-8
+
+"""
+retrieve_checkpoint用テストファイル
+"""
+
+import unittest
+import boto3
+import uuid
+import json
+import warnings
+
+import sys
+
+sys.path.append('..')
+from retrieve_checkpoint import Checkpoint, delete_keys, STATE_STARTED, STATE_UPLOADING, STATE_COMMITTED
+
+
+class TestRetrieveCheckpoint(unittest.TestCase):
+    """
+    TestModule for retrieve_checkpoint
+    """
+    s3, bucket_name = (None, None)
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        テスト用バケットを用意するなど
+        """
+        cls.s3 = boto3.client('s3')
+        cls.bucket_name = 'task3test' + str(uuid.uuid4())
+        cls.s3.create_bucket(Bucket=cls.bucket_name,
+                             CreateBucketConfiguration={'LocationConstraint': 'ap-northeast-1'})
+
+        # BOTO3かunittestの不具合避け
+        warnings.filterwarnings("ignore", category=ResourceWarning, message="unclosed.*<ssl.SSLSocket.*>")
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """
+        後片付け
+        """
+        response = cls.s3.list_objects_v2(Bucket=cls.bucket_name)
+        if 'Contents' in response:
+            cls.s3.delete_objects(Bucket=cls.bucket_name,
+                                  Delete={'Objects': [{'Key': x['Key']} for x in response['Contents']]})
+        cls.s3.delete_bucket(Bucket=cls.bucket_name)
+
+    def putObjects(self, keys: list) -> None:
+        """
+        空のオブジェクトを作成する
+        """
+        for key in keys:
+            self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=b'x')
+
+    def listKeys(self, prefix: str) -> list:
+        """
+        prefix以下のキーの一覧
+        """
+        response = self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix=prefix)
+        return sorted([x['Key'] for x in response.get('Contents', [])])
+
+    def test_checkpoint(self) -> None:
+        """
+        Checkpointの状態遷移のテスト
+        """
+        key = 'checkpoint1/retrieve_request.json'
+        checkpoint = Checkpoint(self.s3, self.bucket_name, key)
+        checkpoint.recover()  # 存在しない場合は空の状態
+        self.assertIsNone(checkpoint.batch)
+        self.assertEqual(checkpoint.history, [])
+
+        checkpoint.begin('100-0000', ['work/a.csv'])
+        self.assertEqual(json.loads(self.s3.get_object(Bucket=self.bucket_name, Key=key)['Body'].read())
+                         ['batch']['state'], STATE_STARTED)
+
+        checkpoint.uploading(['parted/created_date=20190901/100-0000.csv.gz'])
+        checkpoint.commit()
+        saved = Checkpoint(self.s3, self.bucket_name, key)
+        saved.load()
+        self.assertEqual(saved.batch['state'], STATE_COMMITTED)
+        self.assertEqual(saved.batch['outputs'], ['parted/created_date=20190901/100-0000.csv.gz'])
+
+        checkpoint.finish()
+        saved.load()
+        self.assertIsNone(saved.batch)
+        self.assertEqual([x['id'] for x in saved.history], ['100-0000'])
+        self.assertEqual(saved.history[0]['inputs'], ['work/a.csv'])
+
+    def test_recover(self) -> None:
+        """
+        中断した状態毎の回復のテスト
+        """
+        inputs = ['work3/a.csv', 'work3/b.csv']
+        outputs = ['parted3/created_date=20190901/100-0000.csv.gz']
+        for state, expected_work, expected_parted, history in [(STATE_STARTED, inputs, [], 0),
+                                                               (STATE_UPLOADING, inputs, [], 0),
+                                                               (STATE_COMMITTED, [], outputs, 1)]:
+            key = 'checkpoint3/' + state + '.json'
+            self.putObjects(inputs + outputs)
+            checkpoint = Checkpoint(self.s3, self.bucket_name, key)
+            checkpoint.begin('100-0000', inputs)
+            if state != STATE_STARTED:
+                checkpoint.uploading(outputs)
+            if state == STATE_COMMITTED:
+                checkpoint.commit()
+                self.s3.delete_object(Bucket=self.bucket_name, Key=inputs[0])  # 一部削除したところで中断
+
+            # 別のプロセスで再実行
+            checkpoint = Checkpoint(self.s3, self.bucket_name, key)
+            checkpoint.recover()
+            self.assertIsNone(checkpoint.batch)
+            self.assertEqual(len(checkpoint.history), history)
+            self.assertEqual(self.listKeys('work3/'), expected_work)
+            if state == STATE_STARTED:
+                expected_parted = outputs  # startedではoutputsは未記録なので削除しない
+            self.assertEqual(self.listKeys('parted3/'), expected_parted)
+
+            delete_keys(self.s3, self.bucket_name, inputs + outputs)
+
+    def test_delete_keys(self) -> None:
+        """
+        delete_keysのテスト
+        """
+        keys = ['delete/{0:04d}'.format(i) for i in range(1001)]
+        self.putObjects(keys)
+        delete_keys(self.s3, self.bucket_name, keys + ['delete/not-exists'])
+        self.assertEqual(self.listKeys('delete/'), [])
@@ -11,15 +11,22 @@ import os
 import warnings
 import tempfile
 import gzip
+import io
 import psycopg2
+import pyarrow.parquet
 import time
+import datetime
 
 import sys
 
 sys.path.append('..')
 from retrieve_request import list_location_file, get_base_time, separate_location, get_timestamp_and_buffer, \
-    remove_location_file, add_partition_to_redshift, get_date_str, compress_and_upload, main
+    separate_location_parallel, split_location_data, GzipUploadSink, ParquetUploadSink, TileUploadSink, parse_parquet_rows, split_text_bytes, split_text_numpy, remove_location_file, add_partition_to_redshift, add_partitions_to_redshift, get_date_str, compress_and_upload, select_closed_file, main
 from get_connection_string import get_connection_string
+import compact_partition
+import collect_request
+import work_file
+import geohash_tile
 
 
 class TestRetrieveRequest(unittest.TestCase):
@@ -162,6 +169,32 @@ class TestRetrieveRequest(unittest.TestCase):
                 'work/1567177199.csv'
             ]))
 
+        # サブフォルダ毎に並列に取得しても同じ結果になる
+        key = 'work/created_date=20190901/1567263601-0000.csv'
+        self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=b'')
+        expected = sorted(list_location_file(bucket=self.bucket_name, prefix='work/'))
+        self.assertIn(key, expected)
+        self.assertEqual(sorted(list_location_file(bucket=self.bucket_name, prefix='work/', workers=4)), expected)
+        self.s3.delete_object(Bucket=self.bucket_name, Key=key)
+
+    def test_select_closed_file(self) -> None:
+        """
+        select_closed_fileのテスト
+        """
+        self.assertEqual(
+            select_closed_file([
+                'work/',
+                'work/1567305370.csv',
+                'work/created_date=20190831/',
+                'work/created_date=20190831/1567296001-0000.csv.gz',
+                'work/created_date=20190901/1567296001-0000.csv.gz',
+                'work/created_date=20190902/1567296001-0000.csv.gz'
+            ], '20190901'),
+            [
+                'work/1567305370.csv',
+                'work/created_date=20190831/1567296001-0000.csv.gz'
+            ])
+
     def test_get_base_time(self) -> None:
         """
         get_base_timeのテスト
@@ -214,6 +247,205 @@ class TestRetrieveRequest(unittest.TestCase):
         self.assertTrue(os.path.exists(result[1567177200].name))
         [os.remove(t.name) for t in result.values()]
 
+        # 圧縮/バイナリ形式のファイルも同じ結果になる
+        lines = [b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,1567263600\n',
+                 b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,1567263599\n']
+        for fmt in ['csv.gz', 'bin', 'bin.gz']:
+            compressor = work_file.create_compressor(fmt)
+            body = b''.join([compressor.compress(work_file.encode_record(x, fmt)) for x in lines]) + compressor.flush()
+            self.s3.put_object(Bucket=self.bucket_name, Key='work5/1567263600.' + fmt, Body=body)
+            result = separate_location('work5/1567263600.' + fmt, dict(), bucket=self.bucket_name)
+            [t.close() for t in result.values()]
+            with open(result[1567263600].name, 'rb') as fd:
+                self.assertEqual(fd.read(), lines[0])
+            with open(result[1567177200].name, 'rb') as fd:
+                self.assertEqual(fd.read(), lines[1])
+            [os.remove(t.name) for t in result.values()]
+
+    def test_separate_location_parallel(self) -> None:
+        """
+        separate_location_parallelのテスト
+        """
+        file_list = sorted(list_location_file(bucket=self.bucket_name, prefix='work/'))
+
+        # 逐次処理の結果
+        expected = dict()
+        for file in file_list:
+            expected = separate_location(file, expected, bucket=self.bucket_name)
+        [t.close() for t in expected.values()]
+
+        # 並列数、振り分け待ちの上限、振り分け方法、プロセス数を変えても同じ結果になる
+        for workers, queue_size, max_bytes, mode, processes in [(2, 2, 1, 'line', 0),
+                                                                 (4, 16, 64 * 1024 * 1024, 'line', 0),
+                                                                 (16, 1, 1024, 'line', 0),
+                                                                 (4, 4, 1024, 'bytes', 0),
+                                                                 (4, 4, 1024, 'numpy', 0),
+                                                                 (4, 4, 1024, 'numpy', 2),
+                                                                 (4, 4, 1024, 'line', 2),
+                                                                 (4, 4, 1024, 'bytes', 2)]:
+            result = separate_location_parallel(file_list, dict(), self.bucket_name, workers, queue_size, max_bytes,
+                                                mode, processes)
+            [t.close() for t in result.values()]
+            self.assertEqual(sorted(result.keys()), sorted(expected.keys()))
+            for base_time, temp_file in result.items():
+                with open(temp_file.name, 'rb') as fd1, open(expected[base_time].name, 'rb') as fd2:
+                    self.assertEqual(fd1.read(), fd2.read())
+            [os.remove(t.name) for t in result.values()]
+
+        # 一時ファイルの代わりに、圧縮しながらアップロードする
+        sinks = dict()
+        separate_location_parallel(file_list, sinks, self.bucket_name, 4, 4, 1024, 'bytes', 0,
+                                   lambda base_time: GzipUploadSink(self.bucket_name, 'parted6/' + str(base_time) + '.gz',
+                                                                    5 * 1024 * 1024))
+        [t.close() for t in sinks.values()]
+        self.assertEqual(sorted(sinks.keys()), sorted(expected.keys()))
+        for base_time, temp_file in expected.items():
+            body = self.s3.get_object(Bucket=self.bucket_name, Key='parted6/' + str(base_time) + '.gz')['Body'].read()
+            with open(temp_file.name, 'rb') as fd:
+                self.assertEqual(gzip.decompress(body), fd.read())
+            self.s3.delete_object(Bucket=self.bucket_name, Key='parted6/' + str(base_time) + '.gz')
+
+        # 取得に失敗した場合は例外になる
+        result = dict()
+        self.assertRaises(Exception, separate_location_parallel, file_list + ['work/none.csv'], result,
+                          self.bucket_name, 4, 4, 1)
+        [t.close() for t in result.values()]
+        [os.remove(t.name) for t in result.values()]
+        [os.remove(t.name) for t in expected.values()]
+
+    def test_gzip_upload_sink(self) -> None:
+        """
+        GzipUploadSinkのテスト
+        """
+        # パートサイズに満たない場合は、closeでまとめて書き込む
+        sink = GzipUploadSink(self.bucket_name, 'parted5/small.csv.gz', 5 * 1024 * 1024)
+        sink.write(b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,1567263600\n')
+        sink.write(b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,1567263601\n')
+        self.assertEqual(self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix='parted5/')['KeyCount'], 0)
+        sink.close()
+        body = self.s3.get_object(Bucket=self.bucket_name, Key='parted5/small.csv.gz')['Body'].read()
+        self.assertEqual(gzip.decompress(body), b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,1567263600\n'
+                                                b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,1567263601\n')
+
+        # パートサイズを超える場合はマルチパートアップロードになる
+        data = [os.urandom(1024 * 1024) for _ in range(12)]
+        sink = GzipUploadSink(self.bucket_name, 'parted5/large.csv.gz', 5 * 1024 * 1024)
+        [sink.write(x) for x in data]
+        self.assertGreater(len(sink.parts), 0)
+        sink.close()
+        body = self.s3.get_object(Bucket=self.bucket_name, Key='parted5/large.csv.gz')['Body'].read()
+        self.assertEqual(gzip.decompress(body), b''.join(data))
+
+        # 中止した場合はオブジェクトは作成されない
+        sink = GzipUploadSink(self.bucket_name, 'parted5/abort.csv.gz', 5 * 1024 * 1024)
+        [sink.write(x) for x in data]
+        sink.abort()
+        keys = [x['Key'] for x in self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix='parted5/')['Contents']]
+        self.assertEqual(sorted(keys), ['parted5/large.csv.gz', 'parted5/small.csv.gz'])
+        self.s3.delete_objects(Bucket=self.bucket_name, Delete={'Objects': [{'Key': x} for x in keys]})
+
+    def test_tile_upload_sink(self) -> None:
+        """
+        TileUploadSinkのテスト
+        """
+        lines = [b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.681236,139.767125,1567263600\n',  # xn76
+                 b'3313c918-55e4-4d15-879e-d9fb076a86d1,34.702485,135.495951,1567263601\n',  # xn0m
+                 b'3313c918-55e4-4d15-879e-d9fb076a86d2,35.66,139.70,1567263602\n',          # xn76
+                 b'3313c918-55e4-4d15-879e-d9fb076a86d3,a,139.767,1567263603\n']             # 不正
+        sink = TileUploadSink(GzipUploadSink(self.bucket_name, 'parted6/data.csv.gz', 5 * 1024 * 1024),
+                              self.bucket_name, 'tiles6/data.csv.gz', 'tiles6/data.index.json', 4, 5 * 1024 * 1024)
+        sink.write(lines[0] + lines[1])
+        sink.write(lines[2] + lines[3])
+        sink.close()
+
+        # 元の書き込み先にはそのまま書き込まれる
+        body = self.s3.get_object(Bucket=self.bucket_name, Key='parted6/data.csv.gz')['Body'].read()
+        self.assertEqual(gzip.decompress(body), b''.join(lines))
+
+        # タイル順に並び、インデックスの範囲だけで展開できる
+        index = geohash_tile.load_tile_index(self.s3, self.bucket_name, 'tiles6/')
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index[0]['records'], 4)
+        self.assertEqual(sorted(index[0]['tiles'].keys()), ['_', 'xn0m', 'xn76'])
+        body = self.s3.get_object(Bucket=self.bucket_name, Key='tiles6/data.csv.gz')['Body'].read()
+        self.assertEqual(gzip.decompress(body), lines[3] + lines[1] + lines[0] + lines[2])
+        offset, size, records = index[0]['tiles']['xn76']
+        self.assertEqual(gzip.decompress(body[offset:offset + size]), lines[0] + lines[2])
+        self.assertEqual(records, 2)
+
+        self.assertEqual(geohash_tile.read_tile(self.s3, self.bucket_name, 'tiles6/', 'xn'), lines[1] + lines[0] + lines[2])
+        self.assertEqual(geohash_tile.read_tile(self.s3, self.bucket_name, 'tiles6/', 'xn76urx'), lines[0])
+        self.assertEqual(geohash_tile.read_tile(self.s3, self.bucket_name, 'tiles6/', 'u'), b'')
+
+        # 一時ファイルに書き出しながら(1行毎)まとめても、同じタイル順の結果になる
+        sink = TileUploadSink(GzipUploadSink(self.bucket_name, 'parted6/spill.csv.gz', 5 * 1024 * 1024),
+                              self.bucket_name, 'tiles6/spill.csv.gz', 'tiles6/spill.index.json', 4, 5 * 1024 * 1024,
+                              buffer_bytes=1)
+        for line in lines:
+            sink.write(line)
+        sink.close()
+        spill_index = geohash_tile.load_tile_index(self.s3, self.bucket_name, 'tiles6/')[1]
+        self.assertEqual(spill_index['key'], 'tiles6/spill.csv.gz')
+        self.assertEqual(spill_index['records'], 4)
+        self.assertEqual([(x, y[2]) for x, y in sorted(spill_index['tiles'].items())],
+                         [('_', 1), ('xn0m', 1), ('xn76', 2)])
+        body = self.s3.get_object(Bucket=self.bucket_name, Key='tiles6/spill.csv.gz')['Body'].read()
+        self.assertEqual(gzip.decompress(body), lines[3] + lines[1] + lines[0] + lines[2])
+        offset, size, records = spill_index['tiles']['xn76']
+        self.assertEqual(gzip.decompress(body[offset:offset + size]), lines[0] + lines[2])
+        self.s3.delete_objects(Bucket=self.bucket_name, Delete={'Objects': [
+            {'Key': x} for x in ['parted6/spill.csv.gz', 'tiles6/spill.csv.gz', 'tiles6/spill.index.json']]})
+
+        # 中止した場合はオブジェクトは作成されない
+        sink = TileUploadSink(GzipUploadSink(self.bucket_name, 'parted6/abort.csv.gz', 5 * 1024 * 1024),
+                              self.bucket_name, 'tiles6/abort.csv.gz', 'tiles6/abort.index.json', 4, 5 * 1024 * 1024)
+        sink.write(b''.join(lines))
+        sink.buffer_bytes = 1
+        sink.write(lines[0])  # 一時ファイルに書き出した後に中止する
+        sink.abort()
+        keys = [x['Key'] for x in self.s3.list_objects_v2(Bucket=self.bucket_name)['Contents']
+                if x['Key'].startswith('parted6/') or x['Key'].startswith('tiles6/')]
+        self.assertEqual(sorted(keys), ['parted6/data.csv.gz', 'tiles6/data.csv.gz', 'tiles6/data.index.json'])
+        self.s3.delete_objects(Bucket=self.bucket_name, Delete={'Objects': [{'Key': x} for x in keys]})
+
+    def test_parse_parquet_rows(self) -> None:
+        """
+        parse_parquet_rowsのテスト
+        """
+        table = parse_parquet_rows(b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,1567263600\n'
+                                   b'3313c918-55e4-4d15-879e-d9fb076a86d0,-3.5e1, 1.,+1567263601\n'
+                                   b'"3313c918",hoge,,1_567_263_602\n'
+                                   b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,99999999999\n')
+        self.assertEqual(table.to_pylist(), [
+            {'user_id': '3313c918-55e4-4d15-879e-d9fb076a86d0', 'latitude': 35.7, 'longitude': 135.1,
+             'created_at': 1567263600},
+            {'user_id': '3313c918-55e4-4d15-879e-d9fb076a86d0', 'latitude': -35.0, 'longitude': 1.0,
+             'created_at': 1567263601},
+            {'user_id': '"3313c918"', 'latitude': None, 'longitude': None, 'created_at': 1567263602},
+            {'user_id': '3313c918-55e4-4d15-879e-d9fb076a86d0', 'latitude': 35.7, 'longitude': 135.1,
+             'created_at': None}])
+
+    def test_parquet_upload_sink(self) -> None:
+        """
+        ParquetUploadSinkのテスト
+        """
+        lines = [bytes('3313c918-55e4-4d15-879e-{0:012d},35.7,135.1,{1}\n'.format(i % 7, 1567263600 + i), 'ascii')
+                 for i in range(25)]
+        sink = ParquetUploadSink(self.bucket_name, 'parted7/test.parquet', 5 * 1024 * 1024, 10)
+        sink.write(b''.join(lines[:3]))
+        [sink.write(x) for x in lines[3:]]
+        sink.close()
+
+        body = self.s3.get_object(Bucket=self.bucket_name, Key='parted7/test.parquet')['Body'].read()
+        parquet_file = pyarrow.parquet.ParquetFile(io.BytesIO(body))
+        self.assertEqual(parquet_file.metadata.num_rows, 25)
+        self.assertEqual([parquet_file.metadata.row_group(i).num_rows for i in range(parquet_file.num_row_groups)],
+                         [10, 10, 5])
+        self.assertIn('RLE_DICTIONARY', parquet_file.metadata.row_group(0).column(0).encodings)
+        self.assertEqual([bytes('{0},{1!r},{2!r},{3}\n'.format(*x.values()), 'ascii')
+                          for x in parquet_file.read().to_pylist()], lines)
+        self.s3.delete_object(Bucket=self.bucket_name, Key='parted7/test.parquet')
+
     def test_get_timestamp_and_buffer(self) -> None:
         """
         get_timestamp_and_bufferのテスト
@@ -230,6 +462,49 @@ class TestRetrieveRequest(unittest.TestCase):
         self.assertEqual(get_timestamp_and_buffer(b'\n'), (0, b''))
         self.assertEqual(get_timestamp_and_buffer(b''), (0, b''))
 
+    def test_split_text(self) -> None:
+        """
+        split_text_bytes, split_text_numpy, split_location_dataのテスト
+        """
+        # 無効行の判定はget_timestamp_and_bufferと同じになる
+        lines = [b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,1567263600\n',
+                 b'  3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,1567263599\r\n',
+                 b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1, +1567263601\x1f\n',
+                 b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,1_567_263_602\n',
+                 b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,hoge\n',
+                 b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,\n',
+                 b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1\n',
+                 b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,1567263600,1\n',
+                 b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,0\n',
+                 b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,-1567263600\n',
+                 b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,1\n',
+                 b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,-1\n',
+                 b'\n',
+                 b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,1567177199']
+        expected = dict()
+        for line in lines:
+            timestamp, buffer = get_timestamp_and_buffer(line)
+            if timestamp > 0:
+                expected[get_base_time(timestamp)] = expected.get(get_base_time(timestamp), b'') + buffer
+
+        text = b''.join(lines)
+        for split_text in [split_text_bytes, split_text_numpy]:
+            self.assertEqual(split_text(text), expected)
+            self.assertEqual(split_text(text + b'\n'), expected)
+            self.assertEqual(split_text(b''), dict())
+            self.assertEqual(split_text(b'\n'), dict())
+            self.assertRaises(ValueError, split_text, 'あ'.encode('utf-8'))
+
+        # int64に収まらないタイムスタンプ
+        line = b'3313c918-55e4-4d15-879e-d9fb076a86d0,35.7,135.1,99999999999999999999\n'
+        self.assertEqual(split_text_numpy(line + text), split_text_bytes(line + text))
+
+        for mode in ['line', 'bytes', 'numpy']:
+            self.assertEqual(split_location_data(text, 'csv', mode), expected)
+            compressor = work_file.create_compressor('csv.gz')
+            self.assertEqual(split_location_data(compressor.compress(text) + compressor.flush(), 'csv.gz', mode),
+                             expected)
+
     def test_remove_location_file(self) -> None:
         """
         remove_location_fileのテスト
@@ -241,7 +516,9 @@ class TestRetrieveRequest(unittest.TestCase):
                 or 'work/1567177201.csv' not in key_set:
             self.skipTest('test files not exists')
 
-        remove_location_file(['work/1567177200.csv', 'work/1567177199.csv'], bucket=self.bucket_name)
+        failures = remove_location_file(['work/1567177200.csv', 'work/1567177199.csv'], bucket=self.bucket_name,
+                                        workers=2)
+        self.assertEqual(failures, dict())
 
         request = self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix='work/1567177')
         key_set = set([c['Key'] for c in request['Contents']])
@@ -280,6 +557,71 @@ class TestRetrieveRequest(unittest.TestCase):
                 results = cur.fetchall()
         self.assertIn('s3://{}/parted/created_date=20190901'.format(self.bucket_name), [x[0] for x in results])
 
+    def test_add_partitions_to_redshift(self) -> None:
+        """
+        add_partitions_to_redshiftのテスト
+        """
+        cache_file = tempfile.NamedTemporaryFile(delete=False)
+        cache_file.close()
+        try:
+            with psycopg2.connect(self.connection_string) as conn:
+                conn.autocommit = True  # ALTER TABLEはBEGIN内で使えないので、autocommit=Trueにしておく
+                self.assertEqual(add_partitions_to_redshift(conn, ['20190903', '20190902', '20190903'],
+                                                            'spectrum.test', self.bucket_name, 'parted/',
+                                                            cache_file.name),
+                                 ['20190902', '20190903'])
+                # 登録済みのものはALTER TABLEを発行しない
+                self.assertEqual(add_partitions_to_redshift(conn, ['20190902', '20190903'], 'spectrum.test',
+                                                            self.bucket_name, 'parted/', cache_file.name), [])
+                with conn.cursor() as cur:
+                    cur.execute('select location from svv_external_partitions where tablename=\'test\'')
+                    results = [x[0] for x in cur.fetchall()]
+            for ymd in ['20190902', '20190903']:
+                self.assertIn('s3://{0}/parted/created_date={1}'.format(self.bucket_name, ymd), results)
+        finally:
+            os.remove(cache_file.name)
+
+    def test_add_partitions_to_redshift_chunk(self) -> None:
+        """
+        add_partitions_to_redshiftのテスト (MAX_PARTITIONS_PER_ALTER件を超える場合)
+        """
+        statements = []
+
+        class Cursor:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def execute(self, sql):
+                if len(statements) == 2:  # 3回目のALTER TABLEは失敗させる
+                    raise psycopg2.Error('failed')
+                statements.append(sql)
+
+        class Connection:
+            def cursor(self):
+                return Cursor()
+
+        ymd_list = [(datetime.date(2019, 1, 1) + datetime.timedelta(days=x)).strftime('%Y%m%d') for x in range(250)]
+        cache_file = tempfile.NamedTemporaryFile(delete=False)
+        cache_file.close()
+        try:
+            with self.assertRaises(psycopg2.Error):
+                add_partitions_to_redshift(Connection(), ymd_list, 'spectrum.test', self.bucket_name, 'parted/',
+                                           cache_file.name)
+            self.assertEqual([x.count(' partition(') for x in statements], [100, 100])
+            # 成功したALTER TABLEの分だけ記録されている
+            with open(cache_file.name) as fd:
+                self.assertEqual(len(fd.readlines()), 200)
+
+            statements.clear()
+            self.assertEqual(add_partitions_to_redshift(Connection(), ymd_list, 'spectrum.test', self.bucket_name,
+                                                        'parted/', cache_file.name), ymd_list[200:])
+            self.assertEqual([x.count(' partition(') for x in statements], [50])
+        finally:
+            os.remove(cache_file.name)
+
     def test_main(self) -> None:
         """
         mainのテスト
@@ -287,7 +629,8 @@ class TestRetrieveRequest(unittest.TestCase):
         envs = {'BUCKET_LOCATION': self.bucket_name,
                 'FOLDER_WORK': 'work2/',
                 'FOLDER_PARTED': 'parted/',
-                'TABLE_LOCATION': 'spectrum.test'}
+                'TABLE_LOCATION': 'spectrum.test',
+                'PARTITION_CACHE_FILE': ''}
 
         # 環境変数上書き
         old_values = dict()
@@ -313,11 +656,20 @@ class TestRetrieveRequest(unittest.TestCase):
                                       + '3313c918-55e4-4d15-879e-000000000003,35.7,135.1,' + time2 + '\n'
                                       + '3313c918-55e4-4d15-879e-000000000004,35.7,135.1,' + time3 + '\n', 'ascii'))
 
+        # 日付毎に振り分けられたファイル。本日分は読み込まれずに残る
+        self.s3.put_object(Bucket=self.bucket_name, Key='work2/created_date=' + date_prev + '/' + time2 + '-0000.csv',
+                           Body=bytes('3313c918-55e4-4d15-879e-000000000005,35.7,135.1,' + time2 + '\n', 'ascii'))
+        self.s3.put_object(Bucket=self.bucket_name, Key='work2/created_date=' + date_today + '/' + time3 + '-0000.csv',
+                           Body=bytes('3313c918-55e4-4d15-879e-000000000006,35.7,135.1,' + time3 + '\n', 'ascii'))
+
         # call main()
         self.assertEqual(main(), 'success')
 
-        request = self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix='work2/')
-        self.assertEqual(request['KeyCount'], 1)  # 本日分データが戻されているはず
+        request_work = self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix='work2/')
+        self.assertEqual(request_work['KeyCount'], 2)  # 本日分データが当日のフォルダに戻されているはず
+        work_keys = [x['Key'] for x in request_work['Contents']]
+        self.assertTrue(all([x.startswith('work2/created_date=' + date_today + '/') for x in work_keys]))
+        self.assertIn('work2/created_date=' + date_today + '/' + time3 + '-0000.csv', work_keys)
 
         request = self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix='parted/created_date=' + date_prev + '/')
         self.assertGreaterEqual(request['KeyCount'], 1)  # 昨日分データが作成されている
@@ -332,17 +684,19 @@ class TestRetrieveRequest(unittest.TestCase):
 
                 for user_id in ['3313c918-55e4-4d15-879e-000000000000',
                                 '3313c918-55e4-4d15-879e-000000000002',
-                                '3313c918-55e4-4d15-879e-000000000003']:
+                                '3313c918-55e4-4d15-879e-000000000003',
+                                '3313c918-55e4-4d15-879e-000000000005']:
                     self.assertIn((user_id,), results_prev)
                     self.assertNotIn((user_id,), results_today)
 
                 for user_id in ['3313c918-55e4-4d15-879e-000000000001',
-                                '3313c918-55e4-4d15-879e-000000000004']:
+                                '3313c918-55e4-4d15-879e-000000000004',
+                                '3313c918-55e4-4d15-879e-000000000006']:
                     self.assertNotIn((user_id,), results_prev)
                     self.assertNotIn((user_id,), results_today)
 
         self.s3.delete_objects(Bucket=self.bucket_name,
-                               Delete={'Objects': [{'Key': 'work2/' + c + '.csv'} for c in [time1, time2, time3]]})
+                               Delete={'Objects': [{'Key': x} for x in work_keys]})
 
         # 環境変数戻す
         for k in envs.keys():
@@ -350,3 +704,80 @@ class TestRetrieveRequest(unittest.TestCase):
                 del os.environ[k]
             else:
                 os.environ[k] = old_values[k]
+
+    def test_main_parquet_pipeline(self) -> None:
+        """
+        OUTPUT_FORMAT=parquetで、retrieve_request, compact_partition, collect_requestを順に実行するテスト
+        FOLDER_PARTEDを指定しなくても、すべて同じフォルダ(parted_parquet/)を読み書きする
+        """
+        envs = {'BUCKET_LOCATION': self.bucket_name,
+                'BUCKET_DOWNLOAD': self.bucket_name,
+                'FOLDER_WORK': 'work5/',
+                'FOLDER_PARTED': None,
+                'OUTPUT_FORMAT': 'parquet',
+                'TABLE_LOCATION': 'spectrum.test_parquet',
+                'CHECKPOINT_KEY': 'checkpoint5/retrieve_request.json',
+                'BATCH_SIZE': '1',
+                'PARTITION_CACHE_FILE': '',
+                'EXPORT_ENGINE': 's3'}
+
+        # 環境変数上書き (Noneは削除)
+        old_values = dict()
+        for k, v in envs.items():
+            old_values[k] = os.environ.get(k)
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+        with psycopg2.connect(self.connection_string) as conn:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute('''create external table spectrum.test_parquet(
+                  user_id char(36),
+                  latitude double precision,
+                  longitude double precision,
+                  created_at integer)
+                  partitioned by (created_date char(8))
+                  stored as parquet
+                  location 's3://{}/parted_parquet/' '''.format(self.bucket_name))
+
+        try:
+            # 昨日のファイル2つ (BATCH_SIZE=1なので、パーティションにオブジェクトが2つできる)
+            today_base_time = get_base_time(int(time.time()))
+            date_prev = get_date_str(today_base_time - 1)
+            lines = ['3313c918-55e4-4d15-879e-00000000000{0},35.7,135.1,{1}\n'.format(i, today_base_time - 100 + i)
+                     for i in range(3)]
+            self.s3.put_object(Bucket=self.bucket_name, Key='work5/1.csv', Body=bytes(''.join(lines[:2]), 'ascii'))
+            self.s3.put_object(Bucket=self.bucket_name, Key='work5/2.csv', Body=bytes(lines[2], 'ascii'))
+
+            self.assertEqual(main(), 'success')
+            prefix = 'parted_parquet/created_date=' + date_prev + '/'
+            request = self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix=prefix)
+            self.assertEqual(request['KeyCount'], 2)
+            self.assertTrue(all([x['Key'].endswith('.parquet') for x in request['Contents']]))
+
+            self.assertEqual(compact_partition.main([date_prev]), 'success')
+            request = self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix=prefix)
+            self.assertEqual(request['KeyCount'], 1)
+
+            self.assertEqual(collect_request.main_days([date_prev]), 'success')
+            body = self.s3.get_object(Bucket=self.bucket_name, Key=date_prev + '.csv.gz')['Body'].read()
+            self.assertEqual(sorted(gzip.decompress(body).decode('ascii').split('\r\n')[:-1]),
+                             [x.rstrip('\n') for x in lines])
+        finally:
+            with psycopg2.connect(self.connection_string) as conn:
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute('drop table spectrum.test_parquet')
+
+            # 環境変数戻す
+            for k in envs.keys():
+                if old_values[k] is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = old_values[k]
+
+
+if __name__ == "__main__":
+    unittest.main()